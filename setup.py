@@ -29,8 +29,10 @@ setup(
     install_requires=[
         'dalibs==1.0',
         'pyvmomi>=6.5,<6.7',
-        'pycurl==7.43.0',
+        'pycurl==7.43.0.2',
         'PyYAML==3.13',
+        'numpy>=1.11,<1.17',
+        'paramiko>=2.4,<3',
     ],
     classifiers=[
         'Development Status :: 4 - Beta',
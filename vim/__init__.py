@@ -15,9 +15,18 @@
 # limitations under the License.
 #
 
+import bandwidth
+import fanout
+import hedge
+import history
 import patched
+import perf
+import sshpool
 import sys
+import tail
+import transfer
 import vc
+import wait
 from pyVmomi import vim
 
 
@@ -30,12 +39,23 @@ class Proxy(object):
         return cls._instance
 
     def __init__(self):
+        self.bandwidth = bandwidth
+        self.fanout = fanout.fanout
+        self.hedge = hedge
+        self.history = history
+        self.perf = perf
+        self.sshpool = sshpool
+        self.tail = tail.tail
+        self.transfer = transfer
         self.vc = vc
+        self.wait = wait
         self.vim = vim
 
     def __getattr__(self, attr):
         if attr == 'VC':
             return getattr(self.vc, attr)
+        if attr == 'wait_for':
+            return getattr(self.wait, attr)
         return getattr(self.vim, attr)
 
 # The hack is to make this module's attribute lookups go through the proxy class
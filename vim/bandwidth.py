@@ -0,0 +1,272 @@
+#
+#
+# Copyright (c) 2013-2018 Datrium Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Bandwidth scheduler for the uploads of deploy.OVF.
+
+Without limits, concurrent imports all saturate the uplink to the same ESX hosts until
+their leases time out. Once configured, every upload registers a Transfer and the
+curl callbacks of deploy.py only send what the Transfer allows. The bandwidth of a
+host (and the global bandwidth) is shared among its active transfers in proportion to
+the weight of their priority class. With a lockfile, the transfers of all processes
+using the same file are taken into account.
+
+Example:
+    >>> vim.bandwidth.configure(rate=200 * MB, host_rate=80 * MB, lockfile='/tmp/ovf.bw')
+    >>> vc.ImportOVF(ovffile, priority='high')
+    >>> vim.bandwidth.scheduler.stats()
+    {'active': 2, 'queued': 1, 'processes': 3, 'bytes': {'esx1': 52428800}, ...}
+'''
+
+import collections
+import contextlib
+import errno
+import fcntl
+import json
+import os
+import threading
+import time
+import urlparse
+
+
+MB = 1024 * 1024
+
+# Weights of the priority classes.
+PRIORITIES = {
+    'high': 4,
+    'normal': 2,
+    'low': 1,
+}
+
+# A transfer can save up at most this many seconds worth of its rate.
+BURST_SECONDS = 0.5
+
+# Do not bother curl with fewer bytes than this, unless it asks for fewer.
+MIN_BYTES = 16 * 1024
+
+# How often the weights of other processes are read from the lockfile.
+SYNC_SECONDS = 1
+
+# Process-wide scheduler, see configure(). None means no limits.
+scheduler = None
+
+
+class Transfer(object):
+    ''' One upload to host, see Scheduler.transfer() '''
+
+    def __init__(self, scheduler, host, priority):
+        if priority not in PRIORITIES:
+            raise ValueError('Unknown priority %s, expected one of %s' %
+                             (priority, ', '.join(sorted(PRIORITIES))))
+        self.scheduler = scheduler
+        self.host = host
+        self.priority = priority
+        self.weight = PRIORITIES[priority]
+        self.allowance = 0.0
+        self.stamp = time.time()
+        self.resume = None  # when a waiting transfer may send again
+        self.sent = 0
+
+    def acquire(self, size, block=True):
+        '''
+        Get the number of bytes (up to size) the transfer may send now. Without block,
+        0 is returned if it has to wait (see ready()); otherwise this sleeps.
+        '''
+        while True:
+            with self.scheduler.lock:
+                rate = self.scheduler.rate(self)
+                now = time.time()
+                if rate is None:
+                    granted = size
+                else:
+                    self.allowance = min(self.allowance + (now - self.stamp) * rate,
+                                         max(rate * BURST_SECONDS, MIN_BYTES))
+                    granted = min(size, int(self.allowance))
+                    wanted = min(size, MIN_BYTES)
+                    if granted < wanted:
+                        granted = 0
+                        self.resume = now + (wanted - self.allowance) / rate
+                    else:
+                        self.allowance -= granted
+                self.stamp = now
+                if granted:
+                    self.resume = None
+                    self.sent += granted
+                    self.scheduler.sent[self.host] += granted
+                    return granted
+                delay = self.resume - now
+            if not block:
+                return 0
+            time.sleep(delay)
+
+    def ready(self):
+        ''' Whether a transfer that was refused bytes may send again. '''
+        return self.resume is None or time.time() >= self.resume
+
+    def delay(self):
+        ''' Seconds until ready(). '''
+        if self.resume is None:
+            return 0
+        return max(self.resume - time.time(), 0)
+
+
+class Scheduler(object):
+    '''
+    Shares rate (bytes/second, all hosts) and host_rate (per host, overridden per
+    host name by host_rates) among the active transfers by weight. None means
+    unlimited. With lockfile, the weights of the transfers of other processes are
+    shared through that file.
+    '''
+
+    def __init__(self, rate=None, host_rate=None, host_rates=None, lockfile=None):
+        self.rate_limit = rate
+        self.host_rate = host_rate
+        self.host_rates = dict(host_rates or {})
+        self.lockfile = lockfile
+        self.lock = threading.RLock()
+        self.active = set()
+        self.sent = collections.Counter()  # host => bytes
+        self.remote = {}  # weights of other processes: {'total': w, 'hosts': {host: w}}
+        self.processes = 1
+        self.synced = 0
+
+    @contextlib.contextmanager
+    def transfer(self, url, priority='normal'):
+        ''' Register an upload to url for the duration of the block. '''
+        t = self.register(url, priority)
+        try:
+            yield t
+        finally:
+            self.unregister(t)
+
+    def register(self, url, priority='normal'):
+        host = urlparse.urlparse(url).hostname or url
+        t = Transfer(self, host, priority)
+        with self.lock:
+            self.active.add(t)
+            self.synced = 0
+        return t
+
+    def unregister(self, t):
+        with self.lock:
+            self.active.discard(t)
+            self.synced = 0
+
+    def rate(self, t):
+        '''
+        The current share of transfer t in bytes/second, or None if it is unlimited.
+        '''
+        host_rate = self.host_rates.get(t.host, self.host_rate)
+        if self.rate_limit is None and host_rate is None:
+            return None
+        with self.lock:
+            if self.lockfile and time.time() - self.synced >= SYNC_SECONDS:
+                self.sync()
+            rates = []
+            if self.rate_limit is not None:
+                total = sum(x.weight for x in self.active) + self.remote.get('total', 0)
+                rates.append(self.rate_limit * t.weight / float(total))
+            if host_rate is not None:
+                total = sum(x.weight for x in self.active if x.host == t.host) + \
+                    self.remote.get('hosts', {}).get(t.host, 0)
+                rates.append(host_rate * t.weight / float(total))
+        return min(rates)
+
+    def weights(self):
+        ''' The weights of this process' transfers: {'total': w, 'hosts': {host: w}} '''
+        hosts = collections.Counter()
+        for t in self.active:
+            hosts[t.host] += t.weight
+        return {'total': sum(hosts.values()), 'hosts': dict(hosts)}
+
+    def sync(self):
+        '''
+        Publish the weights of this process to the lockfile and read the ones of the
+        other (live) processes.
+        '''
+        with open(self.lockfile, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    state = json.loads(f.read() or '{}')
+                except ValueError:
+                    state = {}
+                mine = self.weights()
+                if mine['total']:
+                    state[str(os.getpid())] = mine
+                else:
+                    state.pop(str(os.getpid()), None)
+                remote = {'total': 0, 'hosts': collections.Counter()}
+                for pid, weights in state.items():
+                    if int(pid) == os.getpid():
+                        continue
+                    if not _alive(int(pid)):
+                        del state[pid]
+                        continue
+                    remote['total'] += weights['total']
+                    remote['hosts'].update(weights['hosts'])
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        self.remote = remote
+        self.processes = len(state) + (0 if mine['total'] else 1)
+        self.synced = time.time()
+
+    def stats(self):
+        ''' Statistics on the transfers of this process. '''
+        with self.lock:
+            active = list(self.active)
+            return {
+                'active': len(active),
+                'queued': len([t for t in active if not t.ready()]),
+                'processes': self.processes,
+                'bytes': dict(self.sent),
+                'transfers': [(t.host, t.priority, t.sent, self.rate(t)) for t in active],
+            }
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # EPERM: the process exists, it belongs to another user.
+        return e.errno != errno.ESRCH
+    return True
+
+
+def configure(rate=None, host_rate=None, host_rates=None, lockfile=None):
+    '''
+    Install the process-wide scheduler used by deploy.OVF (see Scheduler); without
+    any limit, uploads are not scheduled.
+    '''
+    global scheduler
+    if rate is None and host_rate is None and not host_rates:
+        scheduler = None
+    else:
+        scheduler = Scheduler(rate, host_rate, host_rates, lockfile)
+    return scheduler
+
+
+def register(url, priority='normal'):
+    ''' Register an upload with the process-wide scheduler; None without one. '''
+    if scheduler is None:
+        return None
+    return scheduler.register(url, priority)
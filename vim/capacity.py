@@ -0,0 +1,222 @@
+#
+#
+# Copyright (c) 2013-2018 Datrium Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+CPU and memory capacity snapshot of many hosts.
+
+vim.HostSystem.cpuAvailable (and memAvailable) fetch the power state and the
+reservation of every VM on the host, one RPC each. A Capacity table is built from a
+single (paged) property collector query for the hosts and all their VMs instead,
+and is computed per host with numpy group-by operations:
+
+    >>> table = cluster.capacity()
+    >>> table['cpuAvailable']
+    array([ 41800.,  43900.,  40100.])
+    >>> table[host]
+    {'cpuTotal': 48000.0, 'cpuReserved': 6200.0, 'cpuAvailable': 41800.0, ...}
+
+While a table is referenced and younger than TTL seconds, the capacity properties of
+its hosts (cpuAvailable, memAvailable, ...) are read from it.
+'''
+
+import mo
+import numpy
+import time
+import weakref
+from pyVmomi import vim
+
+
+MB = 1024 * 1024
+
+# The capacity properties of a host are read from its latest table up to this age.
+TTL = 30
+
+# Objects per page of the property collector query.
+PAGESIZE = 1000
+
+HOST_PATHS = [
+    'summary.hardware.cpuMhz',
+    'summary.hardware.numCpuCores',
+    'summary.hardware.memorySize',
+    'summary.quickStats.overallCpuUsage',
+    'summary.quickStats.overallMemoryUsage',
+]
+
+VM_PATHS = [
+    'runtime.powerState',
+    'runtime.host',
+    'config.cpuAllocation.reservation',
+    'config.memoryAllocation.reservation',
+]
+
+# CPU in MHz, memory in MB, utilization in percent, vms is the number of powered-on VMs.
+COLUMNS = [
+    'cpuTotal', 'cpuReserved', 'cpuAvailable', 'cpuUsage', 'cpuUtilization',
+    'memTotal', 'memReserved', 'memAvailable', 'memUsage', 'memUtilization',
+    'vms',
+]
+
+_tables = weakref.WeakValueDictionary()  # host => latest Capacity
+
+
+class Capacity(object):
+    '''
+    Per-host capacity table. table[column] is the numpy array of column (see COLUMNS)
+    in the order of table.hosts, table[host] is the row of host as a dictionary.
+    '''
+
+    def __init__(self, hosts, columns):
+        self.hosts = hosts
+        self.index = dict((h, i) for i, h in enumerate(hosts))
+        self.columns = columns
+        self.taken = time.time()
+
+    def __len__(self):
+        return len(self.hosts)
+
+    def __iter__(self):
+        return iter(self.hosts)
+
+    def __contains__(self, host):
+        return host in self.index
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            return self.columns[key]
+        return self.row(key)
+
+    def row(self, host):
+        i = self.index[host]
+        return dict((c, self.columns[c][i].item()) for c in COLUMNS)
+
+    def rows(self):
+        return [(h, self.row(h)) for h in self.hosts]
+
+    @property
+    def age(self):
+        return time.time() - self.taken
+
+
+def _vmspec():
+    return vim.TraversalSpec(name='vms', type=vim.HostSystem, path='vm', skip=False)
+
+
+def _propspecs():
+    return [vim.PropertySpec(type=vim.HostSystem, all=False, pathSet=HOST_PATHS),
+            vim.PropertySpec(type=vim.VirtualMachine, all=False, pathSet=VM_PATHS)]
+
+
+def _query(pc, objspecs):
+    pfspec = vim.PropertyFilterSpec(objectSet=objspecs, propSet=_propspecs())
+    hosts, vms = {}, []
+    for content in mo.retrieve(pc, [pfspec], maxObjects=PAGESIZE):
+        props = dict((p.name, p.val) for p in content.propSet)
+        if isinstance(content.obj, vim.HostSystem):
+            hosts[content.obj] = props
+        else:
+            vms.append(props)
+    return hosts, vms
+
+
+def snapshot(root=None, hosts=None):
+    '''
+    The Capacity of hosts, or of all the hosts of root (a ComputeResource, or a
+    Folder/Datacenter, searched recursively).
+    '''
+    if hosts is not None:
+        hosts = list(hosts)
+        if not hosts:
+            return table([], [])
+        pc = hosts[0].si.content.propertyCollector
+        objspecs = [vim.ObjectSpec(obj=h, skip=False, selectSet=[_vmspec()]) for h in hosts]
+        return table(*_query(pc, objspecs))
+
+    pc = root.si.content.propertyCollector
+    if isinstance(root, vim.ComputeResource):
+        tspec = vim.TraversalSpec(name='hosts', type=vim.ComputeResource, path='host',
+                                  skip=False, selectSet=[_vmspec()])
+        return table(*_query(pc, [vim.ObjectSpec(obj=root, skip=True, selectSet=[tspec])]))
+
+    view = root.si.content.viewManager.CreateContainerView(root, [vim.HostSystem], True)
+    try:
+        tspec = vim.TraversalSpec(name='view', type=vim.ContainerView, path='view',
+                                  skip=False, selectSet=[_vmspec()])
+        return table(*_query(pc, [vim.ObjectSpec(obj=view, skip=True, selectSet=[tspec])]))
+    finally:
+        view.DestroyView()
+
+
+def table(hosts, vms):
+    '''
+    Compute the Capacity of hosts ({host: {path: value}}, see HOST_PATHS) from their
+    vms ([{path: value}], see VM_PATHS). VMs on other hosts are ignored.
+    '''
+    order = list(hosts)
+    if not order:
+        # numpy.bincount(..., minlength=0) raises before numpy 1.14.
+        return Capacity(order, dict((c, numpy.zeros(0)) for c in COLUMNS))
+    index = dict((h, i) for i, h in enumerate(order))
+
+    def host_column(path):
+        return numpy.array([hosts[h].get(path) or 0 for h in order], dtype=float)
+
+    cpuTotal = host_column('summary.hardware.cpuMhz') * host_column('summary.hardware.numCpuCores')
+    memTotal = host_column('summary.hardware.memorySize') / MB
+    cpuUsage = host_column('summary.quickStats.overallCpuUsage')
+    memUsage = host_column('summary.quickStats.overallMemoryUsage')
+
+    # Group the reservations of the powered-on VMs by host.
+    on = [vm for vm in vms if vm.get('runtime.host') in index and
+          vm.get('runtime.powerState') == vim.VirtualMachine.PowerState.poweredOn]
+    owner = numpy.array([index[vm['runtime.host']] for vm in on], dtype=int)
+    cpuRes = numpy.array([vm.get('config.cpuAllocation.reservation') or 0 for vm in on], dtype=float)
+    memRes = numpy.array([vm.get('config.memoryAllocation.reservation') or 0 for vm in on], dtype=float)
+    cpuReserved = numpy.bincount(owner, weights=cpuRes, minlength=len(order))
+    memReserved = numpy.bincount(owner, weights=memRes, minlength=len(order))
+    count = numpy.bincount(owner, minlength=len(order))
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        cpuUtilization = numpy.where(cpuTotal > 0, cpuUsage / cpuTotal * 100.0, 0.0)
+        memUtilization = numpy.where(memTotal > 0, memUsage / memTotal * 100.0, 0.0)
+
+    result = Capacity(order, {
+        'cpuTotal': cpuTotal,
+        'cpuReserved': cpuReserved,
+        'cpuAvailable': cpuTotal - cpuReserved,
+        'cpuUsage': cpuUsage,
+        'cpuUtilization': cpuUtilization,
+        'memTotal': memTotal,
+        'memReserved': memReserved,
+        'memAvailable': memTotal - memReserved,
+        'memUsage': memUsage,
+        'memUtilization': memUtilization,
+        'vms': count,
+    })
+    for h in order:
+        _tables[h] = result
+    return result
+
+
+def lookup(host):
+    '''
+    The row of host in its latest Capacity table, or None if there is no such table
+    (anymore) or it is older than TTL.
+    '''
+    result = _tables.get(host)
+    if result is None or result.age > TTL:
+        return None
+    return result.row(host)
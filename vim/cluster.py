@@ -20,14 +20,37 @@ Adds functionality to pyVmomi.Vim.ClusterComputeResource
 '''
 
 
-import time
+import capacity as _capacity
+import placement as _placement
+import wait
 from pyVmomi import vim, vmodl
 
 
+# Seconds to wait for a resource pool created concurrently by another caller.
+POOL_TIMEOUT = 60
+
+
 def vm(self):
     return self.find(vim.VirtualMachine)
 
 
+def capacity(self):
+    '''
+    Capacity snapshot of the hosts of this compute resource, see capacity.py
+    '''
+    return _capacity.snapshot(self)
+
+
+def PlaceVM(self, resources, **kwargs):
+    '''
+    Pick a host and a datastore for a new VM with resources (e.g., {'cpu': 1000,
+    'mem': 4096, 'disk': 40}), accounting for the recent placements on this compute
+    resource. See placement.Placer.place() for the options. Only the hosts of this
+    compute resource are considered (a single one for a standalone host).
+    '''
+    return _placement.placer(self).place(resources, **kwargs)
+
+
 def EnableHA_Task(self, datastore):
     '''
     Enable HA and heart beat with the data store
@@ -81,12 +104,12 @@ def CreateResourcePool(self, name):
         return self.resourcePool.CreateResourcePool(name=name, spec=spec)
     except vim.fault.DuplicateName:
         # Another caller has already created (or is creating) the resourcepool.
-        # Wait for it to be created and then return it.
-        while True:
-            time.sleep(0.2)
-            try:
-                return [x for x in self.find(vim.ResourcePool) if x.name == name][0]
-            except vmodl.fault.ManagedObjectNotFound:
-                # The object has already been deleted or has not been completely created
-                # Likely it hasn't been completely created ...
-                continue
+        # Wait for it to show up (with its name) under this cluster and then return it.
+        view = self.si.content.viewManager.CreateContainerView(self, [vim.ResourcePool], True)
+        try:
+            names = wait.wait_for(view, 'name', lambda names: name in names.values(),
+                klass=vim.ResourcePool, timeout=POOL_TIMEOUT,
+                message='Resource pool %s did not appear in %s' % (name, self))
+        finally:
+            view.DestroyView()
+        return [rp for rp, n in names.items() if n == name][0]
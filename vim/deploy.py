@@ -16,23 +16,54 @@
 #
 
 
+import bandwidth
+import collections
+import contextlib
 import dalibs.retry
+import hashlib
+import history
+import json
 import logging
+import mo
 import os
 import pycurl
+import re
+import requests
 import sys
+import tarfile
+import threading
 import time
-from pyVmomi import vim
+import wait
+from pyVmomi import vim, vmodl
 
 
 # Enable curl verbose to stderr.
 curl_debug = 0
 
+# Size of the blocks curl reads from the files it uploads (libcurl's default is 64KB).
+UPLOAD_BUFFERSIZE = 2 * 1024 * 1024
+
+# Name of the template VM of an OVF (by content digest) on a datastore, see OVF.clone().
+TEMPLATE_NAME = 'ovf-%s-%s'
+
+# OVF content digests by (path, size, mtime) of the files, see OVF.digest().
+_digests = {}
+
 
 class OVFException(Exception):
     pass
 
 
+class LeaseLost(OVFException):
+    ''' The lease can no longer be used; the import has to start over. '''
+    pass
+
+
+class TransferFailed(OVFException):
+    ''' A file could not be uploaded within its retries while the lease was usable. '''
+    pass
+
+
 class Container(object):
     ''' Generic class for attribute containment '''
     def __init__(self, attrs=[]):
@@ -41,29 +72,288 @@ class Container(object):
 
 
 class LeaseProgress(object):
-    ''' A class used by curl read callback. Also, provides lease progress updates. '''
-    def __init__(self, lease, total, logger, fp):
-        self.sent = float(0)
+    '''
+    Counts the bytes sent for a lease (see Stream), or reads them itself when used as
+    a curl read callback. Also, provides lease progress updates.
+
+    The callbacks only count the bytes sent. Used as a context manager, a
+    background thread reports the progress to the lease every interval seconds, which
+    also keeps the lease alive, so the transfer never waits on a vCenter round trip.
+    '''
+    def __init__(self, lease, total, logger, fp, interval=5):
+        self.sent = 0
         self.total = total
         self.last = 0
         self.lease = lease
         self.logger = logger
         self.fp = fp
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name='LeaseProgress')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        self.thread.join()
+        return False
 
     def read(self, size):
-        self.update(size)
-        return self.fp.read(size)
+        data = self.fp.read(size)
+        self.update(len(data))
+        return data
 
     def update(self, size):
-        self.sent += size
-        percent = int((self.sent / self.total) * 100)
-        if percent > 100:
-            percent = 100
-        if percent != self.last:
-            if percent % 10 == 0:
+        self.sent += size  # only the transfer (curl) thread writes sent
+
+    def percent(self):
+        if not self.total:
+            return 100
+        return min(int(self.sent * 100 / self.total), 100)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            percent = self.percent()
+            if percent // 10 != self.last // 10:
                 self.logger.debug('Transfer progress: %d' % percent)
-            self.lease.HttpNfcLeaseProgress(percent)
             self.last = percent
+            try:
+                # Sent even when unchanged, it keeps the lease from timing out.
+                self.lease.HttpNfcLeaseProgress(percent)
+            except Exception as e:
+                self.logger.warning('Unable to update lease progress: %s' % e)
+
+
+class Stream(object):
+    '''
+    curl progress callback of one file transfer. Accounts the bytes uploaded (or
+    downloaded) on the LeaseProgress shared by all the files of the lease.
+    '''
+    def __init__(self, progress, transfer=None, download=False):
+        self.progress = progress
+        self.transfer = transfer  # bandwidth.Transfer, when uploads are scheduled
+        self.throttle = None  # see OVF._curl
+        self.download = download
+        self.uploaded = 0
+
+    def xferinfo(self, dltotal, dlnow, ultotal, ulnow):
+        now = int(dlnow if self.download else ulnow)
+        if now > self.uploaded:
+            self.progress.update(now - self.uploaded)
+            self.uploaded = now
+        return 0
+
+    def rewind(self):
+        ''' Take back the progress of a failed request, its bytes are sent again. '''
+        self.progress.update(-self.uploaded)
+        self.uploaded = 0
+
+    def close(self):
+        if self.transfer is not None:
+            self.transfer.scheduler.unregister(self.transfer)
+            self.transfer = None
+
+
+class Throttle(object):
+    '''
+    curl read callback that only reads what the bandwidth.Transfer allows. In a
+    CurlMulti, the handle is paused instead of blocking the other transfers; see
+    OVF._upload_multi for resuming it.
+    '''
+    def __init__(self, read, transfer, multi=False):
+        self._read = read
+        self.transfer = transfer
+        self.multi = multi
+        self.paused = False
+
+    def read(self, size):
+        size = self.transfer.acquire(size, block=not self.multi)
+        if size == 0:
+            self.paused = True
+            return pycurl.READFUNC_PAUSE
+        return self._read(size)
+
+
+class Range(object):
+    ''' curl read callback that reads at most length bytes of fp. '''
+    def __init__(self, fp, length):
+        self.fp = fp
+        self.left = length
+
+    def read(self, size):
+        data = self.fp.read(min(size, self.left))
+        self.left -= len(data)
+        return data
+
+
+def _copy(obj):
+    '''
+    Shallow copy of the DataObject obj. copy.deepcopy can not copy data objects that
+    refer to managed objects (their stub holds locks).
+    '''
+    result = obj.__class__()
+    for prop in obj._GetPropertyList():
+        setattr(result, prop.name, getattr(obj, prop.name))
+    return result
+
+
+def _sha1(ovf):
+    if isinstance(ovf, unicode):
+        ovf = ovf.encode('utf-8')
+    return hashlib.sha1(ovf).hexdigest()
+
+
+class DescriptorCache(object):
+    '''
+    Bounded (LRU) cache of the ParseDescriptor and CreateImportSpec results of OVF
+    descriptors, see OVF._parse and OVF._importspec. Keys start with the kind of
+    result, the vCenter and the sha1 of the descriptor, followed by the parameters
+    that affect the result. Results with errors are not cached.
+    '''
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+
+    def get(self, key, func, *args):
+        ''' The cached value of key, or func(*args) (which is cached). '''
+        with self.lock:
+            if key in self.entries:
+                value = self.entries[key] = self.entries.pop(key)
+                self.stats['hits'] += 1
+                return value
+            self.stats['misses'] += 1
+        value = func(*args)
+        if not getattr(value, 'error', None):
+            with self.lock:
+                self.entries[key] = value
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+        return value
+
+    def invalidate(self, ovf=None):
+        '''
+        Drop the results of the descriptor ovf (the descriptor text or its sha1), or
+        all results without ovf.
+        '''
+        with self.lock:
+            if ovf is None:
+                self.entries.clear()
+                return
+            digest = ovf if re.match(r'^[0-9a-f]{40}$', ovf) else _sha1(ovf)
+            for key in list(self.entries):
+                if key[2] == digest:
+                    del self.entries[key]
+
+
+# Process-wide descriptor cache.
+descriptors = DescriptorCache()
+
+
+# Placement kwargs of imports, see PlacementContext.
+PLACEMENT = ['datacenter', 'cluster', 'resourcepool', 'datastore', 'folder', 'host', 'network']
+
+
+def _props(content):
+    return dict((p.name, p.val) for p in content.propSet)
+
+
+class PlacementContext(object):
+    '''
+    Where imports go: datacenter, cluster, resource pool, datastore, folder, host and
+    network (by name or object). Unspecified ones default as follows, using a few
+    batched property collector calls. Pass a context to many imports (or
+    VC.RegisterVM) to resolve it only once:
+
+        >>> placement = deploy.PlacementContext(vc, network='vlan1550')
+        >>> for name in names:
+        ...     vc.ImportOVF(ovffile, name=name, placement=placement)
+    '''
+
+    # Seconds a validated context is trusted, see validate().
+    ttl = 60
+
+    def __init__(self, vc, datacenter=None, cluster=None, resourcepool=None, datastore=None,
+                 folder=None, host=None, network='VM Network'):
+        self.vc = vc
+        # Given (as opposed to defaulted) placement, see OVF._set_params.
+        self.explicit = set(k for k, v in [('datastore', datastore), ('host', host)]
+                            if v is not None)
+        # Default to 1st datacenter (this will exist even for single ESX)
+        dcattrs = ['vmFolder', 'hostFolder', 'datastore', 'network']
+        if datacenter is None:
+            content = vc.content.rootFolder._find(vim.Datacenter, attrs=dcattrs)[0]
+            datacenter, dcprops = content.obj, _props(content)
+        else:
+            dcprops = mo.collect([datacenter], dcattrs)[datacenter]
+        # Default to 1st cluster if it exists.
+        clattrs = ['resourcePool', 'datastore', 'network']
+        clprops = None
+        if cluster is None:
+            contents = datacenter._find(vim.ClusterComputeResource, attrs=clattrs)
+            if contents:
+                cluster, clprops = contents[0].obj, _props(contents[0])
+        else:
+            clprops = mo.collect([cluster], clattrs)[cluster]
+        # Default to top level resource pool of datacenter or cluster.
+        if resourcepool is None:
+            if cluster is not None:
+                resourcepool = clprops['resourcePool']
+            else:
+                resourcepool = dcprops['hostFolder'].childEntity[0].resourcePool
+        # Default to 1st datastore in cluster or datacenter.
+        if datastore is None:
+            datastore = (clprops if cluster is not None else dcprops)['datastore'][0]
+        # Default to "vm" folder.
+        if folder is None:
+            folder = dcprops['vmFolder']
+
+        # Networks by name, working from deepest node to the root. The first match wins.
+        if host is not None:
+            networks = host.network
+        elif cluster is not None:
+            networks = clprops.get('network', [])
+        else:
+            networks = dcprops.get('network', [])
+        names = mo.collect(networks, ['name'])
+        self.networks = {}
+        for x in networks:
+            self.networks.setdefault(names.get(x, {}).get('name'), x)
+        if isinstance(network, basestring):
+            network = self.networks.get(network, network)
+        assert isinstance(network, vim.Network), 'No suitable network (%s) found!' % network
+
+        self.datacenter = datacenter
+        self.cluster = cluster
+        self.resourcepool = resourcepool
+        self.datastore = datastore
+        self.folder = folder
+        self.host = host
+        self.network = network
+        self.validated = time.time()
+
+    def validate(self, force=False):
+        '''
+        Check that the objects of the context still exist, in one property collector
+        call. Unless forced, this is skipped within ttl seconds of the last check.
+        '''
+        if not force and time.time() - self.validated < self.ttl:
+            return
+        objs = [getattr(self, k) for k in PLACEMENT if getattr(self, k) is not None]
+        try:
+            found = mo.collect(objs, ['name'])
+        except vmodl.fault.ManagedObjectNotFound as e:
+            raise OVFException('Placement is no longer valid, %s is gone' % e.obj)
+        missing = [o for o in objs if o not in found]
+        if missing:
+            raise OVFException('Placement is no longer valid, %s is gone' % missing[0])
+        self.validated = time.time()
 
 
 class OVF(object):
@@ -75,18 +365,79 @@ class OVF(object):
 
     def parse(self, ovffile):
         ''' Parse and load the ovf desctiptor. '''
-        pdp = vim.OvfParseDescriptorParams()
         with open(ovffile, 'r') as f:
             ovf = f.read()
+        return self._parse(ovf)
+
+    def _parse(self, ovf):
         ovf = unicode(ovf, errors='ignore')
-        return ovf, self.vc.si.content.ovfManager.ParseDescriptor(ovf, pdp)
+        key = ('parse', self.vc.host, _sha1(ovf))
+        pdp = vim.OvfParseDescriptorParams()
+        return ovf, descriptors.get(key, self.vc.si.content.ovfManager.ParseDescriptor, ovf, pdp)
+
+    def _importspec(self, ovf, params):
+        '''
+        CreateImportSpec for params, from the template in the descriptors cache when
+        the same descriptor was imported with the same parameters (up to the entity
+        name) before.
+        '''
+        cisp = history.todict(params.cisp)  # managed objects by moId
+        name = cisp.pop('entityName', None)
+        key = ('importspec', self.vc.host, _sha1(ovf), json.dumps(cisp, sort_keys=True),
+               params.resourcepool._moId, params.datastore._moId)
+        spec = descriptors.get(key, self.vc.si.content.ovfManager.CreateImportSpec, ovf,
+                               params.resourcepool, params.datastore, params.cisp)
+        # Copy what is renamed, the rest of the cached template is shared.
+        spec = _copy(spec)
+        if isinstance(spec.importSpec, vim.VirtualMachineImportSpec):
+            spec.importSpec = _copy(spec.importSpec)
+            spec.importSpec.configSpec = _copy(spec.importSpec.configSpec)
+            spec.importSpec.configSpec.name = name
+        elif isinstance(spec.importSpec, vim.VirtualAppImportSpec):
+            spec.importSpec = _copy(spec.importSpec)
+            spec.importSpec.name = name
+        return spec
+
+    def importovf(self, ovffile, reuse=False, **kwargs):
+        with self._reserved(kwargs) as kwargs:
+            if reuse:
+                return self.clone(ovffile, **kwargs)
+            return self._retry(self._importovf, ovffile, **kwargs)
+
+    def importova(self, source, **kwargs):
+        with self._reserved(kwargs) as kwargs:
+            return self._retry(self._importova, source, **kwargs)
 
-    def importovf(self, ovffile, **kwargs):
+    @contextlib.contextmanager
+    def _reserved(self, kwargs):
+        '''
+        Place the VM of kwargs with resources (see _set_params) once for the whole
+        deployment, retries included, and yield kwargs with that reservation. The
+        reservation is released if the deployment fails; otherwise it is held until
+        the capacity snapshots account for the new VM (see placement.HOLD).
+        '''
+        if kwargs.get('resources') is None or kwargs.get('reservation') is not None:
+            yield kwargs
+            return
+        reservation = self._set_params(**kwargs).reservation
+        try:
+            yield dict(kwargs, reservation=reservation)
+        except BaseException:
+            if reservation is not None:
+                reservation.release()
+            raise
+
+    def _retry(self, func, source, **kwargs):
+        '''
+        Run the import func, starting over when it fails. Failed uploads are retried
+        within the lease (see _push); once a file is out of retries while the lease
+        is still usable, starting over would not do better.
+        '''
         last_exception = None
         for _ in dalibs.retry.retry(attempts=3, raises=False):
             try:
-                return self._importovf(ovffile, **kwargs)
-            except vim.fault.DuplicateName:
+                return func(source, **kwargs)
+            except (vim.fault.DuplicateName, TransferFailed):
                 raise
             except Exception as e:
                 last_exception = e
@@ -96,14 +447,177 @@ class OVF(object):
     def _importovf(self, ovffile, **kwargs):
         ''' Import an OVF VM. See _set_params for support kwargs. '''
         self.logger.info('Importing OVFFile %s' % ovffile)
+        with open(ovffile, 'r') as f:
+            ovf = f.read()
+        params, spec, lease = self._start(ovf, **kwargs)
+
+        # Push all files using HTTP.
+        total, files = self._files(spec, lease, os.path.dirname(ovffile), params.priority)
+        with self._transfer(lease, total) as callback:
+            if params.parallel > 1 and len(files) > 1:
+                self._upload_multi(files, callback, lease, params.parallel, params.chunksize,
+                                   params.retries)
+            else:
+                for fi in files:
+                    self.logger.debug('Uploading %s to %s' % (fi.path, fi.url))
+                    self._push(fi, callback, lease, params.chunksize, params.retries)
+                    if lease.state == vim.HttpNfcLeaseState.error:
+                        raise lease.error
+        self._wait_vm(params.cisp.entityName)
+
+    def _importova(self, source, **kwargs):
+        '''
+        Import an OVA VM from a local path or an http(s) URL. The tarball is streamed:
+        the descriptor is read from the first member and every other member is sent to
+        its lease deviceUrl as it is read, without temporary files. See _set_params for
+        support kwargs.
+        '''
+        self.logger.info('Importing OVA %s' % source)
+        fp = self._open(source)
+        try:
+            tar = tarfile.open(fileobj=fp, mode='r|')
+            member = tar.next()
+            if member is None or not member.name.endswith('.ovf'):
+                raise OVFException('The OVF descriptor must be the first member of %s' % source)
+            params, spec, lease = self._start(tar.extractfile(member).read(), **kwargs)
+
+            total, files = self._files(spec, lease, priority=params.priority)
+            files = dict((fi.path, fi) for fi in files)
+            with self._transfer(lease, total) as callback:
+                member = tar.next()
+                while member is not None:
+                    fi = files.pop(member.name, None) or files.pop(os.path.basename(member.name), None)
+                    if fi is None:
+                        self.logger.debug('Skipping %s' % member.name)  # e.g. manifest, certificate
+                    else:
+                        self.logger.debug('Uploading %s to %s' % (member.name, fi.url))
+                        fi.size = member.size
+                        self._send(fi, tar.extractfile(member), callback)
+                        if lease.state == vim.HttpNfcLeaseState.error:
+                            raise lease.error
+                    member = tar.next()
+                if files:
+                    raise OVFException('%s is missing %s' % (source, ', '.join(sorted(files))))
+        finally:
+            fp.close()
+        self._wait_vm(params.cisp.entityName)
+
+    def digest(self, ovffile):
+        '''
+        Content hash of the OVF descriptor and the files it references. Cached per
+        process as long as the files keep their size and mtime.
+        '''
+        with open(ovffile, 'rb') as f:
+            ovf = f.read()
+        basedir = os.path.dirname(ovffile)
+        paths = [ovffile] + [os.path.join(basedir, href)
+                             for href in re.findall(r'ovf:href="([^"]+)"', ovf)]
+        key = tuple((os.path.abspath(p), os.path.getsize(p), os.path.getmtime(p)) for p in paths)
+        if key not in _digests:
+            sha = hashlib.sha1()
+            for path in paths:
+                with open(path, 'rb') as f:
+                    for block in iter(lambda: f.read(UPLOAD_BUFFERSIZE), ''):
+                        sha.update(block)
+            _digests[key] = sha.hexdigest()
+        return _digests[key]
+
+    def template(self, ovffile, **kwargs):
+        '''
+        Get the template VM of ovffile on the datastore selected by kwargs (see
+        _set_params), importing it first if there is none. The template has a snapshot
+        to create linked clones from, and is tagged with the OVF digest in its note.
+        '''
+        with self._reserved(kwargs) as kwargs:
+            params = self._set_params(**kwargs)
+            digest = self.digest(ovffile)
+            name = TEMPLATE_NAME % (digest[:20], params.datastore._moId)
+            vm = self.vc.vm(name)
+            if vm is None:
+                kwargs = dict(kwargs, name=name)
+                if kwargs.get('cisp') is not None:
+                    kwargs['cisp'] = _copy(kwargs['cisp'])
+                    kwargs['cisp'].entityName = name
+                try:
+                    self._retry(self._importovf, ovffile, **kwargs)
+                except vim.fault.DuplicateName:
+                    vm = self.vc.vm(name)  # imported concurrently
+                else:
+                    vm = self.vc.vm(name)
+                    vm.CreateSnapshot_Task(name='template', description=ovffile, memory=False,
+                                           quiesce=False).wait()
+                    vm.SetNote({'ovf': os.path.basename(ovffile), 'digest': digest})
+                    vm.MarkAsTemplate()
+            wait.wait_for(vm, 'config.template', bool, timeout=3600,
+                          message='Template %s did not become ready' % name)
+            if vm.GetNote().get('digest') != digest:
+                raise OVFException('%s is not a template of %s' % (name, ovffile))
+            return vm
+
+    def clone(self, ovffile, **kwargs):
+        '''
+        Deploy ovffile as a linked clone of its template (see template()), instead of
+        uploading its disks. The name, network and placement kwargs are applied as for
+        an import (see _set_params); all the nics are connected to the (first mapped)
+        network. Disk provisioning does not apply to linked clones.
+        '''
+        with self._reserved(kwargs) as kwargs:
+            template = self.template(ovffile, **kwargs)
+            params = self._set_params(**kwargs)
+            vmname = params.cisp.entityName if params.cisp is not None else None
+            vmname = vmname or params.name or self.parse(ovffile)[1].defaultEntityName
+            network = params.network
+            if params.cisp is not None and params.cisp.networkMapping:
+                network = params.cisp.networkMapping[0].network
+            self.logger.info('Cloning %s from template %s' % (vmname, template.name))
 
-        # Validate ovffile.
-        ovf, result = self.parse(ovffile)
+            config = vim.VirtualMachineConfigSpec(annotation='')
+            for device in template.devices().bytype(vim.VirtualEthernetCard):
+                nic = device.__class__()
+                for field in ('key', 'controllerKey', 'unitNumber', 'macAddress', 'addressType',
+                              'connectable'):
+                    setattr(nic, field, getattr(device, field))
+                if isinstance(network, vim.dvs.DistributedVirtualPortgroup):
+                    nic.backing = vim.VirtualEthernetCard.DistributedVirtualPortBackingInfo()
+                    nic.backing.port = vim.dvs.PortConnection(
+                        portgroupKey=network.key,
+                        switchUuid=network.config.distributedVirtualSwitch.uuid)
+                else:
+                    nic.backing = vim.VirtualEthernetCard.NetworkBackingInfo()
+                    nic.backing.deviceName = network.name
+                    nic.backing.network = network
+                config.deviceChange.append(vim.VirtualDeviceConfigSpec(
+                    operation=vim.VirtualDeviceConfigSpecOperation.edit, device=nic))
+            spec = vim.VirtualMachineCloneSpec()
+            spec.location = vim.VirtualMachineRelocateSpec(
+                pool=params.resourcepool, datastore=params.datastore, host=params.host,
+                diskMoveType='createNewChildDiskBacking')
+            spec.snapshot = template.snapshot.currentSnapshot
+            spec.config = config
+            spec.powerOn = False
+            spec.template = False
+            template.CloneVM_Task(folder=params.folder, name=vmname, spec=spec).wait(timeout=600)
+            self._wait_vm(vmname)
+
+    def _open(self, source):
+        ''' Open a local path or an http(s) URL for streamed reading. '''
+        if source.startswith('http://') or source.startswith('https://'):
+            response = requests.get(source, stream=True, verify=False)
+            response.raise_for_status()
+            response.raw.decode_content = True
+            return response.raw
+        return open(source, 'rb')
+
+    def _start(self, ovf, **kwargs):
+        '''
+        Validate the descriptor ovf, create the import spec and start the import.
+        Returns (params, import spec result, lease) once the lease is ready.
+        '''
+        ovf, result = self._parse(ovf)
         for w in result.warning:
             self.logger.warning(w.msg)
         if result.error:
             raise result.error[0]
-        basedir = os.path.dirname(ovffile)
 
         # Load kwargs and create import spec params.
         params = self._set_params(**kwargs)
@@ -111,8 +625,7 @@ class OVF(object):
             params.cisp = vim.OvfCreateImportSpecParams()
         if not params.cisp.entityName:
             params.cisp.entityName = params.name or result.defaultEntityName
-        vmname = params.cisp.entityName
-        self.logger.info('VM name is %s' % vmname)
+        self.logger.info('VM name is %s' % params.cisp.entityName)
         if not params.cisp.networkMapping:
             params.cisp.networkMapping = [
                 vim.OvfNetworkMapping(name='VM Network', network=params.network)
@@ -123,8 +636,7 @@ class OVF(object):
         self.logger.info('Provisioning is %s' % params.cisp.diskProvisioning)
 
         # Create import spec.
-        spec = self.vc.si.content.ovfManager.CreateImportSpec(ovf, params.resourcepool,
-            params.datastore, params.cisp)
+        spec = self._importspec(ovf, params)
         for w in spec.warning:
             self.logger.warning(w.msg)
         if spec.error:
@@ -134,6 +646,11 @@ class OVF(object):
         self.logger.debug('Running ImportVApp')
         lease = params.resourcepool.ImportVApp(spec=spec.importSpec, folder=params.folder,
             host=params.host)
+        self._ready(lease)
+        return params, spec, lease
+
+    def _ready(self, lease):
+        ''' Wait for lease to become ready. '''
         for _ in range(180):
             if lease.state == vim.HttpNfcLeaseState.ready:
                 break
@@ -142,28 +659,137 @@ class OVF(object):
             time.sleep(1)
         else:
             lease.HttpNfcLeaseAbort()
-            raise OVFException('OVF import timed out waiting to become ready: %s' % lease.state)
+            raise OVFException('OVF transfer timed out waiting to become ready: %s' % lease.state)
 
-        # Push all files using HTTP.
-        total, files = self._files(spec, lease, basedir)
+    def exportovf(self, vm, dest, parallel=1, name=None):
+        '''
+        Export vm as an OVF. The disks are downloaded over up to parallel concurrent
+        connections, then the descriptor (name.ovf, name defaults to the VM name) is
+        created by the server. dest is a directory, or a callable returning a
+        writable file object for each file name (e.g., to stream to another store).
+        Returns the list of file names written.
+        '''
+        name = name or vm.name
+        self.logger.info('Exporting %s' % name)
+        if not callable(dest):
+            directory = dest
+            dest = lambda filename: open(os.path.join(directory, filename), 'wb')
+
+        lease = vm.ExportVm()
+        self._ready(lease)
+        files = []
+        for d in lease.info.deviceUrl:
+            f = Container()
+            f.key = d.key
+            # When self.vc is an ESX host, the hostname is '*'.
+            f.url = d.url.replace('https://*', 'https://%s' % self.vc.host)
+            f.path = d.targetId or os.path.basename(d.url)
+            f.size = d.fileSize or 0
+            files.append(f)
+        total = sum(f.size for f in files) or lease.info.totalDiskCapacityInKB * 1024
+
+        with self._transfer(lease, total) as callback:
+            self._download_multi(files, callback, lease, dest, max(parallel, 1))
+            params = vim.OvfCreateDescriptorParams(name=name)
+            params.ovfFiles = [vim.OvfFile(deviceId=f.key, path=f.path, size=f.size)
+                               for f in files]
+            result = self.vc.si.content.ovfManager.CreateDescriptor(vm, params)
+            for w in result.warning:
+                self.logger.warning(w.msg)
+            if result.error:
+                raise result.error[0]
+        descriptor = '%s.ovf' % name
+        fp = dest(descriptor)
+        try:
+            fp.write(result.ovfDescriptor.encode('utf-8'))
+        finally:
+            fp.close()
+        return [f.path for f in files] + [descriptor]
+
+    def _download_multi(self, files, callback, lease, dest, parallel):
+        '''
+        Download files to the file objects returned by dest(path) over up to parallel
+        concurrent connections driven by one CurlMulti. f.size is set to the size
+        downloaded. Raises as soon as any transfer fails.
+        '''
+        pending = list(reversed(files))
+        active = {}  # curl handle => (f, fp, stream)
+        m = pycurl.CurlMulti()
+        try:
+            while pending or active:
+                while pending and len(active) < parallel:
+                    f = pending.pop()
+                    self.logger.debug('Downloading %s from %s' % (f.path, f.url))
+                    fp = dest(f.path)
+                    stream = Stream(callback, download=True)
+                    c = pycurl.Curl()
+                    c.setopt(pycurl.VERBOSE, curl_debug)
+                    c.setopt(pycurl.SSL_VERIFYPEER, 0)
+                    c.setopt(pycurl.SSL_VERIFYHOST, 0)
+                    c.setopt(pycurl.URL, f.url)
+                    c.setopt(pycurl.WRITEDATA, fp)
+                    if hasattr(pycurl, 'BUFFERSIZE'):
+                        c.setopt(pycurl.BUFFERSIZE, 512 * 1024)  # libcurl's maximum
+                    c.setopt(pycurl.NOPROGRESS, 0)
+                    if hasattr(pycurl, 'XFERINFOFUNCTION'):  # libcurl >= 7.32
+                        c.setopt(pycurl.XFERINFOFUNCTION, stream.xferinfo)
+                    else:
+                        c.setopt(pycurl.PROGRESSFUNCTION, stream.xferinfo)
+                    c.setopt(pycurl.NOSIGNAL, 1)
+                    active[c] = (f, fp, stream)
+                    m.add_handle(c)
+
+                while m.perform()[0] == pycurl.E_CALL_MULTI_PERFORM:
+                    pass
+
+                finished = 0
+                while True:
+                    queued, done, failed = m.info_read()
+                    for c, errno, errmsg in failed:
+                        raise OVFException('Download of %s failed: %s (%d)' %
+                                           (active[c][0].path, errmsg, errno))
+                    for c in done:
+                        f, fp, stream = active.pop(c)
+                        status = c.getinfo(pycurl.RESPONSE_CODE)
+                        f.size = int(c.getinfo(pycurl.SIZE_DOWNLOAD))
+                        m.remove_handle(c)
+                        c.close()
+                        fp.close()
+                        if status >= 400:
+                            raise OVFException('Download of %s failed: HTTP %d' % (f.path, status))
+                        self.logger.debug('Downloaded %s' % f.path)
+                        finished += 1
+                    if not queued:
+                        break
+                if finished and lease.state == vim.HttpNfcLeaseState.error:
+                    raise lease.error
+                if active and not finished:
+                    m.select(1.0)
+        finally:
+            for c, (f, fp, stream) in active.items():
+                m.remove_handle(c)
+                c.close()
+                fp.close()
+            m.close()
+
+    @contextlib.contextmanager
+    def _transfer(self, lease, total):
+        '''
+        Report the progress of the uploads made in the block to the lease. The lease is
+        aborted if the block raises and completed otherwise.
+        '''
         self.logger.info('Starting transfer')
         callback = LeaseProgress(lease, total, self.logger, None)
-
-        for fi in files:
-            self.logger.debug('Uploading %s to %s' % (fi.path, fi.url))
-            try:
-                if fi.create:
-                    self._put(fi, callback)
-                else:
-                    self._post(fi, callback)
-            except:
-                lease.HttpNfcLeaseAbort()
-                raise
-            if lease.state == vim.HttpNfcLeaseState.error:
-                lease.HttpNfcLeaseAbort()
-                raise lease.error
+        try:
+            with callback:
+                yield callback
+        except:
+            lease.HttpNfcLeaseAbort()
+            raise
         lease.HttpNfcLeaseComplete()
         self.logger.info('Transfer complete')
+
+    def _wait_vm(self, vmname):
         for _ in dalibs.retry.retry(timeout=120, raises=False):
             vm = self.vc.vm(vmname)
             if vm is not None:
@@ -171,8 +797,12 @@ class OVF(object):
                 return
         raise OVFException('Unable to find the VM %s' % vmname)
 
-    def _files(self, spec, lease, basedir):
-        ''' Generate a list of files to send and update ReadFunction params. '''
+    def _files(self, spec, lease, basedir=None, priority='normal'):
+        '''
+        Generate a list of files to send and their total size. Without basedir, the
+        files are not local (e.g. OVA members) and sizes come from the descriptor.
+        priority is the bandwidth priority class of the uploads (see bandwidth.py).
+        '''
         total = 0
         files = []
         for fi in spec.fileItem:
@@ -183,111 +813,294 @@ class OVF(object):
                     # When self.vc is an ESX host, the hostname is '*'.
                     f.url = d.url.replace('https://*', 'https://%s' % self.vc.host)
                     f.create = fi.create
-                    f.path = os.path.join(basedir, fi.path)
+                    f.offset = 0  # bytes committed, see _commit()
+                    f.attempts = 0
+                    f.priority = priority
+                    if basedir is None:
+                        f.path = fi.path
+                        f.size = fi.size or 0
+                    else:
+                        f.path = os.path.join(basedir, fi.path)
+                        f.size = os.path.getsize(f.path)
                     files.append(f)
-                    total += os.path.getsize(f.path)
+                    total += f.size
                     break
             else:
                 lease.HttpNfcLeaseAbort()
                 raise OVFException('Could not import %s' % fi.path)
         return total, files
 
+    def _curl(self, fi, fp, stream, start=0, end=None, multi=False):
+        '''
+        Get a curl handle that pushes fi, using PUT for files to be created and POST
+        (streamVmdk) otherwise. The content is read from the file object fp by curl
+        itself, in UPLOAD_BUFFERSIZE blocks; progress is reported to stream (a Stream)
+        through curl's progress callback rather than for every block read.
+
+        With start and end, only bytes [start, end) of the file are PUT, with a
+        Content-Range header; fp must be positioned at start.
+
+        When the upload is scheduled (stream.transfer), the content is read through a
+        Throttle; multi tells whether the handle is driven by a CurlMulti.
+        '''
+        if end is None:
+            end = fi.size
+        c = pycurl.Curl()
+        c.setopt(pycurl.VERBOSE, curl_debug)
+        c.setopt(pycurl.SSL_VERIFYPEER, 0)
+        c.setopt(pycurl.SSL_VERIFYHOST, 0)
+        c.setopt(pycurl.URL, fi.url)
+        if fi.create:
+            hdr = ['Content-Type: application/octet-stream', 'Overwrite: t',
+                   'Connection: Keep-Alive']
+            c.setopt(pycurl.PUT, 1)
+            c.setopt(pycurl.INFILESIZE_LARGE, end - start)
+        else:
+            assert (start, end) == (0, fi.size), 'streamVmdk uploads can not be resumed'
+            hdr = ['Content-Type: application/x-vnd.vmware-streamVmdk', 'Connection: Keep-Alive']
+            c.setopt(pycurl.POST, 1)
+            c.setopt(pycurl.POSTFIELDSIZE_LARGE, fi.size)
+        read = None
+        if (start, end) != (0, fi.size):
+            hdr.append('Content-Range: bytes %d-%d/%d' % (start, end - 1, fi.size))
+            read = Range(fp, end - start).read
+        if stream.transfer is not None:
+            stream.throttle = Throttle(read or fp.read, stream.transfer, multi)
+            read = stream.throttle.read
+        if read is not None:
+            c.setopt(pycurl.READFUNCTION, read)
+        else:
+            c.setopt(pycurl.READDATA, fp)
+        c.setopt(pycurl.HTTPHEADER, hdr)
+        # pycurl >= 7.43.0.2 built against libcurl >= 7.62; the default is used otherwise.
+        if hasattr(pycurl, 'UPLOAD_BUFFERSIZE'):
+            try:
+                c.setopt(pycurl.UPLOAD_BUFFERSIZE, UPLOAD_BUFFERSIZE)
+            except pycurl.error:
+                pass  # built against a newer libcurl than the one loaded
+        c.setopt(pycurl.NOPROGRESS, 0)
+        if hasattr(pycurl, 'XFERINFOFUNCTION'):  # libcurl >= 7.32
+            c.setopt(pycurl.XFERINFOFUNCTION, stream.xferinfo)
+        else:
+            c.setopt(pycurl.PROGRESSFUNCTION, stream.xferinfo)
+        # Potential workaround for Bugs 8696 and 10697.
+        c.setopt(pycurl.NOSIGNAL, 1)
+        return c
+
+    def _request(self, fi, fp, callback, chunksize=None, multi=False):
+        '''
+        Get (curl handle, Stream, end) for the next request of local file fi, which
+        continues at fi.offset (the bytes committed so far). With chunksize, files that
+        are PUT are sent in Content-Range requests of chunksize bytes, so a failure
+        only loses the chunk in flight.
+        '''
+        end = fi.size
+        if chunksize and fi.create:
+            end = min(fi.offset + chunksize, fi.size)
+        fp.seek(fi.offset)
+        stream = Stream(callback, bandwidth.register(fi.url, fi.priority))
+        return self._curl(fi, fp, stream, fi.offset, end, multi), stream, end
+
+    def _commit(self, fi, c, stream, end):
+        '''
+        Check the answer to a finished request of fi and commit its bytes. Returns
+        True once all of fi is committed.
+        '''
+        status = c.getinfo(pycurl.RESPONSE_CODE)
+        if status >= 400:
+            stream.rewind()
+            raise OVFException('Upload of %s failed: HTTP %d' % (fi.path, status))
+        fi.offset = end
+        return fi.offset >= fi.size
+
+    def _retrying(self, fi, lease, error, retries):
+        '''
+        Account a failed request of fi. Raises LeaseLost when the lease is no longer
+        usable, and TransferFailed when fi is out of retries. Otherwise, returns the
+        seconds after which the caller retries from fi.offset.
+        '''
+        fi.attempts += 1
+        state = lease.state
+        if state != vim.HttpNfcLeaseState.ready:
+            raise LeaseLost('Lease is %s after upload of %s failed: %s' % (state, fi.path, error))
+        if fi.attempts > retries:
+            raise TransferFailed('Upload of %s failed %d times: %s' % (fi.path, fi.attempts, error))
+        self.logger.warning('Upload of %s failed, resuming at %d of %d: %s' %
+                            (fi.path, fi.offset, fi.size, error))
+        return min(2 ** fi.attempts, 30)
+
     def _post(self, fi, callback):
         ''' Push a file using POST '''
-        hdr = ['Content-Type: application/x-vnd.vmware-streamVmdk', 'Connection: Keep-Alive']
+        assert not fi.create
         with open(fi.path, 'rb') as f:
-            callback.fp = f
-            c = pycurl.Curl()
-            c.setopt(pycurl.VERBOSE, curl_debug)
-            c.setopt(pycurl.SSL_VERIFYPEER, 0)
-            c.setopt(pycurl.SSL_VERIFYHOST, 0)
-            c.setopt(pycurl.HTTPHEADER, hdr)
-            c.setopt(pycurl.URL, fi.url)
-            c.setopt(pycurl.POST, 1)
-            c.setopt(pycurl.READFUNCTION, callback.read)
-            c.setopt(pycurl.POSTFIELDSIZE_LARGE, os.path.getsize(fi.path))
-            # Potential workaround for Bugs 8696 and 10697.
-            c.setopt(pycurl.NOSIGNAL, 1)
-            c.perform()
-            c.close()
+            self._send(fi, f, callback)
 
     def _put(self, fi, callback):
         ''' Push a file using PUT '''
-        hdr = ['Content-Type: application/octet-stream', 'Overwrite: t', 'Connection: Keep-Alive']
+        assert fi.create
         with open(fi.path, 'rb') as f:
-            callback.fp = f
-            c = pycurl.Curl()
-            c.setopt(pycurl.VERBOSE, curl_debug)
-            c.setopt(pycurl.SSL_VERIFYPEER, 0)
-            c.setopt(pycurl.SSL_VERIFYHOST, 0)
-            c.setopt(pycurl.HTTPHEADER, hdr)
-            c.setopt(pycurl.URL, fi.url)
-            c.setopt(pycurl.PUT, 1)
-            c.setopt(pycurl.READFUNCTION, callback.read)
-            # Potential workaround for Bugs 8696 and 10697.
-            c.setopt(pycurl.NOSIGNAL, 1)
+            self._send(fi, f, callback)
+
+    def _send(self, fi, fp, callback):
+        ''' Push fi, reading its content from the file object fp. '''
+        stream = Stream(callback, bandwidth.register(fi.url, fi.priority))
+        c = self._curl(fi, fp, stream)
+        try:
             c.perform()
+            self._commit(fi, c, stream, fi.size)
+        except pycurl.error:
+            stream.rewind()
+            raise
+        finally:
             c.close()
+            stream.close()
+
+    def _push(self, fi, callback, lease, chunksize=None, retries=3):
+        '''
+        Push local file fi. Failed requests are retried within the lease, resuming at
+        the last committed chunk (see _request) or at the start of the file.
+        '''
+        with open(fi.path, 'rb') as fp:
+            while True:
+                c, stream, end = self._request(fi, fp, callback, chunksize)
+                try:
+                    c.perform()
+                    if self._commit(fi, c, stream, end):
+                        return
+                except (pycurl.error, OVFException) as e:
+                    if isinstance(e, pycurl.error):
+                        stream.rewind()
+                    time.sleep(self._retrying(fi, lease, e, retries))
+                finally:
+                    c.close()
+                    stream.close()
+
+    def _upload_multi(self, files, callback, lease, parallel, chunksize=None, retries=3):
+        '''
+        Push files over up to parallel concurrent connections driven by one CurlMulti.
+        Progress of all the files is reported through callback. Failed requests are
+        retried as in _push; once that is not possible, the error is raised and the
+        caller is expected to abort the lease. The other transfers go on while a failed
+        file waits for its retry.
+        '''
+        pending = list(reversed(files))
+        active = {}  # curl handle => (fi, fp, stream, end)
+        waiting = []  # (time, fi) of the files to retry after a failure
+        m = pycurl.CurlMulti()
+        try:
+            while pending or active or waiting:
+                now = time.time()
+                for retry in [w for w in waiting if w[0] <= now]:
+                    waiting.remove(retry)
+                    pending.append(retry[1])
+                while pending and len(active) < parallel:
+                    fi = pending.pop()
+                    if fi.offset == 0:
+                        self.logger.debug('Uploading %s to %s' % (fi.path, fi.url))
+                    fp = open(fi.path, 'rb')
+                    c, stream, end = self._request(fi, fp, callback, chunksize, multi=True)
+                    active[c] = (fi, fp, stream, end)
+                    m.add_handle(c)
+
+                while m.perform()[0] == pycurl.E_CALL_MULTI_PERFORM:
+                    pass
+
+                finished = 0
+                while True:
+                    queued, done, failed = m.info_read()
+                    for c, error in [(c, None) for c in done] + \
+                            [(c, '%s (%d)' % (errmsg, errno)) for c, errno, errmsg in failed]:
+                        fi, fp, stream, end = active.pop(c)
+                        m.remove_handle(c)
+                        fp.close()
+                        stream.close()
+                        finished += 1
+                        try:
+                            if error is not None:
+                                stream.rewind()
+                                raise OVFException('Upload of %s failed: %s' % (fi.path, error))
+                            if self._commit(fi, c, stream, end):
+                                self.logger.debug('Uploaded %s' % fi.path)
+                                continue
+                        except OVFException as e:
+                            retry = time.time() + self._retrying(fi, lease, e, retries)
+                            waiting.append((retry, fi))
+                            continue
+                        finally:
+                            c.close()
+                        pending.append(fi)  # the next chunk
+                    if not queued:
+                        break
+                if finished and lease.state == vim.HttpNfcLeaseState.error:
+                    raise lease.error
+
+                # Resume the transfers the bandwidth scheduler paused, once they may send.
+                timeout = 1.0
+                for c, (fi, fp, stream, end) in active.items():
+                    if stream.throttle is not None and stream.throttle.paused:
+                        if stream.transfer.ready():
+                            stream.throttle.paused = False
+                            c.pause(pycurl.PAUSE_CONT)
+                            finished += 1
+                        else:
+                            timeout = min(timeout, stream.transfer.delay())
+                if waiting:
+                    timeout = max(min([timeout] + [w[0] - time.time() for w in waiting]), 0)
+                if active and not finished:
+                    m.select(timeout)
+                elif not active and not pending and waiting:
+                    time.sleep(timeout)
+        finally:
+            for c, (fi, fp, stream, end) in active.items():
+                m.remove_handle(c)
+                c.close()
+                fp.close()
+                stream.close()
+            m.close()
 
     def _set_params(self, **kwargs):
         ''' Load kwargs into a params structure. '''
         known = ['name', 'datacenter', 'cluster', 'resourcepool', 'datastore', 'cisp',
-            'provisioning', 'folder', 'host', 'network']
+            'provisioning', 'folder', 'host', 'network', 'parallel', 'chunksize', 'retries',
+            'priority', 'reservation']
         params = Container(known)
         params.name = kwargs.get('name', None)
-        # Default to 1st datacenter (this will exist even for single ESX)
-        dc = kwargs.get('datacenter', None)
-        if dc is None:
-            dc = self.vc.find(vim.Datacenter)[0]
-        params.datacenter = dc
-        # Default to 1st cluster if it exists.
-        cl = kwargs.get('cluster', None)
-        if cl is None:
-            clusters = dc.find(vim.ClusterComputeResource)
-            if clusters:
-                cl = clusters[0]
-        params.cluster = cl
-        # Default to top level resource pool of datacenter or cluster.
-        rp = kwargs.get('resourcepool', None)
-        if rp is None:
-            if cl:
-                rp = cl.resourcePool
-            else:
-                rp = dc.hostFolder.childEntity[0].resourcePool
-        params.resourcepool = rp
-        # Default to 1st datastore in cluster or datacenter.
-        ds = kwargs.get('datastore', None)
-        if ds is None:
-            if cl:
-                ds = cl.datastore[0]
-            else:
-                ds = dc.datastore[0]
-        params.datastore = ds
+        placement = kwargs.get('placement', None)
+        if placement is None:
+            placement = PlacementContext(self.vc, **dict((k, kwargs[k]) for k in PLACEMENT
+                                                         if k in kwargs))
+        else:
+            mixed = [k for k in PLACEMENT if kwargs.get(k) is not None]
+            if mixed:
+                raise ValueError('%s can not be combined with placement' % ', '.join(mixed))
+            placement.validate()
+        for k in PLACEMENT:
+            setattr(params, k, getattr(placement, k))
+        # With resources (see placement.Placer.place), pick the host (and datastore,
+        # unless one was given) by capacity instead of the defaults.
+        params.reservation = kwargs.get('reservation', None)
+        resources = kwargs.get('resources', None)
+        if params.reservation is not None:
+            # Held once per deployment, see _reserved.
+            params.host = params.reservation.host
+            params.datastore = params.reservation.datastore
+        elif resources is not None and 'host' not in placement.explicit:
+            datastore = params.datastore if 'datastore' in placement.explicit else None
+            params.reservation = params.resourcepool.owner.PlaceVM(
+                dict(resources, network=params.network), datastore=datastore)
+            params.host = params.reservation.host
+            params.datastore = params.reservation.datastore
         params.cisp = kwargs.get('cisp', None)
         params.provisioning = kwargs.get('provisioning', 'thin')
-        folder = kwargs.get('folder', None)
-        # Default to "vm" folder.
-        if folder is None:
-            folder = dc.vmFolder
-        params.folder = folder
-        # Default to None for host.
-        host = kwargs.get('host', None)
-        params.host = host
-
-        # Default to 'VM Network'
-        network = kwargs.get('network', 'VM Network')
-        networks = []  # find networks, working from deepest node to the root
-        for node in [host, cl, dc]:
-            if node is not None:
-                networks = node.network
-                break
-        for x in networks:  # choose the first matching network associated with this cluster
-            if x.name == network:
-                network = x
-                break
-        assert isinstance(network, vim.Network), 'No suitable network (%s) found!' % network
-        params.network = network
-
+        # Number of files to upload concurrently, 1 uploads them one after another.
+        params.parallel = kwargs.get('parallel', 1)
+        # Send files that are PUT in Content-Range requests of chunksize bytes, so that a
+        # failed upload resumes at the last chunk. Only for hosts that support it.
+        params.chunksize = kwargs.get('chunksize', None)
+        # Number of times a failed upload is retried within the lease.
+        params.retries = kwargs.get('retries', 3)
+        # Bandwidth priority class of the uploads, see bandwidth.configure().
+        params.priority = kwargs.get('priority', 'normal')
         for k, v in params.__dict__.items():
             if hasattr(v, 'name'):
                 self.logger.debug('%s name: %s' % (k, v.name))
@@ -0,0 +1,133 @@
+#
+#
+# Copyright (c) 2013-2018 Datrium Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Indexed snapshot of a VirtualMachine's config.hardware.device.
+
+Reading config.hardware.device goes over the wire every time. Helpers that look at
+the devices repeatedly (e.g., searching for a free controller slot) work on a
+Devices snapshot instead, which is fetched once and indexed by key, type,
+controller and (controller, unit) slot.
+'''
+
+import collections
+from pyVmomi import vim
+
+
+class Devices(object):
+    ''' Snapshot of virtual devices, see vim.VirtualMachine.devices() '''
+
+    def __init__(self, devices, changeVersion=None):
+        self.changeVersion = changeVersion
+        self.devices = []
+        self.bykey = {}
+        self.bycontroller = collections.defaultdict(list)  # controllerKey => [device]
+        self.slots = {}  # (controllerKey, unitNumber) => device
+        self._bytype = {}
+        self._key = 0  # lowest key seen or handed out, see newkey()
+        for device in devices:
+            self.add(device)
+
+    def __iter__(self):
+        return iter(self.devices)
+
+    def __len__(self):
+        return len(self.devices)
+
+    def copy(self):
+        result = Devices(self.devices, self.changeVersion)
+        result._key = min(result._key, self._key)
+        return result
+
+    def add(self, device):
+        '''
+        Add a device to the snapshot. This is also used to account for devices that
+        are about to be added (e.g., by a pending reconfigure).
+        '''
+        self.devices.append(device)
+        self.bykey[device.key] = device
+        self._key = min(self._key, device.key)
+        if device.controllerKey is not None:
+            self.bycontroller[device.controllerKey].append(device)
+            if device.unitNumber is not None:
+                self.slots[(device.controllerKey, device.unitNumber)] = device
+        self._bytype.clear()
+
+    def newkey(self):
+        '''
+        A temporary (negative) key for a new device that no device in the snapshot,
+        and no key handed out before, has.
+        '''
+        self._key -= 1
+        return self._key
+
+    def remove(self, key):
+        device = self.bykey.pop(key)
+        self.devices.remove(device)
+        if device.controllerKey is not None:
+            self.bycontroller[device.controllerKey].remove(device)
+            self.slots.pop((device.controllerKey, device.unitNumber), None)
+        self._bytype.clear()
+
+    def bytype(self, deviceType=vim.VirtualDevice):
+        '''
+        All devices of the specified type (including subtypes), in device order.
+        '''
+        if deviceType not in self._bytype:
+            self._bytype[deviceType] = [d for d in self.devices if isinstance(d, deviceType)]
+        return self._bytype[deviceType]
+
+    def oncontroller(self, controller, deviceType=vim.VirtualDevice):
+        '''
+        Devices of the specified type attached to controller (a device or its key).
+        '''
+        key = getattr(controller, 'key', controller)
+        return [d for d in self.bycontroller.get(key, []) if isinstance(d, deviceType)]
+
+    def disks(self):
+        '''
+        All disks attached to controllers, in controller order.
+        '''
+        return [d for c in self.bytype(vim.VirtualController)
+                for d in self.oncontroller(c, vim.VirtualDisk)]
+
+    def controller(self, controllerType, busNumber):
+        '''
+        The controller of the specified type on busNumber, or None.
+        '''
+        for c in self.bytype(controllerType):
+            if c.busNumber == busNumber:
+                return c
+        return None
+
+    def slot(self, controller, unitNumber):
+        '''
+        The device in the (controller, unitNumber) slot, or None.
+        '''
+        return self.slots.get((getattr(controller, 'key', controller), unitNumber))
+
+    def free(self, controller, n_unit_numbers, invalid_unit_numbers=(), start=0):
+        '''
+        The first free unit number on controller at or after start, or None. The
+        controller itself occupies a unit number on its bus (e.g., 7 on SCSI), which
+        is expected to be listed in invalid_unit_numbers.
+        '''
+        key = getattr(controller, 'key', controller)
+        for unit_number in range(start, n_unit_numbers):
+            if unit_number not in invalid_unit_numbers and (key, unit_number) not in self.slots:
+                return unit_number
+        return None
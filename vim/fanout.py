@@ -0,0 +1,204 @@
+#
+#
+# Copyright (c) 2013-2018 Datrium Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Runs the same command on many hosts and VMs at once.
+
+The addresses of all the targets are fetched with one property collector call, and
+the commands run over pooled SSH connections (see sshpool.py) from parallelism
+threads. Results are yielded as they complete:
+
+    >>> for result in vim.fanout(cluster.host, 'esxcli system version get', username='root',
+    ...                          password=..., parallelism=32):
+    ...     print result.target, result.returncode, result.elapsed
+    >>> job = vim.fanout(vms, 'uptime', username='root', password=...)
+    >>> job.wait()
+    >>> job.summary()
+    {'targets': 40, 'succeeded': 39, 'failed': 1, 'returncodes': {0: 39, 255: 1}, ...}
+'''
+
+import Queue
+import collections
+import hostsystem
+import mo
+import sshpool
+import threading
+import time
+from pyVmomi import vim
+
+
+HOST_PATH = hostsystem.NETCONFIG
+VM_PATH = 'guest.ipAddress'
+
+
+def addresses(objs):
+    '''
+    The management IP address of hosts and the guest IP address of VMs in objs, in
+    one property collector call (hosts with a cached address are not queried, see
+    hostsystem.remember). Returns {obj: ipaddr}; None if there is none.
+    '''
+    result, objs = {}, list(objs)
+    for o in list(objs):
+        address = hostsystem.remembered(o) if isinstance(o, vim.HostSystem) else None
+        result[o] = address[0] if address is not None else None
+        if address is not None:
+            objs.remove(o)
+    if not objs:
+        return result
+    propspecs = []
+    if any(isinstance(o, vim.HostSystem) for o in objs):
+        propspecs.append(vim.PropertySpec(type=vim.HostSystem, all=False, pathSet=[HOST_PATH]))
+    if any(isinstance(o, vim.VirtualMachine) for o in objs):
+        propspecs.append(vim.PropertySpec(type=vim.VirtualMachine, all=False, pathSet=[VM_PATH]))
+    pfspec = vim.PropertyFilterSpec()
+    pfspec.objectSet = [vim.ObjectSpec(obj=o, skip=False) for o in objs]
+    pfspec.propSet = propspecs
+    for content in mo.si(objs[0]).content.propertyCollector.RetrieveContents([pfspec]):
+        props = dict((p.name, p.val) for p in content.propSet)
+        if isinstance(content.obj, vim.HostSystem):
+            result[content.obj] = hostsystem.remember(content.obj, props.get(HOST_PATH))[0]
+        else:
+            result[content.obj] = props.get(VM_PATH) or None
+    return result
+
+
+class Result(object):
+    ''' The outcome of the command on target; error is set when it could not run. '''
+
+    def __init__(self, target, ipaddr):
+        self.target = target
+        self.ipaddr = ipaddr
+        self.returncode = None
+        self.stdout = None
+        self.stderr = None
+        self.error = None
+        self.started = None
+        self.elapsed = None
+
+    @property
+    def ok(self):
+        return self.error is None and self.returncode == 0
+
+    def __repr__(self):
+        return '<Result %s (%s): %s>' % (self.target, self.ipaddr,
+                                         self.error if self.error is not None else self.returncode)
+
+
+class Fanout(object):
+    '''
+    The command running on the targets, see fanout(). Iterating yields the Results as
+    they complete; results has them all by target once done.
+    '''
+
+    def __init__(self, objs, cmd, parallelism=16, timeout=None, username=None, password=None):
+        self.cmd = cmd
+        self.timeout = timeout
+        self.username = username
+        self.password = password
+        self.pool = sshpool.pool or sshpool.Pool()
+        self.private = sshpool.pool is None
+        self.results = collections.OrderedDict()
+        self.started = time.time()
+        self.elapsed = None
+        self.pending = Queue.Queue()
+        self.done = Queue.Queue()
+        self.remaining = 0
+        objs = list(objs)
+        ipaddrs = addresses(objs)
+        for target in objs:
+            if target not in self.results:
+                self.results[target] = None
+                self.pending.put(Result(target, ipaddrs[target]))
+                self.remaining += 1
+        self.threads = []
+        self.lock = threading.Lock()
+        self.running = min(parallelism, self.remaining)  # workers, see run()
+        for i in range(self.running):
+            t = threading.Thread(target=self.run, name='fanout-%d' % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def run(self):
+        try:
+            self._run()
+        finally:
+            # The last worker closes a private pool, even if the results are not all
+            # consumed (e.g., the caller stopped iterating).
+            with self.lock:
+                self.running -= 1
+                last = not self.running
+            if last and self.private:
+                self.pool.close()
+
+    def _run(self):
+        while True:
+            try:
+                result = self.pending.get_nowait()
+            except Queue.Empty:
+                return
+            result.started = time.time()
+            if result.ipaddr is None:
+                result.error = 'No IP address'
+            else:
+                try:
+                    result.returncode, result.stdout, result.stderr = self.pool.run(
+                        result.ipaddr, self.cmd, self.username, self.password, self.timeout)
+                except Exception as e:
+                    result.error = e
+            result.elapsed = time.time() - result.started
+            self.done.put(result)
+
+    def __iter__(self):
+        while self.remaining:
+            result = self.done.get()
+            self.remaining -= 1
+            self.results[result.target] = result
+            if not self.remaining:
+                self.elapsed = time.time() - self.started
+            yield result
+
+    def wait(self):
+        ''' Wait for all the targets, returns results. '''
+        for _ in self:
+            pass
+        return self.results
+
+    def summary(self):
+        ''' Aggregate of the results so far. '''
+        done = [r for r in self.results.values() if r is not None]
+        elapsed = [r.elapsed for r in done]
+        return {
+            'targets': len(self.results),
+            'completed': len(done),
+            'succeeded': len([r for r in done if r.ok]),
+            'failed': len([r for r in done if not r.ok]),
+            'errors': len([r for r in done if r.error is not None]),
+            'returncodes': dict(collections.Counter(r.returncode for r in done
+                                                    if r.error is None)),
+            'elapsed': self.elapsed,
+            'slowest': max(elapsed) if elapsed else None,
+            'mean': sum(elapsed) / len(elapsed) if elapsed else None,
+        }
+
+
+def fanout(objs, cmd, parallelism=16, timeout=None, username=None, password=None):
+    '''
+    Run cmd (a string or a list) on the hosts and VMs objs, on up to parallelism of
+    them at once, with a timeout (seconds) per command. Returns a Fanout.
+    '''
+    return Fanout(objs, cmd, parallelism, timeout, username, password)
@@ -0,0 +1,311 @@
+#
+#
+# Copyright (c) 2013-2018 Datrium Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Hedged, deadline-aware invocation of vSphere methods.
+
+Every SOAP call goes through SoapStubAdapter.InvokeMethod, which takes an HTTP
+connection from the stub's pool. patched.py routes InvokeMethod and GetConnection
+through this module so that:
+
+1. a per-thread deadline (see deadline()) bounds every call made inside it; the
+   remaining time is applied as the socket timeout of the pooled connection.
+2. idempotent read methods can be hedged. When a stub has a Hedger attached and
+   a read has not answered within the running p95 of that method, a duplicate is
+   sent (the pool hands out a different connection) and the first answer wins.
+
+Example:
+    >>> vc = vim.VC(host, username=..., password=..., hedged=True)
+    >>> with vc.deadline(5):
+    ...     vm = vc.vm('vm-01')
+    >>> vc.hedger.stats
+    Counter({'calls': 3, 'hedged': 1, 'hedge_wins': 1})
+'''
+
+import collections
+import contextlib
+import Queue
+import random
+import socket
+import threading
+import time
+
+
+# Methods that are safe to send twice. Note that PropertyCollector.RetrieveContents()
+# is RetrieveProperties on the wire.
+HEDGED_METHODS = frozenset([
+    'RetrieveProperties',
+    'RetrievePropertiesEx',
+    'FindByInventoryPath',
+    'QueryOptions',
+])
+
+_local = threading.local()
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    '''
+    Bound all vSphere calls made by this thread within the block to seconds. Nested
+    deadlines can only shorten the outer one.
+    '''
+    previous = getattr(_local, 'deadline', None)
+    endtime = time.time() + seconds
+    if previous is not None:
+        endtime = min(endtime, previous)
+    _local.deadline = endtime
+    try:
+        yield
+    finally:
+        _local.deadline = previous
+
+
+def remaining():
+    '''
+    Seconds left before this thread's deadline, or None if there is no deadline.
+    '''
+    endtime = getattr(_local, 'deadline', None)
+    if endtime is None:
+        return None
+    left = endtime - time.time()
+    if left <= 0:
+        raise DeadlineExceeded('vSphere call deadline exceeded')
+    return left
+
+
+class Hedger(object):
+    ''' Tracks per-method latency and races duplicate requests for slow reads. '''
+
+    def __init__(self, methods=HEDGED_METHODS, percentile=95, window=200, warmup=20,
+                 minimum=0.05):
+        self.methods = frozenset(methods)
+        self.percentile = percentile
+        self.warmup = warmup
+        self.minimum = minimum
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self.stats = collections.Counter()
+        # Latencies the callers saw, hedging (and deadlines) included.
+        self.observed = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self.lock = threading.Lock()
+        self.jobs = Queue.Queue()
+        self.workers = []
+        self.idle = 0
+
+    def delay(self, name):
+        '''
+        How long to wait for method name before hedging. None until enough samples
+        have been seen to estimate the percentile.
+        '''
+        with self.lock:
+            samples = sorted(self.latencies[name])
+        if len(samples) < self.warmup:
+            return None
+        index = min(len(samples) - 1, len(samples) * self.percentile // 100)
+        return max(samples[index], self.minimum)
+
+    def record(self, name, elapsed, **counters):
+        with self.lock:
+            self.latencies[name].append(elapsed)
+            self.stats.update(counters)
+
+    def count(self, **counters):
+        with self.lock:
+            self.stats.update(counters)
+
+    def invoke(self, func, name, *args, **kwargs):
+        '''
+        Call func(*args), sending a duplicate if it is slower than the running
+        percentile for name. The first attempt to finish (success or failure) wins;
+        the loser finishes in the background, returns its connection to the pool and
+        is passed to discard(result) (e.g., to cancel a paged retrieval).
+
+        The latency of the first attempt is recorded whether it wins or not, so that
+        hedging does not lower the percentile it is based on. The latency the caller
+        saw is recorded in observed.
+        '''
+        discard = kwargs.pop('discard', None)
+        delay = self.delay(name)
+        timeout = remaining()
+        started = time.time()
+        if delay is None or (timeout is not None and delay >= timeout):
+            # Nothing to race (e.g. while warming up): the deadline is applied by
+            # GetConnection as the socket timeout.
+            try:
+                return func(*args)
+            finally:
+                elapsed = time.time() - started
+                self.record(name, elapsed, calls=1)
+                self.observe(name, elapsed)
+
+        endtime = getattr(_local, 'deadline', None)
+        # The caller blocks on done (a plain lock acquire, which python 2 does not poll
+        # like it does waits with a timeout) until the first outcome is in.
+        done = threading.Lock()
+        done.acquire()
+        lock = threading.Lock()
+        outcome = []  # (hedge, result, error), the first one wins
+        answered = threading.Event()
+        hedged = []
+
+        def finish(hedge, result, error):
+            with lock:
+                won = not outcome
+                if won:
+                    outcome.append((hedge, result, error))
+            if won:
+                answered.set()
+                done.release()
+            elif result is not None and discard is not None:
+                try:
+                    discard(result)
+                except Exception:
+                    pass
+
+        def attempt(hedge):
+            _local.deadline = endtime
+            start = time.time()
+            result, error = None, None
+            try:
+                result = func(*args)
+            except Exception as e:
+                error = e
+            if not hedge:
+                self.record(name, time.time() - start)
+            finish(hedge, result, error)
+
+        def watch():
+            # Hedge once the primary is late, and give up at the deadline. Only these
+            # waits (which are not on the caller's path) have a timeout.
+            if answered.wait(delay):
+                return
+            hedged.append(True)
+            self.submit(lambda: attempt(True))
+            if endtime is not None and not answered.wait(max(endtime - time.time(), 0)):
+                finish(None, None, DeadlineExceeded('%s did not answer before the deadline'
+                                                    % name))
+
+        self.submit(lambda: attempt(False))
+        self.submit(watch)
+        done.acquire()
+        hedge, result, error = outcome[0]
+        elapsed = time.time() - started
+        self.observe(name, elapsed)
+        self.count(calls=1, hedged=len(hedged), hedge_wins=int(bool(hedge)),
+                   deadline_exceeded=int(hedge is None))
+        if error is not None:
+            raise error
+        return result
+
+    def observe(self, name, elapsed):
+        with self.lock:
+            self.observed[name].append(elapsed)
+
+    def submit(self, job):
+        ''' Run job on an idle worker thread, starting one if there is none. '''
+        with self.lock:
+            if self.idle:
+                self.idle -= 1
+            else:
+                t = threading.Thread(target=self._work, name='hedge-%d' % len(self.workers))
+                t.daemon = True
+                self.workers.append(t)
+                t.start()
+        self.jobs.put(job)
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                job()
+            except Exception:
+                pass
+            with self.lock:
+                self.idle += 1
+
+
+def GetConnection(self):
+    '''
+    SoapStubAdapter.GetConnection that applies this thread's deadline (or the
+    connection's original timeout) to the pooled connection.
+
+    In patched.py, the original GetConnection should be stored under _GetConnection()
+    '''
+    timeout = remaining()
+    conn = self._GetConnection()
+    if not hasattr(conn, 'timeout'):
+        return conn  # e.g. SSLTunnelConnection
+    if not hasattr(conn, 'default_timeout'):
+        conn.default_timeout = conn.timeout
+    if timeout is None:
+        timeout = conn.default_timeout
+    conn.timeout = timeout
+    if conn.sock is not None:
+        if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            timeout = socket.getdefaulttimeout()
+        conn.sock.settimeout(timeout)
+    return conn
+
+
+def InvokeMethod(self, mo, info, args, outerStub=None):
+    '''
+    SoapStubAdapter.InvokeMethod that hedges idempotent reads when the stub has a
+    Hedger attached (see VC(..., hedged=True)).
+
+    In patched.py, the original InvokeMethod should be stored under _InvokeMethod()
+    '''
+    hedger = getattr(self, 'hedger', None)
+    if hedger is None or info.wsdlName not in hedger.methods:
+        return self._InvokeMethod(mo, info, args, outerStub)
+    return hedger.invoke(self._InvokeMethod, info.wsdlName, mo, info, args, outerStub,
+                         discard=lambda result: _cancel(mo, result))
+
+
+def _cancel(mo, result):
+    # The losing RetrievePropertiesEx holds the rest of its pages on the server.
+    token = getattr(result, 'token', None)
+    if token:
+        mo.CancelRetrievePropertiesEx(token)
+
+
+class Stall(object):
+    '''
+    Stand-in for SoapStubAdapter._InvokeMethod that stalls a fraction of the calls,
+    to measure hedging without a misbehaving server:
+
+        >>> stub = vc.si._stub.soapStub
+        >>> stub._InvokeMethod = vim.hedge.Stall(stub._InvokeMethod, 0.05, 3)
+        >>> for i in range(1000):
+        ...     vm.runtime.powerState
+        >>> vc.hedger.stats
+        Counter({'calls': 1000, 'hedged': 53, 'hedge_wins': 49})
+    '''
+
+    def __init__(self, func, probability=0.05, seconds=3):
+        self.func = func
+        self.probability = probability
+        self.seconds = seconds
+        self.stalls = 0
+
+    def __call__(self, *args):
+        if random.random() < self.probability:
+            self.stalls += 1
+            time.sleep(self.seconds)
+        return self.func(*args)
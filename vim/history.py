@@ -0,0 +1,129 @@
+#
+#
+# Copyright (c) 2013-2018 Datrium Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Full event and task histories.
+
+The events and tasks properties of HostSystem and VirtualMachine only return the
+latest page of a new collector. iter_events() and iter_tasks() read the whole
+history matching a time window (and event types or task states) instead, oldest
+first, page_size items per ReadNextEvents/ReadNextTasks of a single collector, so
+histories of any length are streamed with flat memory:
+
+    >>> events = vim.history.iter_events(vc.content.rootFolder, since=yesterday,
+    ...                                  types=['VmPoweredOnEvent'], recursion='all')
+    >>> with open('events.jsonl', 'w') as f:
+    ...     vim.history.write_jsonl(events, f)
+    183204
+'''
+
+import datetime
+import json
+from pyVmomi import vim, VmomiSupport
+
+
+# The server reads at most this many items per call.
+PAGE_SIZE = 1000
+
+
+def _collect(create, spec, page_size):
+    # The collector is created on the first next(), so that a generator that is never
+    # started does not leave it on the server (which limits collectors per session).
+    collector = create(spec)
+    try:
+        collector.RewindCollector()
+        while True:
+            page = collector.ReadNext(page_size)
+            if not page:
+                return
+            for item in page:
+                yield item
+    finally:
+        collector.DestroyCollector()
+
+
+def iter_events(entity, since=None, until=None, types=None, page_size=PAGE_SIZE,
+                recursion='self'):
+    '''
+    Generate the events of entity (recursion: 'self', 'children' or 'all') between the
+    datetimes since and until, of the event types (e.g., ['VmPoweredOnEvent']), oldest
+    first. The filters are applied by the server.
+    '''
+    spec = vim.EventFilterSpec()
+    spec.entity = vim.EventFilterSpec.ByEntity(entity=entity, recursion=recursion)
+    if since is not None or until is not None:
+        spec.time = vim.EventFilterSpec.ByTime(beginTime=since, endTime=until)
+    spec.eventTypeId = list(types or [])
+    return _collect(entity.si.content.eventManager.CreateCollectorForEvents, spec,
+                    min(page_size, PAGE_SIZE))
+
+
+def iter_tasks(entity, since=None, until=None, types=None, states=None, page_size=PAGE_SIZE,
+               recursion='self'):
+    '''
+    Generate the TaskInfos of entity (see iter_events) queued between the datetimes
+    since and until, in the states (e.g., ['error']), oldest first. The time window
+    and states are applied by the server; the task types (descriptionId, e.g.
+    ['VirtualMachine.powerOn']) are not supported there and are filtered here.
+    '''
+    spec = vim.TaskFilterSpec()
+    spec.entity = vim.TaskFilterSpec.ByEntity(entity=entity, recursion=recursion)
+    if since is not None or until is not None:
+        spec.time = vim.TaskFilterSpec.ByTime(timeType=vim.TaskFilterSpec.TimeOption.queuedTime,
+                                              beginTime=since, endTime=until)
+    spec.state = list(states or [])
+    spec.eventChainId = []
+    tasks = _collect(entity.si.content.taskManager.CreateCollectorForTasks, spec,
+                     min(page_size, PAGE_SIZE))
+    if not types:
+        return tasks
+    types = set(types)
+    return (t for t in tasks if t.descriptionId in types)
+
+
+def todict(obj):
+    '''
+    A JSON-serializable copy of the data object obj (e.g., an event): managed objects
+    become their moId, datetimes ISO 8601 strings, and data objects dictionaries with
+    their type in '_type'.
+    '''
+    if isinstance(obj, VmomiSupport.DataObject):
+        result = {'_type': obj._wsdlName}
+        for prop in obj._GetPropertyList():
+            value = getattr(obj, prop.name)
+            if value is not None and not (isinstance(value, list) and not value):
+                result[prop.name] = todict(value)
+        return result
+    if isinstance(obj, VmomiSupport.ManagedObject):
+        return obj._moId
+    if isinstance(obj, (list, tuple)):
+        return [todict(x) for x in obj]
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat()
+    if isinstance(obj, type):
+        return getattr(obj, '_wsdlName', obj.__name__)
+    return obj
+
+
+def write_jsonl(items, fp):
+    ''' Write items (e.g., from iter_events) to fp as JSON Lines; returns the count. '''
+    count = 0
+    for item in items:
+        fp.write(json.dumps(todict(item), separators=(',', ':'), default=str))
+        fp.write('\n')
+        count += 1
+    return count
@@ -20,27 +20,96 @@ Adds functionality to pyVmomi.Vim.HostSystem
 '''
 
 import ast
-import dalibs.decorators
+import capacity
 import dalibs.ssh
+import mo
+import sshpool
+import weakref
 from pyVmomi import vim, vmodl
 
 
-@dalibs.decorators.cached
-def ipaddr(self):
-    for nic in self.config.virtualNicManagerInfo.netConfig:
+NETCONFIG = 'config.virtualNicManagerInfo.netConfig'
+
+# Objects per page of management_addresses().
+PAGESIZE = 500
+
+_addresses = weakref.WeakKeyDictionary()  # stub => {moId: (ipaddr, macaddr)}
+
+
+def management_vnic(netConfig):
+    '''
+    The management vnic in netConfig (config.virtualNicManagerInfo.netConfig), or None.
+    '''
+    for nic in netConfig or []:
         if nic.nicType == 'management':
             for vinc in nic.candidateVnic:
                 if vinc.portgroup == 'Management Network':
-                    return vinc.spec.ip.ipAddress
+                    return vinc
+    return None
+
+
+def remember(host, netConfig):
+    '''
+    Cache the management (ipaddr, macaddr) of host found in netConfig for the session.
+    Nothing is cached without one (e.g., netConfig is unset while host is disconnected).
+    '''
+    vinc = management_vnic(netConfig)
+    if vinc is None or not vinc.spec.ip.ipAddress:
+        return (None, None)
+    address = (vinc.spec.ip.ipAddress, vinc.spec.mac)
+    _addresses.setdefault(host._stub, {})[host._moId] = address
+    return address
+
+
+def remembered(host):
+    ''' The cached (ipaddr, macaddr) of host, or None. '''
+    return _addresses.get(host._stub, {}).get(host._moId)
+
+
+def management_addresses(root=None, hosts=None):
+    '''
+    The management (ipaddr, macaddr) of hosts, or of all the hosts under root, with one
+    paged property collector query for their netConfig only. Returns {host: (ipaddr,
+    macaddr)} and caches them for the session, see ipaddr.
+    '''
+    spec = vim.PropertySpec(type=vim.HostSystem, all=False, pathSet=[NETCONFIG])
+    view = None
+    if hosts is not None:
+        hosts = list(hosts)
+        if not hosts:
+            return {}
+        si = hosts[0].si
+        objspecs = [vim.ObjectSpec(obj=h, skip=False) for h in hosts]
+    else:
+        si = root.si
+        view = si.content.viewManager.CreateContainerView(root, [vim.HostSystem], True)
+        tspec = vim.TraversalSpec(name='view', type=vim.ContainerView, path='view', skip=False)
+        objspecs = [vim.ObjectSpec(obj=view, skip=True, selectSet=[tspec])]
+    try:
+        pfspec = vim.PropertyFilterSpec(objectSet=objspecs, propSet=[spec])
+        result = {}
+        for content in mo.retrieve(si.content.propertyCollector, [pfspec], maxObjects=PAGESIZE):
+            netConfig = dict((p.name, p.val) for p in content.propSet).get(NETCONFIG)
+            result[content.obj] = remember(content.obj, netConfig)
+        return result
+    finally:
+        if view is not None:
+            view.DestroyView()
+
+
+def _address(self):
+    address = remembered(self)
+    if address is None:
+        address = remember(self, self.properties([NETCONFIG]).get(NETCONFIG))
+    return address
+
+
+def ipaddr(self):
+    return _address(self)[0]
 
 
-@dalibs.decorators.cached
 def macaddr(self):
-    for nic in self.config.virtualNicManagerInfo.netConfig:
-        if nic.nicType == 'management':
-            for vinc in nic.candidateVnic:
-                if vinc.portgroup == 'Management Network':
-                    return vinc.spec.mac
+    return _address(self)[1]
 
 
 def Popen(self, *args, **kwargs):
@@ -48,14 +117,20 @@ def Popen(self, *args, **kwargs):
 
 
 def call(self, *args, **kwargs):
+    if sshpool.usable(kwargs):
+        return sshpool.pool.call(self.ipaddr, *args, **kwargs)
     return dalibs.ssh.call(self.ipaddr, *args, name=self.ipaddr, **kwargs)
 
 
 def check_call(self, *args, **kwargs):
+    if sshpool.usable(kwargs):
+        return sshpool.pool.check_call(self.ipaddr, *args, **kwargs)
     return dalibs.ssh.check_call(self.ipaddr, *args, name=self.ipaddr, **kwargs)
 
 
 def check_output(self, *args, **kwargs):
+    if sshpool.usable(kwargs):
+        return sshpool.pool.check_output(self.ipaddr, *args, **kwargs)
     return dalibs.ssh.check_output(self.ipaddr, *args, name=self.ipaddr, **kwargs)
 
 
@@ -68,18 +143,27 @@ def put(self, src, dst, *args, **kwargs):
 
 
 def cpuTotal(self):
+    row = capacity.lookup(self)
+    if row is not None:
+        return row['cpuTotal']
     cpuspeed = float(self.summary.hardware.cpuMhz)
     numcores = float(self.summary.hardware.numCpuCores)
     return cpuspeed * numcores
 
 
 def cpuUtilization(self):
+    row = capacity.lookup(self)
+    if row is not None:
+        return row['cpuUtilization']
     usage = float(self.summary.quickStats.overallCpuUsage)
     return (usage / self.cpuTotal) * 100.0  # percent
 
 
 def cpuAvailable(self):
-    # There may be a more efficient way to do this.
+    # Read from a recent capacity snapshot (see capacity.py) when there is one.
+    row = capacity.lookup(self)
+    if row is not None:
+        return int(row['cpuAvailable'])
     reserved = 0
     for vm in self.vm:
         try:
@@ -92,12 +176,18 @@ def cpuAvailable(self):
 
 
 def memUtilization(self):
+    row = capacity.lookup(self)
+    if row is not None:
+        return row['memUtilization']
     total = float(self.summary.hardware.memorySize / 1024 / 1024 / 1024)  # bytes => gb
     usage = float(self.summary.quickStats.overallMemoryUsage / 1024)  # mb => gb
     return (usage / total) * 100.0  # percent
 
 
 def memAvailable(self):
+    row = capacity.lookup(self)
+    if row is not None:
+        return int(row['memAvailable'])
     reserved = 0
     for vm in self.vm:
         try:
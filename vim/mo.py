@@ -19,7 +19,7 @@
 Adds functionality to pyVmomi.Vim.ManagedObject
 '''
 
-from pyVmomi import vim
+from pyVmomi import vim, vmodl
 
 
 def si(self):
@@ -95,6 +95,52 @@ def find(self, klass, path=None, attrs=[]):
     return [x.obj for x in results]
 
 
+def properties(self, paths):
+    '''
+    Fetch several properties (e.g., ['name', 'config.changeVersion']) of this managed
+    object in a single property collector call. Returns a dictionary of {path: value};
+    unset properties are missing.
+    '''
+    return collect([self], paths).get(self, {})
+
+
+def collect(objs, paths):
+    '''
+    Fetch the properties paths of many managed objects (of one or more types that all
+    have paths) in a single property collector call. Returns a dictionary of
+    {obj: {path: value}}; unset properties are missing.
+    '''
+    if not objs:
+        return {}
+    pfspec = vim.PropertyFilterSpec()
+    pfspec.objectSet = [vim.ObjectSpec(obj=o, skip=False) for o in objs]
+    pfspec.propSet = [vim.PropertySpec(type=k, all=False, pathSet=paths)
+                      for k in set(o.__class__ for o in objs)]
+    result = si(objs[0]).content.propertyCollector.RetrieveContents([pfspec])
+    return dict((r.obj, dict((p.name, p.val) for p in r.propSet)) for r in result)
+
+
+def retrieve(pc, specs, maxObjects=None):
+    '''
+    Generator over the ObjectContents matching the property filter specs, fetched
+    with RetrievePropertiesEx in pages of up to maxObjects (None lets the server
+    choose). The remaining pages are cancelled if the generator is not exhausted.
+    '''
+    options = vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=maxObjects)
+    result = pc.RetrievePropertiesEx(specs, options)
+    try:
+        while result is not None:
+            for content in result.objects:
+                yield content
+            if not result.token:
+                result = None
+                break
+            result = pc.ContinueRetrievePropertiesEx(result.token)
+    finally:
+        if result is not None and result.token:
+            pc.CancelRetrievePropertiesEx(result.token)
+
+
 def path(self):
     if self == self.si.content.rootFolder:
         return ''
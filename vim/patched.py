@@ -35,6 +35,7 @@ vim.ManagedEntity.si = property(mo.si)
 vim.ManagedEntity.find = mo.find
 vim.ManagedEntity._find = mo._find
 vim.ManagedEntity.path = property(mo.path)
+vim.ManagedEntity.properties = mo.properties
 
 import hostsystem
 vim.HostSystem.cpuUtilization = property(hostsystem.cpuUtilization)
@@ -43,8 +44,10 @@ vim.HostSystem.cpuTotal = property(hostsystem.cpuTotal)
 vim.HostSystem.memUtilization = property(hostsystem.memUtilization)
 vim.HostSystem.memAvailable = property(hostsystem.memAvailable)
 vim.HostSystem.EnableVmotionNic = hostsystem.EnableVmotionNic
-vim.HostSystem.ipaddr = hostsystem.ipaddr
-vim.HostSystem.macaddr = hostsystem.macaddr
+# Not cached on the object, so an address that is missing (e.g., while the host is
+# disconnected) is looked up again; found ones are cached per session (see _address).
+vim.HostSystem.ipaddr = property(hostsystem.ipaddr)
+vim.HostSystem.macaddr = property(hostsystem.macaddr)
 vim.HostSystem.Popen = hostsystem.Popen
 vim.HostSystem.call = hostsystem.call
 vim.HostSystem.check_call = hostsystem.check_call
@@ -61,6 +64,11 @@ vim.HostSystem.UpdateAdvConfig = hostsystem.UpdateAdvConfig
 import vm
 vim.VirtualMachine.GetNote = vm.GetNote
 vim.VirtualMachine.SetNote = vm.SetNote
+vim.VirtualMachine.reconfigure = vm.reconfigure
+vim.VirtualMachine.devices = vm.devices
+vim.VirtualMachine.ExportOVF = vm.ExportOVF
+vim.VirtualMachine._ReconfigVM_Task = vim.VirtualMachine.ReconfigVM_Task  # store the original
+vim.VirtualMachine.ReconfigVM_Task = vm.ReconfigVM_Task
 vim.VirtualMachine.Touch = vm.Touch
 vim.VirtualMachine.GetDevices = vm.GetDevices
 vim.VirtualMachine.GetDevicesOnController = vm.GetDevicesOnController
@@ -104,12 +112,24 @@ vim.VirtualMachine.DeletePoolIPs = vm.DeletePoolIPs
 vim.VirtualMachine.PersistPoolIPs = vm.PersistPoolIPs
 vim.VirtualMachine.NetworkConnect_Task = vm.NetworkConnect_Task
 vim.VirtualMachine.RemoveNic_Task = vm.RemoveNic_Task
+vim.VirtualMachine.VirtualMachineConfigSpec_SetNote = vm.VirtualMachineConfigSpec_SetNote
+vim.VirtualMachine.VirtualMachineConfigSpec_AddDisk = vm.VirtualMachineConfigSpec_AddDisk
+vim.VirtualMachine.VirtualMachineConfigSpec_AddDisks = vm.VirtualMachineConfigSpec_AddDisks
+vim.VirtualMachine.VirtualMachineConfigSpec_PlanDisks = vm.VirtualMachineConfigSpec_PlanDisks
+vim.VirtualMachine.VirtualMachineConfigSpec_RemoveDisk = vm.VirtualMachineConfigSpec_RemoveDisk
+vim.VirtualMachine.VirtualMachineConfigSpec_AddDevices = vm.VirtualMachineConfigSpec_AddDevices
+vim.VirtualMachine.VirtualMachineConfigSpec_ReserveResources = vm.VirtualMachineConfigSpec_ReserveResources
+vim.VirtualMachine.VirtualMachineConfigSpec_AddPoolIPs = vm.VirtualMachineConfigSpec_AddPoolIPs
+vim.VirtualMachine.VirtualMachineConfigSpec_NetworkConnect = vm.VirtualMachineConfigSpec_NetworkConnect
+vim.VirtualMachine.VirtualMachineConfigSpec_RemoveNic = vm.VirtualMachineConfigSpec_RemoveNic
 
 import task
 vim.Task.wait = task.wait
 
 import cluster
 vim.ClusterComputeResource.vm = property(cluster.vm)
+vim.ComputeResource.capacity = cluster.capacity
+vim.ComputeResource.PlaceVM = cluster.PlaceVM
 vim.ClusterComputeResource.EnableHA_Task = cluster.EnableHA_Task
 vim.ClusterComputeResource.CreateResourcePool = cluster.CreateResourcePool
 
@@ -126,6 +146,17 @@ except (ImportError, AttributeError):
     pass
 
 
+'''
+Route SOAP calls through hedge.py, which applies per-call deadlines to the pooled
+connection and hedges idempotent reads for stubs that have a Hedger attached.
+'''
+import hedge
+SoapStubAdapter._GetConnection = SoapStubAdapter.GetConnection  # store the original
+SoapStubAdapter.GetConnection = hedge.GetConnection
+SoapStubAdapter._InvokeMethod = SoapStubAdapter.InvokeMethod  # store the original
+SoapStubAdapter.InvokeMethod = hedge.InvokeMethod
+
+
 '''
 Override the Soap/Stub Adapters to do the following:
 1. don't store an explicit reference to the propertyCollector
@@ -0,0 +1,423 @@
+#
+#
+# Copyright (c) 2013-2018 Datrium Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Bulk PerformanceManager queries.
+
+The quickStats behind HostSystem.cpuUtilization or VirtualMachine.utilization are
+instantaneous. query() fetches the history of any counters (by name, e.g.
+'cpu.usage.average') of many hosts and VMs with one QueryPerf per batch of entities,
+in CSV format, and returns a Series of numpy arrays:
+
+    >>> series = vim.perf.query(vc.find(vim.HostSystem), ['cpu.usage.average',
+    ...                         'mem.usage.average', 'net.usage.average'], samples=15)
+    >>> series.values.shape  # entities x counters x samples
+    (120, 3, 15)
+    >>> series.get(host, 'cpu.usage.average')
+    array([ 23.1,  24.7, ...])
+
+Use instance='*' for the per-instance (e.g., per-core, per-disk) series as well.
+'''
+
+import calendar
+import datetime
+import logging
+import numpy
+import threading
+import time
+import warnings
+import weakref
+from pyVmomi import vim, Iso8601
+
+
+# Realtime interval (seconds), available for the last hour on hosts and VMs.
+REALTIME = 20
+
+# Historical intervals (seconds) of the default statistics levels.
+HISTORICAL = [300, 1800, 7200, 86400]
+
+# Metrics (entities x counters) per QueryPerf of historical intervals, the default of
+# the vpxd.stats.maxQueryMetrics advanced setting of vCenter.
+MAX_METRICS = 64
+
+# Entities per QueryPerf of the realtime interval, which is not limited by the server.
+REALTIME_ENTITIES = 250
+
+_counters = weakref.WeakKeyDictionary()  # stub => Counters
+
+
+class Counters(object):
+    ''' The performance counters of a server by 'group.name.rollup' name and by id. '''
+
+    def __init__(self, infos):
+        self.byid = dict((c.key, c) for c in infos)
+        self.byname = dict(('%s.%s.%s' % (c.groupInfo.key, c.nameInfo.key, c.rollupType), c.key)
+                           for c in infos)
+
+    def id(self, name):
+        try:
+            return self.byname[name]
+        except KeyError:
+            raise ValueError('Unknown performance counter %s' % name)
+
+    def name(self, counterId):
+        c = self.byid[counterId]
+        return '%s.%s.%s' % (c.groupInfo.key, c.nameInfo.key, c.rollupType)
+
+    def scale(self, counterId):
+        ''' Percentages are reported in hundredths of a percent. '''
+        return 0.01 if self.byid[counterId].unitInfo.key == 'percent' else 1.0
+
+
+def counters(entity):
+    ''' The (cached) Counters of the server of entity. '''
+    stub = entity._stub
+    if stub not in _counters:
+        _counters[stub] = Counters(entity.si.content.perfManager.perfCounter)
+    return _counters[stub]
+
+
+class Series(object):
+    '''
+    Result of query(). values is an array of entities x counters x timestamps, NaN
+    where there is no sample. counters are (name, instance) pairs, instance is '' for
+    the aggregate. timestamps are in seconds since the epoch.
+    '''
+
+    def __init__(self, entities, counters, timestamps, values):
+        self.entities = entities
+        self.counters = counters
+        self.timestamps = timestamps
+        self.values = values
+        self.entity_index = dict((e, i) for i, e in enumerate(entities))
+        self.counter_index = dict((c, i) for i, c in enumerate(counters))
+
+    def get(self, entity, counter, instance=''):
+        ''' The samples of counter (instance) of entity. '''
+        return self.values[self.entity_index[entity], self.counter_index[(counter, instance)]]
+
+    def latest(self):
+        ''' The last sample of each entity and counter (entities x counters), or NaN. '''
+        result = numpy.full(self.values.shape[:2], numpy.nan)
+        for t in range(self.values.shape[2]):
+            sample = self.values[:, :, t]
+            result = numpy.where(numpy.isnan(sample), result, sample)
+        return result
+
+
+def _timestamp(value):
+    ''' Seconds since the epoch of an xsd:dateTime ('2018-10-01T12:00:20Z') or a datetime. '''
+    if isinstance(value, basestring):
+        return float(calendar.timegm(time.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')))
+    return float(calendar.timegm(value.utctimetuple()))
+
+
+def _batches(entities, ncounters, interval):
+    if interval == REALTIME:
+        size = REALTIME_ENTITIES
+    else:
+        size = max(MAX_METRICS // max(ncounters, 1), 1)
+    for i in range(0, len(entities), size):
+        yield entities[i:i + size]
+
+
+def _spec(entity, ids, interval, instance='', csv=True, start=None, end=None, samples=None):
+    spec = vim.PerfQuerySpec(entity=entity, intervalId=interval, format='csv' if csv else 'normal')
+    spec.metricId = [vim.PerfMetricId(counterId=i, instance=instance) for i in ids]
+    spec.startTime = start
+    spec.endTime = end
+    spec.maxSample = samples
+    return spec
+
+
+def _parse(result, table):
+    '''
+    Add the samples of the QueryPerf result to table {(entity, counterId, instance):
+    {timestamp: value}}. Returns the timestamps seen.
+    '''
+    seen = set()
+    for metric in result or []:
+        if isinstance(metric, vim.PerfEntityMetricCSV):
+            info = metric.sampleInfoCSV.split(',') if metric.sampleInfoCSV else []
+            stamps = [_timestamp(x) for x in info[1::2]]
+            series = [(s.id, numpy.array(s.value.split(','), dtype=float) if s.value else [])
+                      for s in metric.value]
+        else:
+            stamps = [_timestamp(x.timestamp) for x in metric.sampleInfo]
+            series = [(s.id, numpy.array(s.value, dtype=float)) for s in metric.value]
+        seen.update(stamps)
+        for mid, values in series:
+            samples = table.setdefault((metric.entity, mid.counterId, mid.instance), {})
+            for stamp, value in zip(stamps, values):
+                if value >= 0:  # -1 means no sample
+                    samples[stamp] = value
+    return seen
+
+
+def query(entities, names, interval=REALTIME, start=None, end=None, samples=None, instance='',
+          csv=True):
+    '''
+    Query the counters names (e.g., ['cpu.usage.average']) of entities (hosts, VMs,
+    ...) for interval (REALTIME or one of HISTORICAL), between the datetimes start
+    and end, or the latest samples. Returns a Series.
+
+    The entities are queried in batches (see MAX_METRICS), one QueryPerf each.
+    '''
+    entities = list(entities)
+    if not entities:
+        return Series([], [], numpy.zeros(0), numpy.zeros((0, 0, 0)))
+    table = counters(entities[0])
+    ids = [table.id(name) for name in names]
+    pm = entities[0].si.content.perfManager
+
+    samples_by_key, stamps = {}, set()
+    for batch in _batches(entities, len(ids), interval):
+        specs = [_spec(entity, ids, interval, instance, csv, start, end, samples)
+                 for entity in batch]
+        stamps.update(_parse(pm.QueryPerf(specs), samples_by_key))
+
+    # Counters in the order of names, with their instances sorted.
+    columns = [(table.name(i), '') for i in ids] if instance == '' else []
+    for entity, counterId, inst in sorted(samples_by_key, key=lambda k: (ids.index(k[1]), k[2])):
+        if (table.name(counterId), inst) not in columns:
+            columns.append((table.name(counterId), inst))
+    timestamps = numpy.array(sorted(stamps))
+    values = numpy.full((len(entities), len(columns), len(timestamps)), numpy.nan)
+    rows = dict((e, i) for i, e in enumerate(entities))
+    cols = dict((c, i) for i, c in enumerate(columns))
+    for (entity, counterId, inst), points in samples_by_key.items():
+        if not points or entity not in rows:
+            continue
+        at = numpy.searchsorted(timestamps, numpy.array(list(points.keys())))
+        values[rows[entity], cols[(table.name(counterId), inst)], at] = \
+            numpy.array(list(points.values())) * table.scale(counterId)
+    return Series(entities, columns, timestamps, values)
+
+
+class Collector(object):
+    '''
+    Collects the realtime samples of counters names of entities (hosts, VMs) into a
+    ring buffer of the last size samples per (entity, counter). Each poll() only
+    fetches the samples newer than the last one of each entity, and the queries
+    (percentile, rate, average) are answered from memory:
+
+        >>> collector = vim.perf.Collector(vc.find(vim.HostSystem), ['cpu.usage.average'])
+        >>> with collector:  # polls every interval seconds in the background
+        ...     time.sleep(600)
+        ...     collector.percentile('cpu.usage.average', 95)
+
+    The buffers are allocated up front for capacity entities (default: the initial
+    ones): capacity x len(names) x size float32 values plus capacity x size
+    timestamps, e.g. 10000 x 20 x 90 samples (30 minutes) take about 79MB.
+    '''
+
+    def __init__(self, entities, names, size=90, capacity=None, interval=REALTIME):
+        entities = list(entities)
+        self.names = list(names)
+        self.size = size
+        self.interval = interval
+        self.capacity = capacity or len(entities)
+        self.values = numpy.full((self.capacity, len(self.names), size), numpy.nan,
+                                 dtype=numpy.float32)
+        self.stamps = numpy.full((self.capacity, size), numpy.nan)
+        self.head = numpy.zeros(self.capacity, dtype=int)  # next slot of each entity
+        self.last = numpy.zeros(self.capacity)  # timestamp of the last sample of each entity
+        self.entities = [None] * self.capacity
+        self.index = {}  # entity => row
+        self.lock = threading.RLock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.table = None  # Counters, once polled
+        self.polls = 0
+        for entity in entities:
+            self.add(entity)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def add(self, entity):
+        ''' Start collecting entity; raises ValueError when there is no room left. '''
+        with self.lock:
+            if entity in self.index:
+                return
+            try:
+                row = self.entities.index(None)
+            except ValueError:
+                raise ValueError('Collector is full (%d entities)' % self.capacity)
+            self.entities[row] = entity
+            self.index[entity] = row
+
+    def remove(self, entity):
+        with self.lock:
+            row = self.index.pop(entity)
+            self.entities[row] = None
+            self.values[row] = numpy.nan
+            self.stamps[row] = numpy.nan
+            self.head[row] = 0
+            self.last[row] = 0
+
+    def poll(self):
+        '''
+        Fetch the new samples of all entities (the last size samples of new ones), one
+        QueryPerf per batch. Returns the number of samples stored.
+        '''
+        with self.lock:
+            entities = [e for e in self.entities if e is not None]
+            last = dict((e, self.last[self.index[e]]) for e in entities)
+        if not entities:
+            return 0
+        table = self.table = counters(entities[0])
+        ids = [table.id(name) for name in self.names]
+        pm = entities[0].si.content.perfManager
+        utc = Iso8601.TZManager.GetTZInfo()
+        samples = {}
+        for batch in _batches(entities, len(ids), self.interval):
+            specs = []
+            for entity in batch:
+                if last[entity]:
+                    start = datetime.datetime.fromtimestamp(last[entity], utc)
+                    specs.append(_spec(entity, ids, self.interval, start=start))
+                else:
+                    specs.append(_spec(entity, ids, self.interval, samples=self.size))
+            _parse(pm.QueryPerf(specs), samples)
+
+        # {entity: {timestamp: [value per counter]}}
+        rows = {}
+        columns = dict((i, c) for c, i in enumerate(ids))
+        for (entity, counterId, instance), points in samples.items():
+            for stamp, value in points.items():
+                sample = rows.setdefault(entity, {}).setdefault(stamp, [numpy.nan] * len(ids))
+                sample[columns[counterId]] = value * table.scale(counterId)
+        stored = 0
+        with self.lock:
+            for entity, points in rows.items():
+                row = self.index.get(entity)
+                if row is None:
+                    continue  # removed meanwhile
+                for stamp in sorted(points):
+                    if stamp <= self.last[row]:
+                        continue
+                    slot = self.head[row]
+                    self.values[row, :, slot] = points[stamp]
+                    self.stamps[row, slot] = stamp
+                    self.head[row] = (slot + 1) % self.size
+                    self.last[row] = stamp
+                    stored += 1
+            self.polls += 1
+        return stored
+
+    def start(self):
+        ''' Poll every interval seconds in a background thread, until stop(). '''
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name='perf.Collector')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception:
+                logging.exception('perf.Collector poll failed')
+            if self.stopped.wait(self.interval):
+                return
+
+    def _window(self, name, seconds=None):
+        '''
+        The samples of counter name (entities x size, NaN where there is none), in ring
+        order; with seconds, only those of the last seconds of each entity.
+        '''
+        values = self.values[:, self.names.index(name), :]
+        if seconds is None:
+            return values
+        recent = self.stamps > (self.last - seconds)[:, None]
+        return numpy.where(recent, values, numpy.nan)
+
+    def _result(self, result, entity):
+        if entity is None:
+            return dict((e, result[row]) for e, row in self.index.items())
+        return result[self.index[entity]]
+
+    def series(self, entity, name):
+        ''' The (timestamps, values) of counter name of entity, oldest first. '''
+        with self.lock:
+            row = self.index[entity]
+            order = numpy.roll(numpy.arange(self.size), -self.head[row])
+            stamps = self.stamps[row, order]
+            values = self.values[row, self.names.index(name), order]
+        valid = ~numpy.isnan(stamps)
+        return stamps[valid], values[valid]
+
+    def percentile(self, name, q, entity=None, seconds=None):
+        '''
+        The q-th percentile of counter name over the last seconds (default: all the
+        samples) of entity, or {entity: percentile} of all entities.
+        '''
+        with self.lock:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)  # all-NaN rows
+                result = numpy.nanpercentile(self._window(name, seconds), q, axis=1)
+            return self._result(result, entity)
+
+    def average(self, name, entity=None, seconds=None):
+        ''' The average of counter name over the last seconds, see percentile(). '''
+        with self.lock:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                result = numpy.nanmean(self._window(name, seconds), axis=1)
+            return self._result(result, entity)
+
+    def moving_average(self, entity, name, n=3):
+        ''' The moving average of the last n samples of counter name of entity. '''
+        stamps, values = self.series(entity, name)
+        if len(values) < n:
+            return stamps[:0], values[:0]
+        return stamps[n - 1:], numpy.convolve(values, numpy.ones(n) / n, mode='valid')
+
+    def rate(self, name, entity=None, seconds=None):
+        '''
+        The per-second rate of counter name over the last seconds, see percentile():
+        the sum over the time covered for delta (e.g., summation) counters, the change
+        over the time elapsed for absolute counters and the average for rate counters.
+        '''
+        with self.lock:
+            values = self._window(name, seconds)
+            valid = ~numpy.isnan(values)
+            statsType = self.table.byid[self.table.id(name)].statsType if self.table else 'rate'
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                if statsType == 'delta':
+                    result = numpy.nansum(values, axis=1) / (valid.sum(axis=1) * self.interval)
+                elif statsType == 'absolute':
+                    rows = numpy.arange(len(values))
+                    first = numpy.argmin(numpy.where(valid, self.stamps, numpy.inf), axis=1)
+                    last = numpy.argmax(numpy.where(valid, self.stamps, -numpy.inf), axis=1)
+                    elapsed = self.stamps[rows, last] - self.stamps[rows, first]
+                    result = numpy.where(elapsed > 0, (values[rows, last] - values[rows, first]) /
+                                         elapsed, numpy.nan)
+                else:
+                    result = numpy.nansum(values, axis=1) / valid.sum(axis=1)
+            return self._result(result, entity)
@@ -0,0 +1,242 @@
+#
+#
+# Copyright (c) 2013-2018 Datrium Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Capacity-aware placement of new VMs on the hosts of a ComputeResource.
+
+Without DRS (or on a standalone ESX), imports go to the first host and datastore. A
+Placer scores the hosts from a capacity snapshot (see capacity.py) and their
+datastores by free space. The resources of its recent placements are kept as
+pending, so that a burst of placements is spread out before any of the VMs shows up
+in a snapshot:
+
+    >>> for name in names:
+    ...     p = cluster.PlaceVM({'cpu': 1000, 'mem': 4096, 'disk': 40}, group='web')
+    ...     vc.ImportOVF(ovffile, name=name, host=p.host, datastore=p.datastore)
+
+Only the hosts of one ComputeResource are scored. Under a VC, each standalone host is
+a ComputeResource of its own, so standalone hosts are not placed across: deploy.OVF
+uses the ComputeResource of the (default) resource pool, i.e. the first one of the
+datacenter when it has no cluster.
+'''
+
+import capacity
+import mo
+import numpy
+import threading
+import time
+from pyVmomi import vim
+
+
+GB = 1024 * 1024 * 1024
+
+# spread: most headroom left after the placement; pack: least headroom that fits.
+POLICIES = ['spread', 'pack']
+
+# Seconds the resources of a placement are held as pending (unless released). This
+# covers the time it takes to create the VM and to power it on.
+HOLD = 300
+
+# Seconds a Placer reuses its capacity snapshot.
+TTL = 30
+
+HOST_PATHS = ['runtime.connectionState', 'runtime.inMaintenanceMode', 'network', 'datastore']
+
+DATASTORE_PATHS = ['summary.freeSpace', 'summary.accessible', 'summary.maintenanceMode']
+
+# ComputeResource => Placer. A plain dict: the ComputeResource objects of the callers
+# are short-lived copies (equal by moId), and the pending placements must outlive them.
+_placers = {}
+
+
+class PlacementError(Exception):
+    pass
+
+
+class Placement(object):
+    ''' Where a VM goes, and the resources held for it, see Placer.place() '''
+
+    def __init__(self, placer, host, datastore, resources, group=None):
+        self.placer = placer
+        self.host = host
+        self.datastore = datastore
+        self.cpu = resources.get('cpu', 0)
+        self.mem = resources.get('mem', 0)
+        self.disk = resources.get('disk', 0) * GB
+        self.group = group
+        self.expires = time.time() + HOLD
+
+    def release(self):
+        ''' Stop holding the resources, e.g. when the VM failed to deploy. '''
+        self.placer.release(self)
+
+
+class Placer(object):
+    '''
+    Places VMs on the hosts of a ComputeResource, see place(). Use placer() to get the
+    process-wide Placer of a ComputeResource, which holds its pending placements.
+    '''
+
+    def __init__(self, computeResource, ttl=TTL):
+        self.computeResource = computeResource
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.pending = []
+        self.table = None
+        self.hosts = {}  # host => {path: value}, see HOST_PATHS
+        self.datastores = {}  # datastore => {path: value}, see DATASTORE_PATHS
+        self.names = {}  # network name => network
+
+    def refresh(self, force=False):
+        ''' Take a new capacity snapshot, unless the current one is younger than ttl. '''
+        if not force and self.table is not None and self.table.age < self.ttl:
+            return
+        table = capacity.snapshot(self.computeResource)
+        hosts = mo.collect(table.hosts, HOST_PATHS)
+        datastores = set(ds for props in hosts.values() for ds in props.get('datastore', []))
+        self.datastores = mo.collect(list(datastores), DATASTORE_PATHS)
+        self.hosts = hosts
+        self.names = {}
+        self.table = table
+
+    def network(self, network):
+        ''' The network named network on the hosts (or network itself if not a name). '''
+        if not isinstance(network, basestring):
+            return network
+        if not self.names:
+            networks = set(n for props in self.hosts.values() for n in props.get('network', []))
+            names = mo.collect(list(networks), ['name'])
+            self.names = dict((props['name'], n) for n, props in names.items())
+        if network not in self.names:
+            raise PlacementError('No host has network %s' % network)
+        return self.names[network]
+
+    def release(self, placement):
+        with self.lock:
+            if placement in self.pending:
+                self.pending.remove(placement)
+
+    def place(self, resources, policy='spread', group=None, antiaffinity='soft', avoid=(),
+              datastore=None):
+        '''
+        Pick a host and a datastore for a VM, and hold its resources. Returns a
+        Placement, or raises PlacementError if no host fits.
+
+        resources - {'cpu': MHz reserved, 'mem': MB reserved, 'disk': GB, 'network': name
+                    or network}, all optional
+        policy - see POLICIES
+        group - anti-affinity group; pending placements of a group avoid each other's hosts
+        antiaffinity - 'soft' prefers hosts with the fewest VMs of group (and of avoid),
+                       'hard' only places on hosts without any
+        avoid - VMs (or hosts) whose hosts are avoided like those of group
+        datastore - the datastore to use, instead of picking one
+        '''
+        if policy not in POLICIES:
+            raise ValueError('Unknown policy %s, expected one of %s' % (policy, ', '.join(POLICIES)))
+        if antiaffinity not in ('soft', 'hard'):
+            raise ValueError('Unknown antiaffinity %s, expected soft or hard' % antiaffinity)
+        cpu = resources.get('cpu', 0)
+        mem = resources.get('mem', 0)
+        disk = resources.get('disk', 0) * GB
+        avoid = list(avoid)
+        avoided = [x for x in avoid if isinstance(x, vim.HostSystem)]
+        vms = [x for x in avoid if not isinstance(x, vim.HostSystem)]
+        avoided += [props['runtime.host'] for props in mo.collect(vms, ['runtime.host']).values()
+                    if 'runtime.host' in props]
+
+        with self.lock:
+            self.refresh()
+            now = time.time()
+            self.pending = [p for p in self.pending if p.expires > now]
+            table = self.table
+            network = resources.get('network')
+            if network is not None:
+                network = self.network(network)
+
+            # Pending resources and anti-affinity counts per host.
+            n = len(table)
+            pendingCpu, pendingMem, count = numpy.zeros(n), numpy.zeros(n), numpy.zeros(n)
+            for p in self.pending:
+                if p.host in table:
+                    i = table.index[p.host]
+                    pendingCpu[i] += p.cpu
+                    pendingMem[i] += p.mem
+                    if group is not None and p.group == group:
+                        count[i] += 1
+            for host in avoided:
+                if host in table:
+                    count[table.index[host]] += 1
+
+            used = {}  # datastore => pending bytes
+            for p in self.pending:
+                used[p.datastore] = used.get(p.datastore, 0) + p.disk
+            stores = [self._datastore(h, disk, policy, used, datastore) for h in table.hosts]
+            cpuFree = table['cpuAvailable'] - pendingCpu - cpu
+            memFree = table['memAvailable'] - pendingMem - mem
+            fits = numpy.array([self._usable(h, network) for h in table.hosts], dtype=bool)
+            fits &= (cpuFree >= 0) & (memFree >= 0)
+            fits &= numpy.array([ds is not None for ds in stores], dtype=bool)
+            if antiaffinity == 'hard':
+                fits &= count == 0
+            if not fits.any():
+                raise PlacementError('No host of %s fits %s' % (self.computeResource, resources))
+
+            # Headroom is the scarcer of the cpu and memory fractions left.
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                headroom = numpy.minimum(
+                    numpy.where(table['cpuTotal'] > 0, cpuFree / table['cpuTotal'], 0.0),
+                    numpy.where(table['memTotal'] > 0, memFree / table['memTotal'], 0.0))
+            if policy == 'spread':
+                headroom = -headroom
+            candidates = numpy.flatnonzero(fits)
+            best = candidates[numpy.lexsort((headroom[candidates], count[candidates]))[0]]
+
+            placement = Placement(self, table.hosts[best], stores[best], resources, group)
+            self.pending.append(placement)
+            return placement
+
+    def _usable(self, host, network):
+        props = self.hosts.get(host, {})
+        if props.get('runtime.connectionState') != vim.HostSystem.ConnectionState.connected:
+            return False
+        if props.get('runtime.inMaintenanceMode'):
+            return False
+        return network is None or network in props.get('network', [])
+
+    def _datastore(self, host, disk, policy, used, datastore=None):
+        ''' The datastore of host that fits disk more bytes, by policy; None if none fits. '''
+        candidates = []
+        for ds in self.hosts.get(host, {}).get('datastore', []):
+            props = self.datastores.get(ds, {})
+            if datastore is not None and ds != datastore:
+                continue
+            if not props.get('summary.accessible'):
+                continue
+            if props.get('summary.maintenanceMode', 'normal') != 'normal':
+                continue
+            free = props.get('summary.freeSpace', 0) - used.get(ds, 0) - disk
+            if free >= 0:
+                candidates.append((free, ds))
+        if not candidates:
+            return None
+        candidates.sort(key=lambda c: c[0], reverse=(policy == 'spread'))
+        return candidates[0][1]
+
+
+def placer(computeResource):
+    ''' The process-wide Placer of computeResource. '''
+    return _placers.setdefault(computeResource, Placer(computeResource))
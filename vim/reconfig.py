@@ -0,0 +1,218 @@
+#
+#
+# Copyright (c) 2013-2018 Datrium Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Batches many VirtualMachineConfigSpecs into a single ReconfigVM_Task.
+
+Every ReconfigVM_Task locks the VMX and is waited on separately, so a provisioning
+path that adds devices, disks, reservations and a note pays for each of them. A
+Reconfigure collects the pieces of the vim.VirtualMachine.VirtualMachineConfigSpec_*
+helpers (see vm.py) and commits them at once:
+
+    >>> with vm.reconfigure() as spec:
+    ...     spec.AddDevices({'nic': ['vlan1550']})
+    ...     spec.AddDisks([{'gbytes': 10, 'dsname': 'datastore1'}])
+    ...     spec.ReserveResources({'ncpus': 2, 'mem': 4096, 'cpu': 1000})
+    ...     spec.SetNote({'owner': 'kyle'})
+    >>> spec.task.info.state
+    'success'
+'''
+
+from pyVmomi import vim
+from pyVmomi.Differ import DiffAnys
+
+
+def _isset(value):
+    return value is not None and not (isinstance(value, list) and len(value) == 0)
+
+
+def _merge_fields(dst, src, skip=()):
+    ''' Copy the set fields of DataObject src to dst; a field may only be set to one value. '''
+    for prop in src._GetPropertyList():
+        if prop.name in skip:
+            continue
+        value = getattr(src, prop.name)
+        if not _isset(value):
+            continue
+        current = getattr(dst, prop.name)
+        if _isset(current) and not DiffAnys(current, value):
+            raise ValueError('Conflicting reconfigure values for %s: %s and %s' %
+                (prop.name, current, value))
+        setattr(dst, prop.name, value)
+
+
+class Reconfigure(object):
+    '''
+    Context manager that merges VirtualMachineConfigSpecs and commits them as one
+    ReconfigVM_Task on exit (unless the block raised).
+
+    Temporary (negative) device keys of a merged spec that are already used by an
+    earlier one are renumbered, so pieces produced independently can reference
+    their own new controllers. Conflicting
+    pieces (the same device edited twice, two new devices in one controller slot,
+    different values for the same setting) raise a ValueError when merged.
+    '''
+
+    def __init__(self, vm, wait=True, timeout=240):
+        self.vm = vm
+        self.wait = wait
+        self.timeout = timeout
+        self.spec = vim.VirtualMachineConfigSpec()
+        self.task = None
+        self._key = 0  # last temporary device key handed out
+        self._keys = set()  # temporary keys of the new devices
+        self._devices = set()  # keys of existing devices being edited/removed
+        self._slots = set()  # (controllerKey, unitNumber) of new devices
+        self._options = {}  # extraConfig key => value
+        self._properties = set()  # vApp property keys
+        self._snapshot = None
+
+    @property
+    def snapshot(self):
+        '''
+        The VM's device snapshot with the pending changes applied, so later pieces
+        are planned against (e.g., do not reuse the slots of) earlier ones.
+        '''
+        if self._snapshot is None:
+            self._snapshot = self.vm.devices().copy()
+            for change in self.spec.deviceChange:
+                if change.operation == vim.VirtualDeviceConfigSpecOperation.add:
+                    self._snapshot.add(change.device)
+                elif change.operation == vim.VirtualDeviceConfigSpecOperation.remove:
+                    self._snapshot.remove(change.device.key)
+        return self._snapshot
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        return False
+
+    def __nonzero__(self):
+        return any(_isset(getattr(self.spec, p.name)) for p in self.spec._GetPropertyList())
+
+    def commit(self):
+        '''
+        Submit the merged spec as a single ReconfigVM_Task. Nothing is submitted if
+        nothing was merged.
+        '''
+        if not self:
+            return None
+        self.task = self.vm.ReconfigVM_Task(self.spec)
+        if self.wait:
+            self.task.wait(timeout=self.timeout)
+        return self.task
+
+    def merge(self, spec):
+        '''
+        Merge the VirtualMachineConfigSpec spec into the pending reconfigure.
+        '''
+        # Temporary keys this spec introduced => their keys in the merged spec. Only
+        # references to these are rewired; other controllerKeys refer to existing
+        # devices or to new devices of earlier specs.
+        keys = {}
+        originals = {}  # id(new device) => its key in spec
+        for change in spec.deviceChange:
+            device = change.device
+            if change.operation == vim.VirtualDeviceConfigSpecOperation.add and device.key < 0:
+                originals[id(device)] = device.key
+                if device.key in self._keys:
+                    self._key = min([self._key] + list(self._keys)) - 1
+                    keys[device.key] = self._key
+                    device.key = self._key
+                else:
+                    keys[device.key] = device.key
+                self._keys.add(device.key)
+        for change in spec.deviceChange:
+            device = change.device
+            # A device is never its own controller: such a key is a device of an earlier spec.
+            if device.controllerKey in keys and originals.get(id(device)) != device.controllerKey:
+                device.controllerKey = keys[device.controllerKey]
+            if change.operation == vim.VirtualDeviceConfigSpecOperation.add:
+                if device.controllerKey is not None and device.unitNumber is not None:
+                    slot = (device.controllerKey, device.unitNumber)
+                    if slot in self._slots:
+                        raise ValueError('Conflicting new devices on controller %s unit %s' % slot)
+                    self._slots.add(slot)
+            else:
+                if device.key in self._devices:
+                    raise ValueError('Device %s is changed more than once' % device.key)
+                self._devices.add(device.key)
+            self.spec.deviceChange.append(change)
+            if self._snapshot is not None:
+                if change.operation == vim.VirtualDeviceConfigSpecOperation.add:
+                    self._snapshot.add(device)
+                elif change.operation == vim.VirtualDeviceConfigSpecOperation.remove:
+                    self._snapshot.remove(device.key)
+
+        for option in spec.extraConfig:
+            if option.key in self._options:
+                if self._options[option.key] != option.value:
+                    raise ValueError('Conflicting values for %s: %s and %s' %
+                        (option.key, self._options[option.key], option.value))
+                continue
+            self._options[option.key] = option.value
+            self.spec.extraConfig.append(option)
+
+        if spec.vAppConfig is not None:
+            if self.spec.vAppConfig is None:
+                self.spec.vAppConfig = vim.VmConfigSpec()
+            for pspec in spec.vAppConfig.property:
+                key = pspec.info.key if pspec.info is not None else pspec.removeKey
+                if key in self._properties:
+                    raise ValueError('vApp property %s is changed more than once' % key)
+                self._properties.add(key)
+                self.spec.vAppConfig.property.append(pspec)
+            _merge_fields(self.spec.vAppConfig, spec.vAppConfig, skip=('property',))
+
+        _merge_fields(self.spec, spec, skip=('deviceChange', 'extraConfig', 'vAppConfig'))
+        return self
+
+    def AddDevices(self, devices):
+        return self.merge(self.vm.VirtualMachineConfigSpec_AddDevices(devices, self.snapshot))
+
+    def AddDisk(self, *args, **kwargs):
+        kwargs['snapshot'] = self.snapshot
+        return self.merge(self.vm.VirtualMachineConfigSpec_AddDisk(*args, **kwargs))
+
+    def AddDisks(self, disks):
+        return self.merge(self.vm.VirtualMachineConfigSpec_AddDisks(disks, self.snapshot))
+
+    def PlanDisks(self, disks, policy='pack', controllerType=vim.ParaVirtualSCSIController):
+        return self.merge(self.vm.VirtualMachineConfigSpec_PlanDisks(disks, policy, controllerType,
+                                                                     self.snapshot))
+
+    def RemoveDisk(self, disk, controller=None):
+        return self.merge(self.vm.VirtualMachineConfigSpec_RemoveDisk(disk, controller))
+
+    def ReserveResources(self, resources):
+        return self.merge(self.vm.VirtualMachineConfigSpec_ReserveResources(resources))
+
+    def SetNote(self, value):
+        return self.merge(self.vm.VirtualMachineConfigSpec_SetNote(value))
+
+    def AddPoolIPs(self, qty=1, network='VM Network'):
+        return self.merge(self.vm.VirtualMachineConfigSpec_AddPoolIPs(qty, network))
+
+    def NetworkConnect(self, label, connected=True, network='VM Network'):
+        return self.merge(self.vm.VirtualMachineConfigSpec_NetworkConnect(label, connected, network,
+                                                                          self.snapshot))
+
+    def RemoveNic(self, label):
+        return self.merge(self.vm.VirtualMachineConfigSpec_RemoveNic(label, self.snapshot))
@@ -0,0 +1,244 @@
+#
+#
+# Copyright (c) 2013-2018 Datrium Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Pooled SSH connections for the call/check_call/check_output methods of HostSystem
+and VirtualMachine.
+
+dalibs.ssh connects (TCP and SSH handshakes, authentication) for every command. Once
+configured, these methods run their commands as exec channels of a persistent
+connection per (ipaddr, username) instead. Connections that were idle for a while
+are checked before use and reconnected if broken, and closed after idle seconds.
+
+Only the commands that run to completion are pooled: Popen (which hands out a live
+process), get and put still open a dalibs.ssh connection per call, as do calls with
+other arguments than those in KWARGS.
+
+Example:
+    >>> vim.sshpool.configure(idle=300)
+    >>> for cmd in checks:
+    ...     host.check_output(cmd, username='root', password=...)
+    >>> vim.sshpool.pool.stats()
+    {'connections': 1, 'connects': 1, 'commands': 25}
+'''
+
+import collections
+import logging
+import paramiko
+import pipes
+import select
+import subprocess
+import threading
+import time
+
+
+# Seconds after which an unused connection is closed.
+IDLE = 300
+
+# Seconds after which a connection is checked before it is used again.
+HEALTH = 30
+
+# Concurrent exec channels per connection (OpenSSH's MaxSessions defaults to 10).
+SESSIONS = 8
+
+USERNAME = 'root'
+
+# Keyword arguments of the dalibs.ssh functions a pool handles, see usable().
+KWARGS = set(['username', 'password', 'timeout'])
+
+# Process-wide pool, see configure(). None means dalibs.ssh is used.
+pool = None
+
+
+class Connection(object):
+    ''' An authenticated SSH connection, shared by up to SESSIONS commands. '''
+
+    def __init__(self, host, username, password=None, timeout=None):
+        self.host = host
+        self.username = username
+        self.client = paramiko.SSHClient()
+        self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.client.connect(host, username=username, password=password, timeout=timeout,
+                            allow_agent=password is None, look_for_keys=password is None)
+        self.sessions = threading.BoundedSemaphore(SESSIONS)
+        self.active = 0
+        self.used = time.time()
+
+    def healthy(self):
+        transport = self.client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except (paramiko.SSHException, EOFError, IOError):
+            return False
+        return True
+
+    def close(self):
+        self.client.close()
+
+    def run(self, cmd, timeout=None):
+        ''' Run cmd, returns (returncode, stdout, stderr). '''
+        with self.sessions:
+            channel = self.client.get_transport().open_session(timeout=timeout)
+            try:
+                channel.exec_command(cmd)
+                return _communicate(channel, timeout)
+            finally:
+                channel.close()
+
+
+def _communicate(channel, timeout=None):
+    deadline = None if timeout is None else time.time() + timeout
+    stdout, stderr = [], []
+    while True:
+        if channel.recv_ready():
+            stdout.append(channel.recv(32768))
+        elif channel.recv_stderr_ready():
+            stderr.append(channel.recv_stderr(32768))
+        elif channel.exit_status_ready():
+            break
+        else:
+            if deadline is not None and time.time() > deadline:
+                raise paramiko.SSHException('Command timed out after %s seconds' % timeout)
+            select.select([channel], [], [], 0.1)  # stderr does not wake select
+    return channel.recv_exit_status(), ''.join(stdout), ''.join(stderr)
+
+
+def _command(args):
+    if isinstance(args, basestring):
+        return args
+    return ' '.join(pipes.quote(a) for a in args)
+
+
+class Pool(object):
+    ''' SSH connections by (host, username), see configure(). '''
+
+    def __init__(self, idle=IDLE, health=HEALTH):
+        self.idle = idle
+        self.health = health
+        self.lock = threading.Lock()
+        self.connections = {}  # (host, username) => Connection
+        self.connecting = collections.defaultdict(threading.Lock)  # (host, username) => Lock
+        self.counters = collections.Counter()
+
+    def connection(self, host, username=None, password=None, timeout=None):
+        ''' The connection to host as username, connecting (or reconnecting) if needed. '''
+        key = (host, username or USERNAME)
+        self.evict()
+        with self.lock:
+            connecting = self.connecting[key]
+        with connecting:  # one handshake per key at a time, others wait for it
+            with self.lock:
+                conn = self.connections.get(key)
+            if conn is not None and time.time() - conn.used > self.health and not conn.healthy():
+                logging.debug('Reconnecting to %s@%s' % (key[1], host))
+                self.discard(conn)
+                conn = None
+            if conn is None:
+                conn = Connection(host, key[1], password, timeout)
+                with self.lock:
+                    self.connections[key] = conn
+                    self.counters['connects'] += 1
+            with self.lock:
+                conn.active += 1
+                conn.used = time.time()
+        return conn
+
+    def release(self, conn):
+        with self.lock:
+            conn.active -= 1
+            conn.used = time.time()
+
+    def discard(self, conn):
+        with self.lock:
+            if self.connections.get((conn.host, conn.username)) is conn:
+                del self.connections[(conn.host, conn.username)]
+        conn.close()
+
+    def evict(self):
+        ''' Close the connections that were not used for idle seconds. '''
+        now = time.time()
+        with self.lock:
+            idle = [c for c in self.connections.values()
+                    if not c.active and now - c.used > self.idle]
+            for c in idle:
+                del self.connections[(c.host, c.username)]
+        for c in idle:
+            c.close()
+
+    def close(self):
+        with self.lock:
+            conns, self.connections = self.connections.values(), {}
+        for c in conns:
+            c.close()
+
+    def run(self, host, args, username=None, password=None, timeout=None):
+        '''
+        Run the command args (a string or a list) on host. Returns (returncode, stdout,
+        stderr). A broken connection is reconnected once.
+        '''
+        cmd = _command(args)
+        for attempt in range(2):
+            conn = self.connection(host, username, password, timeout)
+            try:
+                result = conn.run(cmd, timeout)
+                with self.lock:
+                    self.counters['commands'] += 1
+                return result
+            except (paramiko.SSHException, EOFError, IOError):
+                if attempt or conn.healthy():
+                    raise
+                self.discard(conn)
+            finally:
+                self.release(conn)
+
+    def call(self, host, args, **kwargs):
+        return self.run(host, args, **kwargs)[0]
+
+    def check_call(self, host, args, **kwargs):
+        returncode, stdout, stderr = self.run(host, args, **kwargs)
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, _command(args), stdout + stderr)
+        return returncode
+
+    def check_output(self, host, args, **kwargs):
+        returncode, stdout, stderr = self.run(host, args, **kwargs)
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, _command(args), stdout)
+        return stdout
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, connections=len(self.connections))
+
+
+def configure(enabled=True, idle=IDLE, health=HEALTH):
+    '''
+    Install (or, without enabled, remove) the process-wide pool used by the ssh
+    methods of HostSystem and VirtualMachine.
+    '''
+    global pool
+    if pool is not None:
+        pool.close()
+    pool = Pool(idle, health) if enabled else None
+    return pool
+
+
+def usable(kwargs):
+    ''' Whether the pool (if any) handles a dalibs.ssh call with kwargs. '''
+    return pool is not None and set(kwargs) <= KWARGS
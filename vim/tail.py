@@ -0,0 +1,286 @@
+#
+#
+# Copyright (c) 2013-2018 Datrium Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Live event stream of a VC.
+
+Polling host.events creates a collector and rereads its latest page every time. A
+Tail keeps one EventHistoryCollector for the whole inventory instead, and watches
+its latestPage with WaitForUpdatesEx (see wait.py), so new events are pushed as they
+are posted. Events are deduplicated by key and handed to the callbacks by a pool of
+worker threads.
+
+With a checkpoint file, the key and time of the last event all the callbacks are
+done with (and every event before it) is persisted. A restarted Tail reads the
+events it missed from the history (see history.py) before the new ones, so none is
+skipped. Delivery is at least once: the events being handled when the process
+stops are delivered again after a restart. Without a checkpoint, a Tail starts with
+the events posted after it.
+
+When watching fails (e.g., the network or the session is lost), a Tail starts over
+with a new collector after a backoff, and reads the events it missed meanwhile from
+the history.
+
+    >>> def powered(event):
+    ...     print event.createdTime, event.vm.name, event.__class__.__name__
+    >>> vim.tail(vc.content.rootFolder, powered, checkpoint='/var/lib/mon/events.json',
+    ...          types=['VmPoweredOnEvent', 'VmPoweredOffEvent'])
+'''
+
+import Queue
+import collections
+import history
+import json
+import logging
+import mo
+import os
+import threading
+import wait
+import weakref
+from pyVmomi import vim, vmodl, Iso8601
+
+
+# Size of latestPage. More events than this between two updates are read from the
+# history instead.
+PAGE_SIZE = 1000
+
+WORKERS = 4
+
+# Seconds to wait before watching again after a failure, doubled up to MAX_BACKOFF.
+BACKOFF = 1
+MAX_BACKOFF = 300
+
+_tails = weakref.WeakKeyDictionary()  # stub => Tail
+
+
+class Tail(object):
+    ''' The events of the inventory under root as they are posted, see tail(). '''
+
+    def __init__(self, root, checkpoint=None, types=None, workers=WORKERS, page_size=PAGE_SIZE):
+        self.root = root
+        self.checkpoint = checkpoint
+        self.types = list(types or [])
+        self.workers = workers
+        self.page_size = page_size
+        self.callbacks = []
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.pending = collections.deque()  # (key, time) of the queued events, in order
+        self.done = set()  # keys of the pending events the callbacks are done with
+        self.last = None  # (key, time) of the newest queued event
+        self.committed = None  # (key, time) of the newest event done with all before it
+        self.primed = False  # whether the events of the first latestPage are known
+        self.counters = collections.Counter()
+        self.stopped = threading.Event()
+        self.pc = None
+        self.watcher = None
+        self.threads = []  # workers
+        self.backoff = BACKOFF
+        if checkpoint is not None and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                saved = json.load(f)
+            self.last = self.committed = (saved['key'], Iso8601.ParseISO8601(saved['time']))
+
+    def subscribe(self, callback):
+        ''' Call callback(event) for every new event. '''
+        with self.lock:
+            self.callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            self.callbacks.remove(callback)
+
+    @property
+    def running(self):
+        ''' Whether the thread watching for events is. '''
+        return self.watcher is not None and self.watcher.is_alive()
+
+    def start(self):
+        ''' Tail (and dispatch) in background threads. '''
+        if self.running:
+            return self
+        self.stopped.clear()
+        threads = [threading.Thread(target=self.run, name='tail')]
+        self.watcher = threads[0]
+        self.threads = [t for t in self.threads if t.is_alive()]
+        threads += [threading.Thread(target=self.work, name='tail-%d' % i)
+                    for i in range(len(self.threads), self.workers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        self.threads += threads[1:]
+        return self
+
+    def stop(self):
+        ''' Stop tailing, once the queued events are dispatched. '''
+        self.stopped.set()
+        pc = self.pc
+        if pc is not None:
+            try:
+                pc.CancelWaitForUpdates()
+            except Exception:
+                pass
+        if self.watcher is not None:
+            self.watcher.join()
+            self.watcher = None
+        for _ in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def run(self):
+        ''' Watch latestPage until stopped, starting over after failures. '''
+        while not self.stopped.is_set():
+            try:
+                self._watch()
+            except Exception:
+                if self.stopped.is_set():
+                    return
+                logging.exception('Event tail of %s failed, watching again in %s seconds' %
+                                  (self.root, self.backoff))
+                self.counters['restarts'] += 1
+                self.stopped.wait(self.backoff)
+                self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+
+    def _watch(self):
+        si = mo.si(self.root)
+        spec = vim.EventFilterSpec()
+        spec.entity = vim.EventFilterSpec.ByEntity(entity=self.root, recursion='all')
+        spec.eventTypeId = self.types
+        collector = si.content.eventManager.CreateCollectorForEvents(spec)
+        pc = None
+        try:
+            collector.SetCollectorPageSize(self.page_size)
+            pc = self.pc = si.content.propertyCollector.CreatePropertyCollector()
+            pc.CreateFilter(wait._filterspec([collector], ['latestPage']), partialUpdates=False)
+            version = ''
+            while not self.stopped.is_set():
+                options = vmodl.query.PropertyCollector.WaitOptions(
+                    maxWaitSeconds=wait.MAX_WAIT_SECONDS)
+                try:
+                    update = pc.WaitForUpdatesEx(version, options)
+                except vmodl.fault.RequestCanceled:
+                    return
+                self.backoff = BACKOFF
+                if update is None:
+                    continue
+                version = update.version
+                for fs in update.filterSet:
+                    for ou in fs.objectSet:
+                        for change in ou.changeSet:
+                            if change.name == 'latestPage':
+                                # After a restart, the events since self.last are
+                                # read from the history if they do not fit the page.
+                                self._page(list(change.val or []))
+        finally:
+            self.pc = None
+            try:
+                if pc is not None:
+                    pc.DestroyPropertyCollector()
+                collector.DestroyCollector()
+            except Exception:
+                pass  # e.g., the connection is gone
+
+    def _page(self, events):
+        events.sort(key=lambda e: e.key)
+        if not self.primed:
+            self.primed = True
+            if self.last is None:
+                # No checkpoint: the existing events are not new.
+                if events:
+                    self.last = (events[-1].key, events[-1].createdTime)
+                return
+        new = [e for e in events if self.last is None or e.key > self.last[0]]
+        if not new:
+            return
+        if self.last is not None and len(new) >= self.page_size:
+            # The page is all new, events may have been posted before it.
+            missed = history.iter_events(self.root, since=self.last[1],
+                                         until=new[0].createdTime, types=self.types,
+                                         recursion='all')
+            for event in missed:
+                if self.last[0] < event.key < new[0].key:
+                    self.counters['backfilled'] += 1
+                    self._queue(event)
+        for event in new:
+            self._queue(event)
+
+    def _queue(self, event):
+        with self.lock:
+            self.last = (event.key, event.createdTime)
+            self.pending.append(self.last)
+            self.counters['events'] += 1
+        self.queue.put(event)
+
+    def work(self):
+        while True:
+            event = self.queue.get()
+            if event is None:
+                return
+            with self.lock:
+                callbacks = list(self.callbacks)
+            for callback in callbacks:
+                try:
+                    callback(event)
+                except Exception:
+                    logging.exception('Event callback %s failed on %s' % (callback, event.key))
+                    self.counters['errors'] += 1
+            self._done(event.key)
+
+    def _done(self, key):
+        with self.lock:
+            self.done.add(key)
+            committed = None
+            while self.pending and self.pending[0][0] in self.done:
+                committed = self.pending.popleft()
+                self.done.discard(committed[0])
+            if committed is not None:
+                self.committed = committed
+                if self.checkpoint is not None:
+                    self._save(committed)
+
+    def _save(self, committed):
+        tmp = self.checkpoint + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'key': committed[0], 'time': committed[1].isoformat()}, f)
+        os.rename(tmp, self.checkpoint)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, pending=len(self.pending), queued=self.queue.qsize())
+
+
+def tail(root, callback=None, checkpoint=None, types=None, workers=WORKERS):
+    '''
+    The Tail of the VC of root (e.g., vc.content.rootFolder), started and with callback
+    subscribed. There is one per VC: the other arguments only apply to the first call.
+    Callbacks run concurrently on workers threads, so events of different keys may be
+    handled out of order.
+    '''
+    t = _tails.get(root._stub)
+    if t is None:
+        t = _tails.setdefault(root._stub, Tail(root, checkpoint, types, workers))
+    if callback is not None:
+        t.subscribe(callback)
+    return t.start()
@@ -0,0 +1,346 @@
+#
+#
+# Copyright (c) 2013-2018 Datrium Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Chunked file transfers to and from many hosts and VMs.
+
+put() sends a file to many targets at once. Each target receives the file in
+chunks of chunksize bytes, over streams parallel SFTP channels of a pooled SSH
+connection (see sshpool.py), written in place into dst.part. The SHA-1 of every
+chunk is then checked on the remote side before dst.part is renamed to dst. When a
+dst.part is left behind (e.g., by a dropped connection), the next transfer only
+sends the chunks whose checksum does not match. get() does the same the other way.
+
+    >>> results = vim.transfer.put(cluster.host, 'big.vib', '/tmp/big.vib',
+    ...                            username='root', password=...)
+    >>> vim.transfer.summary(results)
+    {'targets': 64, 'failed': 0, 'bytes': 274877906944, 'rate': 1181116006.4, ...}
+'''
+
+import Queue
+import collections
+import fanout
+import hashlib
+import logging
+import os
+import pipes
+import sshpool
+import threading
+import time
+
+
+MB = 1024 * 1024
+
+CHUNKSIZE = 64 * MB
+
+# Parallel chunk streams per target.
+STREAMS = 4
+
+# Attempts per chunk, reconnecting in between.
+RETRIES = 3
+
+BLOCKSIZE = MB
+
+# Cached digests() of files.
+DIGESTS = 64
+
+_digests = collections.OrderedDict()  # (path, size, mtime, chunksize) => [sha1 of each chunk]
+
+
+class TransferFailed(Exception):
+    pass
+
+
+class Result(object):
+    ''' The outcome of a transfer to (or from) target. '''
+
+    def __init__(self, target, ipaddr):
+        self.target = target
+        self.ipaddr = ipaddr
+        self.bytes = 0  # sent (or received)
+        self.chunks = 0  # sent (or received)
+        self.skipped = 0  # chunks that were already there
+        self.error = None
+        self.elapsed = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return '<Result %s (%s): %s>' % (self.target, self.ipaddr,
+                                         self.error if self.error is not None else self.bytes)
+
+
+def digests(path, chunksize=CHUNKSIZE, cache=True):
+    '''
+    SHA-1 (hex) of each chunk of the local file path. With cache, the last DIGESTS
+    files are cached by size and mtime.
+    '''
+    key = (os.path.abspath(path), os.path.getsize(path), os.path.getmtime(path), chunksize)
+    if key in _digests:
+        _digests[key] = _digests.pop(key)
+        return _digests[key]
+    result = []
+    with open(path, 'rb') as f:
+        for _ in range(_count(key[1], chunksize)):
+            sha = hashlib.sha1()
+            for block in _blocks(f, chunksize):
+                sha.update(block)
+            result.append(sha.hexdigest())
+    if cache:
+        _digests[key] = result
+        while len(_digests) > DIGESTS:
+            _digests.popitem(last=False)
+    return result
+
+
+def _count(size, chunksize):
+    return max((size + chunksize - 1) // chunksize, 1)
+
+
+def _blocks(f, length):
+    while length > 0:
+        block = f.read(min(BLOCKSIZE, length))
+        if not block:
+            return
+        length -= len(block)
+        yield block
+
+
+def _remote_digests(pool, ipaddr, path, size, chunksize, chunks, **kwargs):
+    '''
+    SHA-1 of the chunks of the remote file path, in one command; None for each chunk
+    if there is no such file (of that size).
+    '''
+    quoted = pipes.quote(path)
+    count = chunksize // BLOCKSIZE
+    cmd = ['[ "$(wc -c < %s)" -eq %d ] || exit 3' % (quoted, size)]
+    for i in chunks:
+        cmd.append('dd if=%s bs=%d skip=%d count=%d 2>/dev/null | sha1sum' %
+                   (quoted, BLOCKSIZE, i * count, count))
+    returncode, stdout, stderr = pool.run(ipaddr, '; '.join(cmd), **kwargs)
+    if returncode:
+        return dict((i, None) for i in chunks)
+    return dict(zip(chunks, [line.split()[0] for line in stdout.splitlines()]))
+
+
+def _stream(pool, result, func, chunks, streams, **kwargs):
+    '''
+    Run func(sftp, chunk) for chunks on up to streams SFTP channels of the pooled
+    connection to result.ipaddr, retrying each chunk up to RETRIES times.
+    '''
+    work = Queue.Queue()
+    for chunk in chunks:
+        work.put(chunk)
+    errors = []
+    lock = threading.Lock()
+
+    def run():
+        while not errors:
+            try:
+                chunk = work.get_nowait()
+            except Queue.Empty:
+                return
+            for attempt in range(RETRIES):
+                conn = None
+                try:
+                    conn = pool.connection(result.ipaddr, **kwargs)
+                    with conn.sessions:
+                        sftp = conn.client.open_sftp()
+                        try:
+                            done = func(sftp, chunk)
+                        finally:
+                            sftp.close()
+                    with lock:
+                        result.bytes += done
+                        result.chunks += 1
+                    break
+                except Exception as e:
+                    logging.debug('Chunk %d of %s failed (%s), attempt %d' %
+                                  (chunk, result.ipaddr, e, attempt + 1))
+                    if conn is not None and not conn.healthy():
+                        pool.discard(conn)
+                    if attempt == RETRIES - 1:
+                        errors.append(e)
+                finally:
+                    if conn is not None:
+                        pool.release(conn)
+
+    threads = [threading.Thread(target=run) for _ in range(min(streams, len(chunks)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+
+
+def _put(pool, result, src, dst, chunksize, streams, **kwargs):
+    size = os.path.getsize(src)
+    local = digests(src, chunksize)
+    part = dst + '.part'
+    chunks = range(len(local))
+    remote = _remote_digests(pool, result.ipaddr, part, size, chunksize, chunks, **kwargs)
+    if all(d is None for d in remote.values()):
+        # A sparse file of the final size, so that a partial one can be resumed.
+        returncode, _, stderr = pool.run(result.ipaddr, 'dd if=/dev/zero of=%s bs=1 count=0 seek=%d'
+                                         % (pipes.quote(part), size), **kwargs)
+        if returncode:
+            raise TransferFailed('Can not create %s: %s' % (part, stderr))
+
+    def send(sftp, chunk):
+        offset = chunk * chunksize
+        with open(src, 'rb') as f, sftp.open(part, 'r+b') as rf:
+            f.seek(offset)
+            rf.seek(offset)
+            rf.set_pipelined(True)
+            sent = 0
+            for block in _blocks(f, chunksize):
+                rf.write(block)
+                sent += len(block)
+        return sent
+
+    missing = [i for i in chunks if remote[i] != local[i]]
+    result.skipped = len(chunks) - len(missing)
+    for _ in range(RETRIES):
+        if not missing:
+            break
+        _stream(pool, result, send, missing, streams, **kwargs)
+        remote.update(_remote_digests(pool, result.ipaddr, part, size, chunksize, missing,
+                                      **kwargs))
+        missing = [i for i in missing if remote[i] != local[i]]
+    if missing:
+        raise TransferFailed('Checksum mismatch of %s on %s' % (dst, result.ipaddr))
+    returncode, _, stderr = pool.run(result.ipaddr, 'mv -f %s %s' % (pipes.quote(part),
+                                                                       pipes.quote(dst)), **kwargs)
+    if returncode:
+        raise TransferFailed('Can not rename %s: %s' % (part, stderr))
+
+
+def _get(pool, result, src, dst, chunksize, streams, **kwargs):
+    returncode, stdout, stderr = pool.run(result.ipaddr, 'wc -c < %s' % pipes.quote(src), **kwargs)
+    if returncode:
+        raise TransferFailed('Can not read %s: %s' % (src, stderr))
+    size = int(stdout)
+    chunks = range(_count(size, chunksize))
+    remote = _remote_digests(pool, result.ipaddr, src, size, chunksize, chunks, **kwargs)
+    part = dst + '.part'
+    if os.path.exists(part) and os.path.getsize(part) == size:
+        local = digests(part, chunksize, cache=False)
+    else:
+        with open(part, 'wb') as f:
+            f.truncate(size)
+        local = [None] * len(chunks)
+
+    def receive(sftp, chunk):
+        offset = chunk * chunksize
+        with sftp.open(src, 'rb') as rf, open(part, 'r+b') as f:
+            rf.seek(offset)
+            f.seek(offset)
+            received = 0
+            for block in _blocks(rf, min(chunksize, size - offset)):
+                f.write(block)
+                received += len(block)
+        return received
+
+    missing = [i for i in chunks if remote[i] != local[i]]
+    result.skipped = len(chunks) - len(missing)
+    for _ in range(RETRIES):
+        if not missing:
+            break
+        _stream(pool, result, receive, missing, streams, **kwargs)
+        local = digests(part, chunksize, cache=False)
+        missing = [i for i in missing if remote[i] != local[i]]
+    if missing:
+        raise TransferFailed('Checksum mismatch of %s from %s' % (src, result.ipaddr))
+    os.rename(part, dst)
+
+
+def _run(func, objs, src, dst, chunksize, streams, parallelism, **kwargs):
+    if chunksize <= 0 or chunksize % BLOCKSIZE:
+        raise ValueError('chunksize must be a positive multiple of %d' % BLOCKSIZE)
+    pool = sshpool.pool or sshpool.Pool()
+    objs = list(collections.OrderedDict.fromkeys(objs))  # each target once
+    ipaddrs = fanout.addresses(objs)
+    targets = Queue.Queue()
+    results = {}
+    for obj in objs:
+        results[obj] = Result(obj, ipaddrs[obj])
+        targets.put(results[obj])
+
+    def run():
+        while True:
+            try:
+                result = targets.get_nowait()
+            except Queue.Empty:
+                return
+            started = time.time()
+            try:
+                if result.ipaddr is None:
+                    raise TransferFailed('No IP address')
+                func(pool, result, src, dst, chunksize, streams, **kwargs)
+            except Exception as e:
+                logging.exception('Transfer of %s with %s failed' % (src, result.target))
+                result.error = e
+            result.elapsed = time.time() - started
+
+    try:
+        threads = [threading.Thread(target=run) for _ in range(min(parallelism, len(objs)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        if pool is not sshpool.pool:
+            pool.close()
+    return results
+
+
+def put(objs, src, dst, chunksize=CHUNKSIZE, streams=STREAMS, parallelism=16, username=None,
+        password=None, timeout=None):
+    '''
+    Send the local file src to dst on the hosts and VMs objs, to up to parallelism of
+    them at once. Returns {obj: Result}.
+    '''
+    return _run(_put, objs, src, dst, chunksize, streams, parallelism, username=username,
+                password=password, timeout=timeout)
+
+
+def get(obj, src, dst, chunksize=CHUNKSIZE, streams=STREAMS, username=None, password=None,
+        timeout=None):
+    '''
+    Fetch the file src of the host or VM obj to the local file dst. Returns a Result.
+    '''
+    return _run(_get, [obj], src, dst, chunksize, streams, 1, username=username,
+                password=password, timeout=timeout)[obj]
+
+
+def summary(results):
+    ''' Aggregate of put() results; rate is the overall throughput in bytes per second. '''
+    results = list(results.values())
+    elapsed = max([r.elapsed for r in results if r.elapsed is not None] or [0])
+    total = sum(r.bytes for r in results)
+    return {
+        'targets': len(results),
+        'failed': len([r for r in results if not r.ok]),
+        'bytes': total,
+        'chunks': sum(r.chunks for r in results),
+        'skipped': sum(r.skipped for r in results),
+        'elapsed': elapsed,
+        'rate': total / elapsed if elapsed else None,
+    }
@@ -23,20 +23,28 @@ accessible by their vsphere API:
 http://pubs.vmware.com/vsphere-65/index.jsp?topic=%2Fcom.vmware.wssdk.apiref.doc%2Fright-pane.html
 '''
 
-import dalibs.retry
+import capacity as _capacity
 import deploy
+import hedge
+import hostsystem
 import ssl
+import tail as _tail
+import wait
 from pyVmomi import vim, vmodl, SoapStubAdapter
 from pyVim.connect import VimSessionOrientedStub
 
 
 class VC(object):
-    def __init__(self, host, username=None, password=None, timeout=None, verify_mode=ssl.CERT_NONE):
+    def __init__(self, host, username=None, password=None, timeout=None, verify_mode=ssl.CERT_NONE,
+                 hedged=False):
         self.host = host
         self.username = username
         self.password = password
         xtra_kwargs = vim.get_ssl_context(verify_mode=verify_mode)
         soapStub = SoapStubAdapter(host=self.host, version='vim.version.version10', **xtra_kwargs)
+        # Hedge idempotent reads (see hedge.py). The stats are in self.hedger.stats.
+        self.hedger = hedge.Hedger() if hedged else None
+        soapStub.hedger = self.hedger
         sessionStub = VimSessionOrientedStub(soapStub,
             VimSessionOrientedStub.makeUserLoginMethod(self.username, self.password))
         self.si = vim.ServiceInstance('ServiceInstance', sessionStub)
@@ -50,6 +58,7 @@ class VC(object):
             'host': self.host,
             'username': self.username,
             'password': self.password,
+            'hedged': self.hedger is not None,
         }
 
     def __setstate__(self, state):
@@ -59,6 +68,13 @@ class VC(object):
     def find(self, klass, path=None, attrs=[]):
         return self.content.rootFolder.find(klass, path=path, attrs=attrs)
 
+    def deadline(self, seconds):
+        '''
+        Context manager bounding all calls made by this thread within it to seconds.
+        The remaining time is applied as the socket timeout of each request.
+        '''
+        return hedge.deadline(seconds)
+
     @property
     def apiType(self):
         return self.si.content.about.apiType
@@ -91,12 +107,53 @@ class VC(object):
                 continue
         return None
 
+    def capacity(self, hosts=None):
+        '''
+        Capacity snapshot (see capacity.py) of hosts, or of all the hosts.
+        '''
+        if hosts is None:
+            return _capacity.snapshot(self.content.rootFolder)
+        return _capacity.snapshot(hosts=hosts)
+
+    def host_addresses(self, hosts=None):
+        '''
+        The management (ipaddr, macaddr) of hosts (default: all), in one paged query.
+        They are cached for the session, so host.ipaddr is free afterwards.
+        '''
+        if hosts is None:
+            return hostsystem.management_addresses(self.content.rootFolder)
+        return hostsystem.management_addresses(hosts=hosts)
+
+    def tail(self, callback=None, checkpoint=None, types=None):
+        '''
+        The live event stream (see tail.py) of this VC, with callback subscribed.
+        '''
+        return _tail.tail(self.content.rootFolder, callback, checkpoint, types)
+
     def ImportOVF(self, ovffile, **kwargs):
+        '''
+        Import an OVF. With reuse=True, the OVF is imported once per datastore as a
+        template, and deployed as a linked clone of it from then on. For batches, pass
+        placement=deploy.PlacementContext(self, ...) instead of the placement kwargs. With
+        resources={'cpu': MHz, 'mem': MB, 'disk': GB}, the host (and datastore) is picked
+        by capacity among the hosts of the resource pool's compute resource, see
+        ComputeResource.PlaceVM (standalone hosts under a VC are not placed across).
+        '''
         if not ovffile.endswith('ovf'):
             raise Exception('Filename must end with .ovf: %s' % ovffile)
         ovf = deploy.OVF(self)
         ovf.importovf(ovffile, **kwargs)
 
+    def ImportOVA(self, source, **kwargs):
+        '''
+        Import an OVA from a local path or an http(s) URL. The OVA is streamed, its
+        disks are never extracted locally. Takes the same kwargs as ImportOVF.
+        '''
+        if not source.endswith('ova'):
+            raise Exception('Filename must end with .ova: %s' % source)
+        ovf = deploy.OVF(self)
+        ovf.importova(source, **kwargs)
+
     def GetVCPoolUsage(self, datacenter_name, pool_name):
         '''
         Returns a tuple of (available, [allocated ips])
@@ -114,17 +171,24 @@ class VC(object):
         available = vcpool_ips - len(allocated)
         return (available, allocated)
 
-    def RegisterVM(self, vc_datastore_name, vmx_path, vm_name):
+    def RegisterVM(self, vc_datastore_name, vmx_path, vm_name, placement=None):
         '''
         Register the VM at the specified path in the specified datastore and return
-        the result VM object.
+        the result VM object. The VM goes to the folder, resource pool and host of
+        placement (a deploy.PlacementContext), if provided.
         '''
         vmx_path_on_esx = '[%s] %s' % (vc_datastore_name, vmx_path.lstrip('/'))
-        datacenters = self.si.content.rootFolder.childEntity
-        vm_folder = datacenters[0].vmFolder
-        clusters = datacenters[0].hostFolder.childEntity
-        pool = clusters[0].resourcePool
-        vm_folder.RegisterVM_Task(vmx_path_on_esx, vm_name, asTemplate=False, pool=pool).wait()
+        host = None
+        if placement is not None:
+            placement.validate()
+            vm_folder, pool, host = placement.folder, placement.resourcepool, placement.host
+        else:
+            datacenters = self.si.content.rootFolder.childEntity
+            vm_folder = datacenters[0].vmFolder
+            clusters = datacenters[0].hostFolder.childEntity
+            pool = clusters[0].resourcePool
+        vm_folder.RegisterVM_Task(vmx_path_on_esx, vm_name, asTemplate=False, pool=pool,
+                                  host=host).wait()
         return self.vm(vm_name)
 
     def WaitForDatastore(self, datastore_name, timeout=30):
@@ -132,6 +196,23 @@ class VC(object):
         Wait for VC to become aware of a particular datastore.
         '''
         msg = 'VC did not become aware of datastore "%s" in time' % datastore_name
-        for _ in dalibs.retry.retry(timeout=timeout, sleeptime=1, message=msg):
-            if datastore_name in [ds.name for ds in self.find(vim.Datastore)]:
-                return
+        view = self.content.viewManager.CreateContainerView(self.content.rootFolder,
+            [vim.Datastore], True)
+        try:
+            wait.wait_for(view, 'name', lambda names: datastore_name in names.values(),
+                timeout=timeout, klass=vim.Datastore, message=msg)
+        finally:
+            view.DestroyView()
+
+    def WaitForIps(self, vms, timeout=300):
+        '''
+        Wait for the IP addresses of many VMs to be visible to VMware tools, using a
+        single property collector filter. Returns a dictionary of {vm: ipaddr}.
+        '''
+        vms = list(vms)
+        if not vms:
+            return {}
+        msg = 'IP addresses of %d VMs did not become visible in time' % len(vms)
+        return wait.wait_for(vms, 'guest.ipAddress',
+            lambda ips: len(ips) == len(vms) and all(ips.values()),
+            timeout=timeout, message=msg)
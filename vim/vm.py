@@ -20,17 +20,26 @@ Adds functionality to pyVmomi.Vim.VirtualMachine
 '''
 
 
-import dalibs.retry
 import dalibs.ssh
 import datetime
+import deploy
+import devices as _devices
 import os
 import re
+import reconfig
 import requests
+import sshpool
 import urllib
+import wait
+import weakref
 import yaml
 from pyVmomi import vim, vmodl
 
 
+# Device snapshots per VM, see devices().
+_snapshots = weakref.WeakKeyDictionary()
+
+
 def GetNote(self):
     s = yaml.load(self.config.annotation)
     if s is None or not isinstance(s, dict):
@@ -38,15 +47,37 @@ def GetNote(self):
     return s
 
 
-def SetNote(self, value):
+def VirtualMachineConfigSpec_SetNote(self, value):
+    '''
+    Get a VirtualMachineConfigSpec that sets the annotation to the yaml dump of value.
+    '''
     if not isinstance(value, dict):
         raise ValueError('vim.VirtualMachine.annotate expects to be a dictionary.')
     config = vim.VirtualMachineConfigSpec()
     config.annotation = yaml.dump(value, default_flow_style=False)
-    t = self.ReconfigVM_Task(config)
+    return config
+
+
+def SetNote(self, value):
+    t = self.ReconfigVM_Task(self.VirtualMachineConfigSpec_SetNote(value))
     t.wait(timeout=240)
 
 
+def reconfigure(self, wait=True, timeout=240):
+    '''
+    Merge many edits into a single ReconfigVM_Task. The VirtualMachineConfigSpec_*
+    helpers contribute their pieces to it, for example:
+
+        with vm.reconfigure() as spec:
+            spec.AddDevices({'nic': ['vlan1550']})
+            spec.ReserveResources({'ncpus': 2, 'mem': 4096, 'cpu': 1000})
+            spec.SetNote({'owner': 'kyle'})
+
+    See reconfig.Reconfigure.
+    '''
+    return reconfig.Reconfigure(self, wait=wait, timeout=timeout)
+
+
 def Touch(self):
     notes = self.GetNote()
     notes['touched_at'] = datetime.datetime.now()
@@ -64,6 +95,35 @@ def utilization(self):
     }
 
 
+def devices(self, refresh=False):
+    '''
+    Get an indexed snapshot (devices.Devices) of config.hardware.device. The snapshot
+    is cached and reused for as long as config.changeVersion does not change; it is
+    dropped on ReconfigVM_Task. Use refresh to force a new snapshot.
+    '''
+    snapshot = _snapshots.get(self)
+    if snapshot is not None and not refresh:
+        # Much cheaper than config.hardware.device (or config) itself.
+        if snapshot.changeVersion == self.properties(['config.changeVersion']).get('config.changeVersion'):
+            return snapshot
+    props = self.properties(['config.changeVersion', 'config.hardware.device'])
+    snapshot = _devices.Devices(props.get('config.hardware.device', []),
+                                props.get('config.changeVersion'))
+    _snapshots[self] = snapshot
+    return snapshot
+
+
+def ReconfigVM_Task(self, spec):
+    '''
+    Override a VirtualMachine's ReconfigVM_Task in order to drop the cached device
+    snapshot (see devices()).
+
+    In patched.py, the original ReconfigVM_Task should be stored under _ReconfigVM_Task()
+    '''
+    _snapshots.pop(self, None)
+    return self._ReconfigVM_Task(spec)
+
+
 def GetDevices(self, deviceType=vim.VirtualDevice):
     '''
     Get all virtual devices of the specified type (e.g., VirtualDevice,
@@ -71,14 +131,14 @@ def GetDevices(self, deviceType=vim.VirtualDevice):
     Virtual, ParaVirtualSCSIController, VirtualLsiLogicSCSIController,
     VirtualLsiLogicSASController).
     '''
-    return [c for c in self.config.hardware.device if isinstance(c, deviceType)]
+    return list(self.devices().bytype(deviceType))
 
 
 def GetDevicesOnController(self, controller, deviceType=vim.VirtualDevice):
     '''
     Get all the devices of the specified type on the provide controller device.
     '''
-    return [d for d in self.GetDevices(deviceType) if d.key in controller.device]
+    return self.devices().oncontroller(controller, deviceType)
 
 
 def GetDisksOnController(self, controller):
@@ -94,10 +154,13 @@ def GetDevicesOnControllers(self, controllerType=vim.VirtualController,
     Get all devices of the provided type on all controllers of the provided type. busNumber and/or
     unitNumber can be used to limit the devices returned.
     '''
-    controllers = [c for c in self.GetDevices(controllerType)
+    devices = self.devices()
+    controllers = [c for c in devices.bytype(controllerType)
                    if busNumber is None or c.busNumber == busNumber]
-    return [d for c in controllers for d in self.GetDevicesOnController(c, deviceType)
-            if unitNumber is None or d.unitNumber == unitNumber]
+    if unitNumber is not None:
+        slots = [devices.slot(c, unitNumber) for c in controllers]
+        return [d for d in slots if isinstance(d, deviceType)]
+    return [d for c in controllers for d in devices.oncontroller(c, deviceType)]
 
 
 def GetDisksOnControllers(self, controllerType=vim.VirtualController, busNumber=None,
@@ -113,22 +176,24 @@ def disks(self):
     '''
     Get a list of all disk devices.
     '''
-    return self.GetDisksOnControllers()
+    return self.devices().disks()
 
 
-def VirtualDeviceConfigSpec_AddController(self, controllerType, busNumber):
+def VirtualDeviceConfigSpec_AddController(self, controllerType, busNumber, snapshot=None):
     '''
     Get a VirtualDeviceConfigSpec to create a virtual disk controller of the specified
     controller type using the provide bus number.
     '''
-    existing_controller = [c for c in self.GetDevices(controllerType) if c.busNumber == busNumber]
-    assert len(existing_controller) == 0, "Controller already exists %s" % existing_controller[0]
+    if snapshot is None:
+        snapshot = self.devices()
+    existing_controller = snapshot.controller(controllerType, busNumber)
+    assert existing_controller is None, "Controller already exists %s" % existing_controller
     config = vim.VirtualDeviceConfigSpec()
     config.operation = vim.VirtualDeviceConfigSpecOperation.add
     config.device = controllerType()
     if isinstance(config.device, vim.VirtualSCSIController):
         config.device.sharedBus = getattr(vim.VirtualSCSIController.Sharing, 'noSharing')
-    config.device.key = -((busNumber + 1) * 100) - 1
+    config.device.key = snapshot.newkey()
     config.device.busNumber = busNumber
     return config
 
@@ -169,7 +234,7 @@ def GetDisks(self):
     '''
     Get all the disks in the virtual machine.
     '''
-    return [d for d in self.config.hardware.device if isinstance(d, vim.VirtualDisk)]
+    return list(self.devices().bytype(vim.VirtualDisk))
 
 
 def GetDiskFiles(self):
@@ -190,9 +255,7 @@ def WaitForIp(self, timeout=300):
     '''
     Wait for the IP address of the VM to be visible to VMware tools.
     '''
-    for _ in dalibs.retry.retry(timeout=timeout, sleeptime=1):
-        if self.ipaddr:
-            return
+    return wait.wait_for(self, 'guest.ipAddress', bool, timeout=timeout)
 
 
 def ipaddr(self):
@@ -206,14 +269,20 @@ def Popen(self, *args, **kwargs):
 
 
 def call(self, *args, **kwargs):
+    if sshpool.usable(kwargs):
+        return sshpool.pool.call(self.ipaddr, *args, **kwargs)
     return dalibs.ssh.call(self.ipaddr, *args, name=self.ipaddr, **kwargs)
 
 
 def check_call(self, *args, **kwargs):
+    if sshpool.usable(kwargs):
+        return sshpool.pool.check_call(self.ipaddr, *args, **kwargs)
     return dalibs.ssh.check_call(self.ipaddr, *args, name=self.ipaddr, **kwargs)
 
 
 def check_output(self, *args, **kwargs):
+    if sshpool.usable(kwargs):
+        return sshpool.pool.check_output(self.ipaddr, *args, **kwargs)
     return dalibs.ssh.check_output(self.ipaddr, *args, name=self.ipaddr, **kwargs)
 
 
@@ -255,11 +324,11 @@ def events(self):
         collector.DestroyCollector()
 
 
-def RemoveDisk_Task(self, disk, controller=None):
-    # Default to the last controller.
-    if not controller:
-        controller = [x for x in self.config.hardware.device
-                      if isinstance(x, vim.VirtualSCSIController)][-1]
+def VirtualMachineConfigSpec_RemoveDisk(self, disk, controller=None):
+    '''
+    Get a VirtualMachineConfigSpec that removes the provided disk device. The disk's own
+    controllerKey is used; controller is accepted for backwards compatibility.
+    '''
     spec = vim.VirtualMachineConfigSpec()
     spec.deviceChange.append(vim.VirtualDeviceConfigSpec())
     spec.deviceChange[0].device = vim.VirtualDisk()
@@ -267,7 +336,11 @@ def RemoveDisk_Task(self, disk, controller=None):
     spec.deviceChange[0].operation = vim.VirtualDeviceConfigSpecOperation()
     spec.deviceChange[0].operation = 'remove'
     spec.deviceChange[0].device.key = disk.key
-    return self.ReconfigVM_Task(spec)
+    return spec
+
+
+def RemoveDisk_Task(self, disk, controller=None):
+    return self.ReconfigVM_Task(self.VirtualMachineConfigSpec_RemoveDisk(disk, controller))
 
 
 def GetDiskControllerInfo(self, controller_type):
@@ -305,7 +378,26 @@ def GetDiskControllerInfo(self, controller_type):
 def AddDisk_Task(self, gbytes=0, ssd=False, fileName=None, diskMode=vim.VirtualDiskMode.persistent,
                  controllerType=vim.VirtualLsiLogicController, busNumber=0, unitNumber=0, noAlts=False):
     '''
-    Return a task for adding a disk to a VM.
+    Return a task for adding a disk to a VM. See VirtualMachineConfigSpec_AddDisk.
+    '''
+    spec, dev_node_string = _AddDisk(self, gbytes, ssd, fileName, diskMode, controllerType,
+                                     busNumber, unitNumber, noAlts, self.devices())
+    task = self.ReconfigVM_Task(spec)
+    if self.si.content.about.apiType == 'VirtualCenter':
+        msg = vmodl.LocalizableMessage()
+        msg.key = "dev_node_string"
+        msg.message = dev_node_string
+        task.SetTaskDescription(msg)
+
+    return task
+
+
+def VirtualMachineConfigSpec_AddDisk(self, gbytes=0, ssd=False, fileName=None,
+                                     diskMode=vim.VirtualDiskMode.persistent,
+                                     controllerType=vim.VirtualLsiLogicController, busNumber=0,
+                                     unitNumber=0, noAlts=False, snapshot=None):
+    '''
+    Get a VirtualMachineConfigSpec for adding a disk to a VM.
 
     Argument summary.
 
@@ -318,8 +410,19 @@ def AddDisk_Task(self, gbytes=0, ssd=False, fileName=None, diskMode=vim.VirtualD
        unitNumber: unit number (device number) to start looking for an available slot.
        noAlts: fail if busNumber and unitNumber are not available in specified controller;
         when noAlts is False, we look for an available slot after the provided bus/unit.
+       snapshot: device snapshot to plan against (defaults to self.devices()).
     '''
+    if snapshot is None:
+        snapshot = self.devices()
+    return _AddDisk(self, gbytes, ssd, fileName, diskMode, controllerType, busNumber, unitNumber,
+                    noAlts, snapshot)[0]
+
 
+def _AddDisk(self, gbytes, ssd, fileName, diskMode, controllerType, busNumber, unitNumber, noAlts,
+             snapshot):
+    '''
+    Returns the VirtualMachineConfigSpec and the device node (e.g., scsi0:1) of the new disk.
+    '''
     assert fileName is None or gbytes == 0
     assert fileName is not None or gbytes != 0
 
@@ -335,21 +438,17 @@ def AddDisk_Task(self, gbytes=0, ssd=False, fileName=None, diskMode=vim.VirtualD
         n_bus_numbers = busNumber + 1
         n_unit_numbers = unitNumber + 1
 
-    controllers = self.GetDevices(abs_controller_type)
     results = None
     for bus_number in range(busNumber, n_bus_numbers):
-        controller = [c for c in controllers if c.busNumber == bus_number]
+        controller = snapshot.controller(abs_controller_type, bus_number)
         start_unit_number = unitNumber if bus_number == busNumber else 0
-        if len(controller) == 0:
+        if controller is None:
             results = bus_number, start_unit_number
             break
-        controller = controller[0]
-        for unit_number in range(start_unit_number, n_unit_numbers):
-            if (unit_number not in invalid_unit_numbers and
-                len(self.GetDevicesOnControllers(abs_controller_type, busNumber=bus_number, unitNumber=unit_number)) == 0):
-                results = controller, unit_number
-                break
-        if results is not None:
+        unit_number = snapshot.free(controller, n_unit_numbers, invalid_unit_numbers,
+                                    start_unit_number)
+        if unit_number is not None:
+            results = controller, unit_number
             break
 
     if results is None:
@@ -367,11 +466,12 @@ def AddDisk_Task(self, gbytes=0, ssd=False, fileName=None, diskMode=vim.VirtualD
     else:
         assert type(controller) == int, "Unexpected results values: %s" % results
         busNumber = controller
-        controller_config = self.VirtualDeviceConfigSpec_AddController(controllerType, busNumber)
+        controller_config = self.VirtualDeviceConfigSpec_AddController(controllerType, busNumber,
+                                                                       snapshot)
         spec.deviceChange.append(controller_config)
         controller = controller_config.device
 
-    datastore = self.disks[-1].backing.datastore
+    datastore = snapshot.disks()[-1].backing.datastore
     disk_config = self.VirtualDeviceConfigSpec_AddDisk(datastore, controller, unit_number,
                                                      diskMode, gbytes, fileName)
     spec.deviceChange.append(disk_config)
@@ -381,15 +481,7 @@ def AddDisk_Task(self, gbytes=0, ssd=False, fileName=None, diskMode=vim.VirtualD
             vim.OptionValue(key='%s%s:%s.virtualSSD' % (device_type_str, busNumber, unit_number), value='1')
         ]
 
-    task = self.ReconfigVM_Task(spec)
-    if self.si.content.about.apiType == 'VirtualCenter':
-        dev_node_string = '%s%d:%d' % (device_type_str, busNumber, unit_number)
-        msg = vmodl.LocalizableMessage()
-        msg.key = "dev_node_string"
-        msg.message = dev_node_string
-        task.SetTaskDescription(msg)
-
-    return task
+    return spec, '%s%d:%d' % (device_type_str, busNumber, unit_number)
 
 
 def PowerOffVM_Task(self):
@@ -432,6 +524,18 @@ def Destroy_Task(self):
     return self._Destroy_Task()
 
 
+def ExportOVF(self, dest, parallel=1, name=None):
+    '''
+    Export the (powered off) VM as an OVF to the directory dest, downloading up to
+    parallel disks at once. See deploy.OVF.exportovf.
+    '''
+    stub = getattr(self._stub, 'soapStub', self._stub)
+    vc = deploy.Container()  # the parts of a vim.VC that deploy.OVF needs
+    vc.si = self.si
+    vc.host = stub.host
+    return deploy.OVF(vc).exportovf(self, dest, parallel, name)
+
+
 def CreateAndGetScreenshot(self, localpath, username, password, timeout=None):
     '''
     Uses VirtualMachine's CreateScreenshot_Task and python requests to reallocate
@@ -469,7 +573,14 @@ def CreateAndGetScreenshot(self, localpath, username, password, timeout=None):
 
 def ReserveResources_Task(self, resources):
     '''
-    Reserve cpu and memory resources
+    Reserve cpu and memory resources. See VirtualMachineConfigSpec_ReserveResources.
+    '''
+    return self.ReconfigVM_Task(self.VirtualMachineConfigSpec_ReserveResources(resources))
+
+
+def VirtualMachineConfigSpec_ReserveResources(self, resources):
+    '''
+    Get a VirtualMachineConfigSpec that reserves cpu and memory resources
 
     Valid keys and values:
     ncpus - number of virtual cpus
@@ -497,12 +608,20 @@ def ReserveResources_Task(self, resources):
     spec.memoryAllocation.shares.level = vim.SharesInfo.Level.normal
     spec.memoryAllocation.shares.shares = 0
     spec.memoryReservationLockedToMax = True
-    return self.ReconfigVM_Task(spec)
+    return spec
 
 
 def AddDevices_Task(self, devices):
     '''
-    Add multiple devices in a single task
+    Add multiple devices in a single task. See VirtualMachineConfigSpec_AddDevices.
+    '''
+    return self.ReconfigVM_Task(self.VirtualMachineConfigSpec_AddDevices(devices))
+
+
+def VirtualMachineConfigSpec_AddDevices(self, devices, snapshot=None):
+    '''
+    Get a VirtualMachineConfigSpec that adds multiple devices. snapshot is the device
+    snapshot to plan against (defaults to self.devices()).
 
     Devices is a list of device mappings
 
@@ -524,17 +643,16 @@ def AddDevices_Task(self, devices):
     '''
     spec = vim.VirtualMachineConfigSpec()
     spec.deviceChange = []
-    # Unique negative keys for this operation, VC will generate the permanent ones.
-    key = -1
+    if snapshot is None:
+        snapshot = self.devices()
     if 'scsi' in devices:
         sharing = devices['scsi'] + 'Sharing'
-        controller = [x for x in self.config.hardware.device
-                      if isinstance(x, vim.VirtualSCSIController)][-1]
+        controller = snapshot.bytype(vim.VirtualSCSIController)[-1]
         config = vim.VirtualDeviceConfigSpec()
         config.operation = vim.VirtualDeviceConfigSpecOperation.add
         config.device = vim.VirtualLsiLogicController()
-        config.device.key = key
-        key -= 1
+        # A unique negative key, VC will generate the permanent one.
+        config.device.key = snapshot.newkey()
         config.device.busNumber = controller.busNumber + 1
         config.device.unitNumber = controller.unitNumber + 1
         config.device.sharedBus = getattr(vim.VirtualSCSIController.Sharing, sharing)
@@ -558,17 +676,29 @@ def AddDevices_Task(self, devices):
             config = vim.VirtualDeviceConfigSpec()
             config.operation = vim.VirtualDeviceConfigSpecOperation.add
             config.device = getattr(vim, nictype[i])()
-            config.device.key = key
-            key -= 1
+            config.device.key = snapshot.newkey()
             config.device.backing = vim.VirtualEthernetCard.NetworkBackingInfo()
             config.device.backing.deviceName = backing
             spec.deviceChange.append(config)
-    return self.ReconfigVM_Task(spec)
+    return spec
 
 
-def AddDisks_Task(self, disks):
+def AddDisks_Task(self, disks, policy=None, controllerType=vim.ParaVirtualSCSIController):
     '''
-    Add multiple disks in a single task
+    Add multiple disks in a single task. See VirtualMachineConfigSpec_AddDisks. With a
+    policy, the disks are spread over as many controllers as needed, see
+    VirtualMachineConfigSpec_PlanDisks.
+    '''
+    if policy is not None:
+        return self.ReconfigVM_Task(self.VirtualMachineConfigSpec_PlanDisks(disks, policy,
+                                                                            controllerType))
+    return self.ReconfigVM_Task(self.VirtualMachineConfigSpec_AddDisks(disks))
+
+
+def VirtualMachineConfigSpec_AddDisks(self, disks, snapshot=None):
+    '''
+    Get a VirtualMachineConfigSpec that adds multiple disks. snapshot is the device
+    snapshot to plan against (defaults to self.devices()).
 
     Disks is a list of disk mappings
 
@@ -582,35 +712,17 @@ def AddDisks_Task(self, disks):
                for example "datastore1 (colo-esx10)". The default datastore is derived using
                dsprefix "datatstore1"
     '''
+    if snapshot is None:
+        snapshot = self.devices()
     spec = vim.VirtualMachineConfigSpec()
-    controller = [x for x in self.config.hardware.device
-        if isinstance(x, vim.VirtualSCSIController)][-1]
-    unitNumber = len([x for x in self.disks if x.controllerKey == controller.key])
+    controller = snapshot.bytype(vim.VirtualSCSIController)[-1]
+    unitNumber = len(snapshot.oncontroller(controller, vim.VirtualDisk))
     spec.extraConfig = []
     spec.deviceChange = []
     for disk in disks:
         if unitNumber == 7:  # scsi ID 7 is invalid
             unitNumber = unitNumber + 1
-        config = vim.VirtualDeviceConfigSpec()
-        config.operation = vim.VirtualDeviceConfigSpecOperation.add
-        config.device = vim.VirtualDisk()
-        config.device.key = (unitNumber * -1) - 1  # a unique negative number for this disk
-        config.device.backing = vim.VirtualDiskFlatVer2BackingInfo()
-        config.device.backing.diskMode = vim.VirtualDiskMode.persistent
-        if disk.get('backing'):
-            config.device.backing.fileName = disk['backing']
-        else:
-            dsname = disk.get('dsname')
-            config.fileOperation = vim.VirtualDeviceConfigSpecFileOperation.create
-            config.device.backing.fileName = '[%s]' % dsname
-            config.device.backing.thinProvisioned = True
-            if disk.get('mode', 'thin') == 'thick':
-                config.device.backing.thinProvisioned = False
-                config.device.backing.eagerlyScrub = True
-            config.device.capacityInKB = disk['gbytes'] * 1024 * 1024
-        config.device.controllerKey = controller.key
-        config.device.unitNumber = unitNumber
-        spec.deviceChange.append(config)
+        spec.deviceChange.append(_DiskConfig(disk, controller, unitNumber, snapshot.newkey()))
         if disk.get('ssd'):
             spec.extraConfig += [
                 vim.OptionValue(key='disk.enableVirtualSSD', value='TRUE'),
@@ -619,7 +731,115 @@ def AddDisks_Task(self, disks):
                     value='1')
             ]
         unitNumber = unitNumber + 1
-    return self.ReconfigVM_Task(spec)
+    return spec
+
+
+def _DiskConfig(disk, controller, unitNumber, key):
+    '''
+    Get a VirtualDeviceConfigSpec that adds the disk mapping disk (see
+    VirtualMachineConfigSpec_AddDisks) in the (controller, unitNumber) slot.
+    '''
+    config = vim.VirtualDeviceConfigSpec()
+    config.operation = vim.VirtualDeviceConfigSpecOperation.add
+    config.device = vim.VirtualDisk()
+    config.device.key = key
+    config.device.backing = vim.VirtualDiskFlatVer2BackingInfo()
+    config.device.backing.diskMode = vim.VirtualDiskMode.persistent
+    if disk.get('backing'):
+        config.device.backing.fileName = disk['backing']
+    else:
+        dsname = disk.get('dsname')
+        config.fileOperation = vim.VirtualDeviceConfigSpecFileOperation.create
+        config.device.backing.fileName = '[%s]' % dsname
+        config.device.backing.thinProvisioned = True
+        if disk.get('mode', 'thin') == 'thick':
+            config.device.backing.thinProvisioned = False
+            config.device.backing.eagerlyScrub = True
+        config.device.capacityInKB = disk['gbytes'] * 1024 * 1024
+    config.device.controllerKey = controller.key
+    config.device.unitNumber = unitNumber
+    return config
+
+
+DISK_POLICIES = ('pack', 'roundrobin', 'tier')
+
+
+def VirtualMachineConfigSpec_PlanDisks(self, disks, policy='pack',
+                                       controllerType=vim.ParaVirtualSCSIController, snapshot=None):
+    '''
+    Get a VirtualMachineConfigSpec that adds the disk mappings disks (see
+    VirtualMachineConfigSpec_AddDisks, plus an optional 'tier') using as many controllers
+    as needed. Missing controllers of controllerType are added, up to the number of buses
+    in GetDiskControllerInfo.
+
+    Supported policies:
+    pack - fill the free slots of the existing controllers, in bus order, before adding
+           a controller.
+    roundrobin - spread the disks over all buses; each disk goes to the controller with
+                 the fewest devices.
+    tier - disks with different 'tier' values never share a controller; each tier is
+           packed onto its own controllers. Controllers that already have devices are
+           only used for disks without a tier.
+    '''
+    assert policy in DISK_POLICIES, 'Unknown disk placement policy %s' % policy
+    if snapshot is None:
+        snapshot = self.devices()
+    info = self.GetDiskControllerInfo(controllerType)
+    abs_controller_type = info['abs_controller_type']
+    units = [u for u in range(info['n_unit_numbers']) if u not in info['invalid_unit_numbers']]
+
+    plan = snapshot.copy()  # the snapshot plus the devices planned so far
+    owners = {}  # busNumber => tier
+    for bus_number in range(info['n_bus_numbers']):
+        controller = plan.controller(abs_controller_type, bus_number)
+        if controller is not None and plan.oncontroller(controller):
+            owners[bus_number] = None
+
+    spec = vim.VirtualMachineConfigSpec()
+    spec.extraConfig = []
+    spec.deviceChange = []
+    for index, disk in enumerate(disks):
+        tier = disk.get('tier') if policy == 'tier' else None
+        candidates = []
+        for bus_number in range(info['n_bus_numbers']):
+            if policy == 'tier' and owners.get(bus_number, tier) != tier:
+                continue
+            controller = plan.controller(abs_controller_type, bus_number)
+            if controller is None:
+                used, unit_number = 0, units[0]
+            else:
+                used = len(plan.oncontroller(controller))
+                unit_number = plan.free(controller, info['n_unit_numbers'],
+                                        info['invalid_unit_numbers'])
+                if unit_number is None:
+                    continue
+            if policy == 'roundrobin':
+                rank = (used, bus_number)
+            else:
+                rank = (bus_number not in owners, controller is None, bus_number)
+            candidates.append((rank, bus_number, unit_number))
+        if not candidates:
+            raise Exception('No free %s slot for disk %d of %d (policy %s)' %
+                            (info['device_type_str'], index + 1, len(disks), policy))
+        _, bus_number, unit_number = min(candidates)
+        owners.setdefault(bus_number, tier)
+
+        controller = plan.controller(abs_controller_type, bus_number)
+        if controller is None:
+            config = self.VirtualDeviceConfigSpec_AddController(controllerType, bus_number, plan)
+            spec.deviceChange.append(config)
+            plan.add(config.device)
+            controller = config.device
+        config = _DiskConfig(disk, controller, unit_number, plan.newkey())
+        spec.deviceChange.append(config)
+        plan.add(config.device)
+        if disk.get('ssd'):
+            spec.extraConfig.append(vim.OptionValue(
+                key='%s%s:%s.virtualSSD' % (info['device_type_str'], bus_number, unit_number),
+                value='1'))
+    if spec.extraConfig:
+        spec.extraConfig.insert(0, vim.OptionValue(key='disk.enableVirtualSSD', value='TRUE'))
+    return spec
 
 
 def AddPoolIPs_Task(self, qty=1, network='VM Network', persist=True):
@@ -640,6 +860,21 @@ def AddPoolIPs(self, qty=1, network='VM Network', persist=True):
     VC must have the pool configured and associated with the specified network.
     '''
     assert self.runtime.powerState == vim.VirtualMachine.PowerState.poweredOff
+    t = self.ReconfigVM_Task(self.VirtualMachineConfigSpec_AddPoolIPs(qty, network))
+    t.wait()
+    if persist:
+        self.PowerOnVM_Task().wait()
+        PersistPoolIPs(self, network)
+        self.PowerOffVM_Task().wait()
+    # Maintain backwards compatibility with _Task().
+    return t
+
+
+def VirtualMachineConfigSpec_AddPoolIPs(self, qty=1, network='VM Network'):
+    '''
+    Get a VirtualMachineConfigSpec that enables acquiring qty IP(s) via IP Pools. The
+    IPs are not persisted (see AddPoolIPs).
+    '''
     spec = vim.VirtualMachineConfigSpec()
     spec.vAppConfig = vim.VmConfigSpec()
     spec.vAppConfig.ipAssignment = vim.VAppIPAssignmentInfo()
@@ -669,14 +904,7 @@ def AddPoolIPs(self, qty=1, network='VM Network', persist=True):
         pspec.info.defaultValue = '${autoIp:%s}' % network
         pspec.operation = vim.ArrayUpdateOperation.add
         spec.vAppConfig.property.append(pspec)
-    t = self.ReconfigVM_Task(spec)
-    t.wait()
-    if persist:
-        self.PowerOnVM_Task().wait()
-        PersistPoolIPs(self, network)
-        self.PowerOffVM_Task().wait()
-    # Maintain backwards compatibility with _Task().
-    return t
+    return spec
 
 
 def PersistPoolIPs(self, network='VM Network'):
@@ -736,34 +964,59 @@ def GetPoolIPs(self):
 
 
 def NetworkConnect_Task(self, label, connected=True, network='VM Network'):
+    return self.ReconfigVM_Task(self.VirtualMachineConfigSpec_NetworkConnect(label, connected, network))
+
+
+def _nic(snapshot, label, nicTypes=vim.VirtualEthernetCard):
+    return [x for x in snapshot.bytype(nicTypes)
+            if x.deviceInfo is not None and x.deviceInfo.label == label][0]
+
+
+def VirtualMachineConfigSpec_NetworkConnect(self, label, connected=True, network='VM Network',
+                                            snapshot=None):
+    '''
+    Get a VirtualMachineConfigSpec that (dis)connects the nic with the provided label
+    to network.
+    '''
+    if snapshot is None:
+        snapshot = self.devices()
     spec = vim.VirtualMachineConfigSpec()
     spec.deviceChange = []
-    controller = [x for x in self.config.hardware.device
-                  if isinstance(x, vim.VirtualEthernetCard) and x.deviceInfo.label == label][0]
+    # Edit a new device; the snapshot must keep reflecting the VM's current configuration.
+    nic = _nic(snapshot, label)
     config = vim.VirtualDeviceConfigSpec()
     config.operation = vim.VirtualDeviceConfigSpecOperation.edit
-    config.device = controller
+    config.device = nic.__class__()
+    for field in ('key', 'controllerKey', 'unitNumber', 'macAddress', 'addressType', 'backing'):
+        setattr(config.device, field, getattr(nic, field))
     config.device.connectable = vim.VirtualDeviceConnectInfo()
     config.device.connectable.connected = connected
     config.device.connectable.startConnected = connected
     config.device.backing = vim.VirtualEthernetCard.NetworkBackingInfo()
     config.device.backing.deviceName = network
     spec.deviceChange.append(config)
-    return self.ReconfigVM_Task(spec)
+    return spec
 
 
 def RemoveNic_Task(self, label):
+    return self.ReconfigVM_Task(self.VirtualMachineConfigSpec_RemoveNic(label))
+
+
+def VirtualMachineConfigSpec_RemoveNic(self, label, snapshot=None):
+    '''
+    Get a VirtualMachineConfigSpec that removes the nic with the provided label.
+    '''
+    if snapshot is None:
+        snapshot = self.devices()
     spec = vim.VirtualMachineConfigSpec()
     spec.deviceChange = []
-    controller = [x for x in self.config.hardware.device
-                  if isinstance(x, (vim.VirtualE1000, vim.VirtualVmxnet3)) and
-                  x.deviceInfo.label == label][0]
+    controller = _nic(snapshot, label, (vim.VirtualE1000, vim.VirtualVmxnet3))
 
     config = vim.VirtualDeviceConfigSpec()
     config.operation = vim.VirtualDeviceConfigSpecOperation()
     config.operation = vim.VirtualDeviceConfigSpecOperation.remove
     config.device = controller
     spec.deviceChange.append(config)
-    return self.ReconfigVM_Task(spec)
+    return spec
 
 
@@ -0,0 +1,141 @@
+#
+#
+# Copyright (c) 2013-2018 Datrium Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Event driven waits built on PropertyCollector.WaitForUpdatesEx.
+
+Instead of re-reading a property every second, a filter is registered on a private
+PropertyCollector and the server pushes changes as they happen. While nothing changes,
+the only traffic is one long-poll request per maxWaitSeconds.
+
+Example:
+    >>> vim.wait_for(vm, 'guest.ipAddress', bool, timeout=300)
+    '10.80.8.124'
+'''
+
+import math
+import time
+from pyVmomi import vim, vmodl
+
+
+# Upper bound for a single long-poll, so idle HTTP connections are not reaped.
+MAX_WAIT_SECONDS = 60
+
+
+def _filterspec(objs, paths, klass=None):
+    pfspec = vmodl.query.PropertyCollector.FilterSpec()
+    if isinstance(objs, vim.view.ContainerView):
+        assert klass is not None, 'klass is required to watch the objects of a view'
+        tspec = vmodl.query.PropertyCollector.TraversalSpec()
+        tspec.name = 'traverseEntities'
+        tspec.type = vim.view.ContainerView
+        tspec.path = 'view'
+        tspec.skip = False
+        objspec = vmodl.query.PropertyCollector.ObjectSpec()
+        objspec.obj = objs
+        objspec.skip = True
+        objspec.selectSet = [tspec]
+        pfspec.objectSet = [objspec]
+        klasses = [klass]
+    else:
+        pfspec.objectSet = [vmodl.query.PropertyCollector.ObjectSpec(obj=o, skip=False)
+                            for o in objs]
+        klasses = [klass] if klass else list(set(o.__class__ for o in objs))
+    pfspec.propSet = [vmodl.query.PropertyCollector.PropertySpec(type=k, all=False, pathSet=paths)
+                      for k in klasses]
+    return pfspec
+
+
+def watch(objs, paths, klass=None, timeout=None):
+    '''
+    Generator that yields the current property values as a dict of
+    {obj: {path: value}} once initially and again every time one of them changes.
+    Stops when timeout (seconds) expires.
+
+    :param objs: a managed object, a list of managed objects, or a ContainerView
+    :param paths: property paths to watch
+    :param klass: type of the objects in a view (required for views)
+    '''
+    if not isinstance(objs, (list, tuple, vim.view.ContainerView)):
+        objs = [objs]
+    if not objs:
+        return
+    if isinstance(paths, basestring):
+        paths = [paths]
+    endtime = None
+    if timeout is not None:
+        endtime = time.time() + timeout
+
+    anchor = objs if isinstance(objs, vim.view.ContainerView) else objs[0]
+    si = vim.ServiceInstance('ServiceInstance', anchor._stub)
+    # A private collector, so our filter and version do not disturb other users of the session.
+    pc = si.content.propertyCollector.CreatePropertyCollector()
+    try:
+        pc.CreateFilter(_filterspec(objs, paths, klass), partialUpdates=True)
+        state = {}
+        version = ''
+        waited = False
+        while True:
+            maxwait = MAX_WAIT_SECONDS
+            if endtime is not None:
+                left = endtime - time.time()
+                if left <= 0 and waited:
+                    return  # even without any update (e.g., timeout=0 still checks once)
+                maxwait = int(math.ceil(min(max(left, 0), MAX_WAIT_SECONDS)))
+            options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=maxwait)
+            update = pc.WaitForUpdatesEx(version, options)
+            waited = True
+            if update is None:
+                continue  # maxWaitSeconds elapsed without a change
+            version = update.version
+            for fs in update.filterSet:
+                for ou in fs.objectSet:
+                    if ou.kind == vmodl.query.PropertyCollector.ObjectUpdate.Kind.leave:
+                        state.pop(ou.obj, None)
+                        continue
+                    values = state.setdefault(ou.obj, dict((p, None) for p in paths))
+                    for change in ou.changeSet:
+                        if change.op in ('remove', 'indirectRemove'):
+                            values[change.name] = None
+                        else:
+                            values[change.name] = change.val
+            if not update.truncated:
+                yield state
+    finally:
+        pc.DestroyPropertyCollector()
+
+
+def wait_for(obj, path, predicate, timeout=None, klass=None, message=None):
+    '''
+    Wait until predicate holds for property path and return the value predicate
+    accepted.
+
+    For a single managed object, predicate is called with the value of path. For a
+    list of managed objects or a ContainerView, it is called with a dict of
+    {obj: value} covering all (current) objects.
+    '''
+    single = not isinstance(obj, (list, tuple, vim.view.ContainerView))
+    for state in watch(obj, [path], klass=klass, timeout=timeout):
+        if single:
+            value = state.get(obj, {}).get(path)
+        else:
+            value = dict((o, v[path]) for o, v in state.items())
+        if predicate(value):
+            return value
+    if message is None:
+        message = 'wait_for(%s) timedout after %d seconds.' % (path, timeout)
+    raise Exception(message)